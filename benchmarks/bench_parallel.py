@@ -0,0 +1,161 @@
+"""
+Measure per-video throughput of parallel downloads over 1, 2, 4, ... connections.
+
+Runs `fetch_media` with the real yt-dlp against a local HTTP server that serves the same media
+as a single mp4 file (fetched in byte ranges) and as an HLS stream of segments (fetched as
+fragments). The server throttles each connection to `--connection-rate` bytes per second and
+delays every response by `--latency` seconds, like a CDN that throttles single connections.
+
+Usage:
+
+    python -m benchmarks.bench_parallel --size 16777216 --connections 1 2 4 8
+"""
+import io
+import re
+import shutil
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from telegram_media_downloader_bot.downloader import configure_ydl_pool, fetch_media
+from telegram_media_downloader_bot.ydl_pool import YoutubeDLPool
+
+_RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class SegmentedMediaServer(object):
+    """
+    Serves `size` bytes as `/video.mp4` (with range support) and as `/stream.m3u8`, an HLS playlist
+    of `segments` MPEG-TS segments.
+    """
+
+    def __init__(self, size: int, segments: int, connection_rate: float, latency: float):
+        body: bytes = b"\0" * size
+        segment_size: int = -(-size // segments)
+        playlist: bytes = "\n".join(
+            ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+            + [line for i in range(segments) for line in ("#EXTINF:2.0,", f"segment{i}.ts")]
+            + ["#EXT-X-ENDLIST", ""]).encode("utf-8")
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _resource(self) -> Tuple[bytes, str]:
+                if self.path.endswith(".m3u8"):
+                    return playlist, "application/vnd.apple.mpegurl"
+                match = re.search(r"segment(\d+)\.ts$", self.path)
+                if match:
+                    start: int = int(match.group(1)) * segment_size
+                    return body[start:start + segment_size], "video/mp2t"
+                return body, "video/mp4"
+
+            def _send(self, head: bool) -> None:
+                data, content_type = self._resource()
+                headers: Dict[str, str] = {"Content-Type": content_type, "Accept-Ranges": "bytes"}
+                status: int = 200
+                match: Optional[re.Match] = _RANGE.fullmatch(self.headers.get("Range") or "")
+                if match:
+                    first: int = int(match.group(1))
+                    last: int = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                    headers["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+                    data = data[first:last + 1]
+                    status = 206
+
+                time.sleep(latency)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if head:
+                    return
+
+                # Throttle this connection.
+                start: float = time.perf_counter()
+                sent: int = 0
+                for offset in range(0, len(data), 64 * 1024):
+                    self.wfile.write(data[offset:offset + 64 * 1024])
+                    sent = min(len(data), offset + 64 * 1024)
+                    delay: float = sent / connection_rate - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+            def do_HEAD(self):
+                self._send(head=True)
+
+            def do_GET(self):
+                self._send(head=False)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass  # yt-dlp's generic extractor hangs up after sniffing the first bytes.
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/{path}"
+
+    def start(self) -> "SegmentedMediaServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def run(url: str, directory: str, connections: int, max_size: int, downloads: int) -> List[float]:
+    """
+    Download `url` `downloads` times over up to `connections` connections and return the time each took, in seconds.
+    """
+    pool = YoutubeDLPool()
+    durations: List[float] = []
+    # yt-dlp isn't quiet in the bot's configuration.
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        for _ in range(downloads):
+            items, timings = fetch_media(url, directory, max_size=max_size, pool=pool, connections=connections)
+            for media in items:
+                media.close()
+            durations.append(timings.download)
+    pool.clear()
+    return durations
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024, help="Bytes per video.")
+    parser.add_argument("--segments", type=int, default=16, help="Segments of the HLS stream.")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4, 8], help="Connections per download to compare.")
+    parser.add_argument("--connection-rate", type=float, default=8 * 1024 * 1024, help="Bytes per second that the server sends on each connection.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the server answers each request.")
+    parser.add_argument("--downloads", type=int, default=3, help="Downloads per configuration.")
+    args = parser.parse_args()
+
+    # Give every download all of the connections it asks for.
+    configure_ydl_pool(max_connections=max(args.connections))
+    server = SegmentedMediaServer(args.size, args.segments, args.connection_rate, args.latency).start()
+    directory: str = tempfile.mkdtemp(prefix="bench-")
+    try:
+        print(f"{'media':<12}{'connections':>12}{'seconds':>10}{'MB/s':>10}")
+        for name, path in (("mp4 ranges", "video.mp4"), ("hls", "stream.m3u8")):
+            for connections in args.connections:
+                durations: List[float] = run(server.url(path), directory, connections, 2 * args.size, args.downloads)
+                best: float = min(durations)
+                print(f"{name:<12}{connections:>12}{best:>10.2f}{args.size / best / (1024 * 1024):>10.1f}")
+    finally:
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
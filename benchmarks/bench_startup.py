@@ -0,0 +1,93 @@
+"""
+Measure the bot's cold start: how long a fresh interpreter takes until the bot is ready to poll.
+
+Each run starts a new Python process that imports the bot, creates it and builds the application
+(everything `python -m telegram_media_downloader_bot` does before polling starts), without any
+network access. The process then runs `warm_up`, which imports yt-dlp and prepares a YoutubeDL
+instance; the bot does this in the background after start-up, so it is reported separately.
+
+Append the results to a file with `--output` to track cold-start regressions over time.
+
+Usage:
+
+    python -m benchmarks.bench_startup --runs 10 --output startup.jsonl
+"""
+import json
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, List
+
+from benchmarks.fake_bot_api import percentiles
+
+# Runs in the child process. Prints "ready" as soon as the bot could start polling, then the timings.
+CHILD: str = """
+import json, sys, tempfile, time
+start = time.perf_counter()
+from telegram.ext import ApplicationBuilder
+from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.downloader import warm_up
+imported = time.perf_counter()
+bot = MediaDownloaderBot(token="123456:benchmark", log_file="", scratch_dir=tempfile.mkdtemp(prefix="bench-"))
+app = ApplicationBuilder().token("123456:benchmark").post_init(bot.post_init).build()
+bot.init_handlers(app)
+ready = time.perf_counter()
+print("ready", flush=True)
+yt_dlp_loaded = "yt_dlp" in sys.modules
+warm_up(bot._scratch.directory)
+warmed_up = time.perf_counter()
+bot.close()
+print(json.dumps({"import": imported - start, "init": ready - imported, "warm_up": warmed_up - ready,
+                  "yt_dlp_at_start": yt_dlp_loaded}), flush=True)
+"""
+
+
+def run_once() -> Dict[str, float]:
+    """
+    Start one bot process and return its timings, in seconds.
+    """
+    start: float = time.perf_counter()
+    child = subprocess.Popen([sys.executable, "-c", CHILD], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    assert child.stdout is not None
+    line: str = child.stdout.readline().strip()
+    ready: float = time.perf_counter() - start
+    if line != "ready":
+        child.wait()
+        raise RuntimeError(f"Bot process failed to start (exit code {child.returncode})")
+
+    timings = json.loads(child.stdout.readline())
+    child.wait()
+    return {"ready": ready, "import": timings["import"], "init": timings["init"], "warm_up": timings["warm_up"],
+            "yt_dlp_at_start": float(timings["yt_dlp_at_start"])}
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="Number of processes to start.")
+    parser.add_argument("--output", type=str, default="", help="File to append the results to, as a JSON line.")
+    args = parser.parse_args()
+
+    # The first run warms the OS page cache, like any start after the first in a container.
+    run_once()
+    runs: List[Dict[str, float]] = [run_once() for _ in range(args.runs)]
+
+    print(f"{'phase':<24}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    summary: Dict[str, float] = {}
+    for phase, label in (("ready", "process start to ready"), ("import", "imports"), ("init", "bot and application"),
+                         ("warm_up", "background warm-up")):
+        points = percentiles([run[phase] for run in runs], (50, 95))
+        summary[f"{phase}_p50"] = points[50]
+        summary[f"{phase}_p95"] = points[95]
+        print(f"{label:<24}{points[50] * 1000:>12.0f}{points[95] * 1000:>12.0f}")
+
+    if any(run["yt_dlp_at_start"] for run in runs):
+        print("⚠️ yt-dlp was imported before the bot was ready.")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({"time": time.time(), "python": sys.version.split()[0], "runs": args.runs, **summary}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare update-to-reply latency of polling and webhook mode against a local fake Bot API server.
+
+Each update is a `/metrics` command, so the measured latency is the time from the update being
+made available to the bot (queued for `getUpdates`, or POSTed to the webhook) until the bot's
+`sendMessage` reply reaches the fake server. No media is downloaded.
+
+Usage (webhook mode requires `pip install python-telegram-bot[webhooks]`):
+
+    python -m benchmarks.bench_webhook_vs_polling --updates 200 --rate 50
+"""
+import asyncio
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+from typing import Dict, List
+
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder
+
+from benchmarks.fake_bot_api import FakeBotApi, RecordedCall, make_command_update, percentiles
+from telegram_media_downloader_bot.bot import DEFAULT_WEBHOOK_PATH, MediaDownloaderBot
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_mode(mode: str, num_updates: int, rate: float) -> List[float]:
+    """
+    Run the bot in the given mode and return the update-to-reply latency of every update, in seconds.
+    """
+    api = FakeBotApi().start()
+    pushed_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    all_replied = threading.Event()
+
+    def on_call(call: RecordedCall) -> None:
+        if call.method != "sendMessage":
+            return
+        chat_id: int = int(call.params["chat_id"])
+        latencies.append(call.received_at - pushed_at[chat_id])
+        if len(latencies) == num_updates:
+            all_replied.set()
+
+    api.listeners.append(on_call)
+
+    app: Application = (ApplicationBuilder()
+                        .token("123456:benchmark")
+                        .base_url(api.base_url)
+                        .base_file_url(api.base_file_url)
+                        .concurrent_updates(True)
+                        .build())
+    bot = MediaDownloaderBot(token="123456:benchmark", bot_user_id="9999", log_file="")
+    bot.init_handlers(app)
+
+    async with app:
+        await app.start()
+        assert app.updater
+        if mode == "webhook":
+            port: int = _free_port()
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path=DEFAULT_WEBHOOK_PATH,
+                webhook_url=f"http://127.0.0.1:{port}/{DEFAULT_WEBHOOK_PATH}",
+                allowed_updates=Update.ALL_TYPES)
+        else:
+            await app.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=Update.ALL_TYPES)
+
+        def produce() -> None:
+            for update_id in range(1, num_updates + 1):
+                # Each update comes from its own chat, so replies can be matched to updates.
+                pushed_at[update_id] = time.perf_counter()
+                api.push_update(make_command_update(update_id, chat_id=update_id, text="/metrics"))
+                time.sleep(1 / rate)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        await asyncio.get_running_loop().run_in_executor(None, all_replied.wait, 60)
+        producer.join()
+
+        await app.updater.stop()
+        await app.stop()
+
+    bot.close()
+    api.stop()
+    return latencies
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200, help="Number of updates per mode.")
+    parser.add_argument("--rate", type=float, default=50, help="Updates per second.")
+    parser.add_argument("--modes", nargs="+", default=["polling", "webhook"], choices=["polling", "webhook"])
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'updates':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}{'p99 (ms)':>12}{'max (ms)':>12}")
+    for mode in args.modes:
+        latencies: List[float] = asyncio.run(run_mode(mode, args.updates, args.rate))
+        points = percentiles(latencies)
+        print(f"{mode:<10}{len(latencies):>10}{points[50] * 1000:>12.2f}{points[95] * 1000:>12.2f}"
+              f"{points[99] * 1000:>12.2f}{max(latencies) * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Measure how split-mode throughput scales with the number of download worker processes.
+
+A frontend submits jobs to a SQLite job queue through a `JobDispatcher`, and 1, 2, 4, ...
+worker processes run `serve_jobs` against it, with yt-dlp replaced by `StubYoutubeDL` and
+uploads replaced by a fake bot that takes `--upload-latency` seconds per video.
+
+Usage:
+
+    python -m benchmarks.bench_workers --jobs 64 --processes 1 2 4 --concurrency 2
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+from benchmarks.fake_bot_api import percentiles
+from benchmarks.fake_yt_dlp import stub_yt_dlp
+from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.jobs import Job, JobDispatcher, JobResult, SQLiteJobQueue
+from telegram_media_downloader_bot.worker import serve_jobs
+
+
+class FakeMessage(object):
+    def __init__(self, message_id: int):
+        self.message_id: int = message_id
+        self.video = type("Video", (), {"file_id": f"file-id-{os.getpid()}-{message_id}"})()
+
+
+class FakeBot(object):
+    """
+    Pretends to upload videos, taking `latency` seconds per request.
+    """
+
+    def __init__(self, latency: float):
+        self._latency: float = latency
+        self._message_ids = itertools.count(1)
+
+    async def send_video(self, video: Any, chat_id: str, reply_to_message_id: Optional[int] = None) -> FakeMessage:
+        if hasattr(video, "read"):
+            video.read()
+        await asyncio.sleep(self._latency)
+        return FakeMessage(next(self._message_ids))
+
+    async def send_media_group(self, media: List[Any], chat_id: str, reply_to_message_id: Optional[int] = None) -> List[FakeMessage]:
+        await asyncio.sleep(self._latency)
+        return [FakeMessage(next(self._message_ids)) for _ in media]
+
+
+async def _serve(options: Dict[str, Any], stop_file: str, ready: Any) -> None:
+    downloader = MediaDownloaderBot(
+        token="123456:benchmark", log_file="", download_workers=options["concurrency"],
+        scratch_dir=os.path.join(options["scratch_dir"], str(os.getpid())))
+    logging.getLogger("telegram_media_downloader_bot").setLevel(logging.WARNING)
+    job_queue = SQLiteJobQueue(options["queue_path"])
+    stop = asyncio.Event()
+
+    async def watch() -> None:
+        while not os.path.exists(stop_file):
+            await asyncio.sleep(0.05)
+        stop.set()
+
+    watcher = asyncio.ensure_future(watch())
+    ready.put(os.getpid())
+    try:
+        await serve_jobs(downloader, job_queue, FakeBot(options["upload_latency"]), options["concurrency"], stop, poll_timeout=0.1)
+    finally:
+        watcher.cancel()
+        job_queue.close()
+        downloader.close()
+
+
+def run_worker(options: Dict[str, Any], stop_file: str, ready: Any) -> None:
+    with stub_yt_dlp(options["download_latency"], options["size"]):
+        asyncio.run(_serve(options, stop_file, ready))
+
+
+async def submit_jobs(queue_path: str, num_jobs: int) -> List[float]:
+    """
+    Submit `num_jobs` jobs at once and return the latency of each, in seconds.
+    """
+    dispatcher = JobDispatcher(SQLiteJobQueue(queue_path), poll_timeout=0.05)
+
+    async def submit(i: int) -> float:
+        start: float = time.perf_counter()
+        job: Job = Job.create(f"https://www.youtube.com/shorts/bench{i}", "youtube", str(i % 20), str(i), i, dispatcher.consumer)
+        result: JobResult = await dispatcher.submit(job)
+        assert not result.failed, result.error()
+        return time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*[submit(i) for i in range(num_jobs)])
+    finally:
+        dispatcher.close()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=64, help="Jobs per configuration.")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="Numbers of worker processes to compare.")
+    parser.add_argument("--concurrency", type=int, default=2, help="Concurrent jobs per worker process.")
+    parser.add_argument("--download-latency", type=float, default=0.2, help="Seconds per stub download.")
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="Seconds per fake upload.")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Bytes per download.")
+    args = parser.parse_args()
+
+    directory: str = tempfile.mkdtemp(prefix="bench-")
+    context = multiprocessing.get_context("spawn")
+    try:
+        print(f"{'processes':<12}{'jobs/s':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+        for num_processes in args.processes:
+            options: Dict[str, Any] = {
+                "queue_path": os.path.join(directory, f"jobs-{num_processes}.db"),
+                "scratch_dir": os.path.join(directory, "scratch"),
+                "concurrency": args.concurrency,
+                "download_latency": args.download_latency,
+                "upload_latency": args.upload_latency,
+                "size": args.size,
+            }
+            SQLiteJobQueue(options["queue_path"]).close()
+            stop_file: str = os.path.join(directory, f"stop-{num_processes}")
+            ready = context.Queue()
+            workers = [context.Process(target=run_worker, args=(options, stop_file, ready)) for _ in range(num_processes)]
+            for worker in workers:
+                worker.start()
+            # Don't count the start-up of the worker processes.
+            for _ in workers:
+                ready.get()
+
+            start: float = time.perf_counter()
+            latencies: List[float] = asyncio.run(submit_jobs(options["queue_path"], args.jobs))
+            elapsed: float = time.perf_counter() - start
+
+            open(stop_file, "w").close()
+            for worker in workers:
+                worker.join()
+
+            points = percentiles(latencies, (50, 95))
+            print(f"{num_processes:<12}{args.jobs / elapsed:>10.1f}{points[50] * 1000:>12.0f}{points[95] * 1000:>12.0f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
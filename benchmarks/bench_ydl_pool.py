@@ -0,0 +1,123 @@
+"""
+Measure the per-request overhead saved by reusing warm YoutubeDL instances.
+
+Runs `fetch_media` with the real yt-dlp against a local HTTP server that serves a small mp4,
+once with a fresh YoutubeDL instance per request (the previous behavior, `max_uses=1`) and
+once with pooled instances. The media is tiny, so the measured latency is dominated by
+yt-dlp's per-instance setup: loading extractors and opening HTTP sessions.
+
+Usage:
+
+    python -m benchmarks.bench_ydl_pool --requests 50 --workers 1
+"""
+import io
+import shutil
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from benchmarks.fake_bot_api import percentiles
+from telegram_media_downloader_bot.downloader import fetch_media
+from telegram_media_downloader_bot.ydl_pool import YoutubeDLPool
+
+
+class MediaServer(object):
+    """
+    Serves `size` bytes as `video/mp4` at every path.
+    """
+
+    def __init__(self, size: int):
+        body: bytes = b"\0" * size
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send_headers(self) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "video/mp4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+            def do_HEAD(self):
+                self._send_headers()
+
+            def do_GET(self):
+                self._send_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass  # yt-dlp's generic extractor hangs up after sniffing the first bytes.
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/video.mp4"
+
+    def start(self) -> "MediaServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def run(url: str, directory: str, pool: YoutubeDLPool, requests: int, workers: int) -> List[float]:
+    """
+    Fetch `url` `requests` times on `workers` threads and return the latency of each request, in seconds.
+    """
+    def fetch(_: int) -> float:
+        start: float = time.perf_counter()
+        items, _ = fetch_media(url, directory, pool=pool)
+        elapsed: float = time.perf_counter() - start
+        for media in items:
+            media.close()
+        return elapsed
+
+    # yt-dlp isn't quiet in the bot's configuration.
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(fetch, range(requests)))
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50, help="Downloads per configuration.")
+    parser.add_argument("--workers", type=int, default=1, help="Concurrent downloads.")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Bytes per download.")
+    parser.add_argument("--max-uses", type=int, default=50, help="Downloads per pooled instance.")
+    args = parser.parse_args()
+
+    server = MediaServer(args.size).start()
+    directory: str = tempfile.mkdtemp(prefix="bench-")
+    try:
+        print(f"{'configuration':<16}{'p50 (ms)':>12}{'p95 (ms)':>12}{'mean (ms)':>12}{'instances':>12}")
+        for name, max_uses in (("fresh", 1), ("pooled", args.max_uses)):
+            pool = YoutubeDLPool(max_uses=max_uses)
+            latencies: List[float] = run(server.url, directory, pool, args.requests, args.workers)
+            pool.clear()
+
+            points = percentiles(latencies, (50, 95))
+            mean: float = sum(latencies) / len(latencies)
+            print(f"{name:<16}{points[50] * 1000:>12.1f}{points[95] * 1000:>12.1f}{mean * 1000:>12.1f}"
+                  f"{pool.stats()['created']:>12}")
+    finally:
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
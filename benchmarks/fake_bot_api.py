@@ -0,0 +1,237 @@
+"""
+A minimal, local stand-in for the Telegram Bot API, for benchmarks.
+
+It serves just enough of the Bot API for `MediaDownloaderBot` to run against it:
+`getMe`, `getUpdates` (with long polling), `setWebhook`/`deleteWebhook` and the `send*`
+methods, whose calls are recorded together with the time they were received.
+
+Updates are injected with `push_update`. In polling mode they are handed out by
+`getUpdates`; once a webhook has been set they are POSTed to the webhook URL instead.
+"""
+import itertools
+import json
+import threading
+import time
+import urllib.request
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+BOT_USER: Dict[str, Any] = {
+    "id": 9999,
+    "is_bot": True,
+    "first_name": "Benchmark",
+    "username": "benchmark_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+
+
+class RecordedCall(object):
+    def __init__(self, method: str, params: Dict[str, Any], received_at: float):
+        self.method: str = method
+        self.params: Dict[str, Any] = params
+        self.received_at: float = received_at
+
+
+class FakeBotApi(object):
+    """
+    Fake Bot API server listening on localhost.
+
+    :param response_delay: seconds to wait before answering each `send*` call, to simulate upload time.
+    """
+
+    def __init__(self, response_delay: float = 0.0):
+        self._response_delay: float = response_delay
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+        self._lock = threading.Condition()
+        self._pending_updates: List[Dict[str, Any]] = []
+        self._webhook_url: str = ""
+        self._message_ids = itertools.count(1)
+
+        self.calls: List[RecordedCall] = []
+        self.listeners: List[Callable[[RecordedCall], None]] = []
+
+    @property
+    def port(self) -> int:
+        assert self._server
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        """
+        Value for `ApplicationBuilder.base_url`.
+        """
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    def start(self) -> "FakeBotApi":
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api._handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._lock:
+            self._lock.notify_all()
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """
+        Deliver an update to the bot, by webhook if one is set, otherwise via getUpdates.
+        """
+        with self._lock:
+            webhook_url: str = self._webhook_url
+            if not webhook_url:
+                self._pending_updates.append(update)
+                self._lock.notify_all()
+                return
+
+        request = urllib.request.Request(
+            webhook_url, data=json.dumps(update).encode(), headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request).read()
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        received_at: float = time.perf_counter()
+        method: str = request.path.rstrip("/").rsplit("/", 1)[-1]
+        params: Dict[str, Any] = _parse_params(request)
+
+        result: Any = self._dispatch(method, params)
+        call = RecordedCall(method, params, received_at)
+        with self._lock:
+            self.calls.append(call)
+        for listener in self.listeners:
+            listener(call)
+
+        body: bytes = json.dumps({"ok": True, "result": result}).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _dispatch(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return BOT_USER
+
+        if method == "setWebhook":
+            with self._lock:
+                self._webhook_url = params.get("url", "")
+            return True
+
+        if method == "deleteWebhook":
+            with self._lock:
+                self._webhook_url = ""
+            return True
+
+        if method == "getUpdates":
+            return self._get_updates(float(params.get("timeout", 0)), int(params.get("offset", 0) or 0))
+
+        if method.startswith("send") or method.startswith("answer") or method in ("deleteMessage", "leaveChat"):
+            if self._response_delay:
+                time.sleep(self._response_delay)
+            return self._message(method, params)
+
+        return True
+
+    def _get_updates(self, timeout: float, offset: int) -> List[Dict[str, Any]]:
+        deadline: float = time.monotonic() + timeout
+        with self._lock:
+            self._pending_updates = [u for u in self._pending_updates if u["update_id"] >= offset]
+            while not self._pending_updates and not self._webhook_url:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            return list(self._pending_updates)
+
+    def _message(self, method: str, params: Dict[str, Any]) -> Any:
+        if method in ("deleteMessage", "leaveChat") or method.startswith("answer"):
+            return True
+
+        chat_id: int = int(params.get("chat_id", 0))
+        message: Dict[str, Any] = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if method == "sendVideo":
+            file_id: str = f"fake-file-{message['message_id']}"
+            message["video"] = {"file_id": file_id, "file_unique_id": file_id,
+                                "width": 720, "height": 1280, "duration": 10}
+        elif method == "sendMediaGroup":
+            return [message]
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+
+def _parse_params(request: BaseHTTPRequestHandler) -> Dict[str, Any]:
+    length: int = int(request.headers.get("Content-Length", 0) or 0)
+    body: bytes = request.rfile.read(length) if length else b""
+    content_type: str = request.headers.get("Content-Type", "")
+
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params: Dict[str, Any] = {}
+        for part in message.iter_parts():
+            name: Optional[str] = part.get_param("name", header="content-disposition")
+            if name and part.get_filename() is None:
+                params[name] = part.get_content().strip()
+        return params
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+def make_command_update(update_id: int, chat_id: int, text: str, user_id: int = 1) -> Dict[str, Any]:
+    """
+    Create a private-chat message update whose text is a bot command.
+    """
+    command_length: int = len(text.split(" ", 1)[0]) if text.startswith("/") else 0
+    message: Dict[str, Any] = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if command_length:
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": update_id, "message": message}
+
+
+def percentiles(samples: List[float], points: Tuple[float, ...] = (50, 95, 99)) -> Dict[float, float]:
+    """
+    Nearest-rank percentiles of the samples.
+    """
+    ordered: List[float] = sorted(samples)
+    if not ordered:
+        return {point: 0.0 for point in points}
+    return {point: ordered[min(len(ordered) - 1, int(round(point / 100 * (len(ordered) - 1))))] for point in points}
@@ -0,0 +1,87 @@
+"""
+A stub of `yt_dlp.YoutubeDL` with configurable latency and file size, for benchmarks.
+"""
+import io
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+from unittest.mock import patch
+
+from telegram_media_downloader_bot.downloader import ydl_pool
+
+
+class StubYoutubeDL(object):
+    """
+    Pretends to download media: sleeps for `latency` seconds, then streams `file_size` bytes from `urlopen`
+    (or writes them to the output path, if `streamable` is False).
+
+    Configure it through the class attributes before use.
+    """
+    latency: float = 0.5
+    file_size: int = 2 * 1024 * 1024
+    streamable: bool = True
+
+    # Number of downloads started, across all instances.
+    downloads: int = 0
+
+    def __init__(self, params: Dict[str, Any]):
+        self.params: Dict[str, Any] = params
+
+    def __enter__(self) -> "StubYoutubeDL":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True) -> Dict[str, Any]:
+        info: Dict[str, Any] = {"id": url, "webpage_url": url, "ext": "mp4", "filesize": self.file_size}
+        if download:
+            self.process_info(info)
+        return info
+
+    def process_ie_result(self, info: Dict[str, Any], download: bool = True) -> Dict[str, Any]:
+        if download:
+            self.process_info(info)
+            return info
+        return {**info, "url": f"https://media.invalid/{info['id']}", "protocol": "https" if self.streamable else "m3u8"}
+
+    def process_info(self, info: Dict[str, Any]) -> Dict[str, Any]:
+        self.download([info["webpage_url"]])
+        return info
+
+    def urlopen(self, request: Any) -> io.BytesIO:
+        StubYoutubeDL.downloads += 1
+        time.sleep(self.latency)
+        return io.BytesIO(b"\0" * self.file_size)
+
+    def download(self, urls: List[str]) -> int:
+        StubYoutubeDL.downloads += 1
+        time.sleep(self.latency)
+
+        outtmpl = self.params["outtmpl"]
+        path: str = outtmpl["default"] if isinstance(outtmpl, dict) else outtmpl
+        with open(path, "wb") as f:
+            f.write(b"\0" * self.file_size)
+        return 0
+
+
+@contextmanager
+def stub_yt_dlp(latency: float, file_size: int) -> Iterator[None]:
+    """
+    Replace yt-dlp with `StubYoutubeDL` for the duration of the context.
+
+    Only affects downloads run in this process (i.e., with the thread executor).
+    """
+    StubYoutubeDL.latency = latency
+    StubYoutubeDL.file_size = file_size
+    StubYoutubeDL.downloads = 0
+    # Don't hand out pooled instances of the real YoutubeDL (or keep stub instances afterwards).
+    ydl_pool.clear()
+    try:
+        with patch("yt_dlp.YoutubeDL", StubYoutubeDL):
+            yield
+    finally:
+        ydl_pool.clear()
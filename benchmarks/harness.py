@@ -0,0 +1,237 @@
+"""
+End-to-end benchmark harness for `MediaDownloaderBot`.
+
+Replays a synthetic stream of link messages through the bot's real handlers (via the
+`Application` update queue), with yt-dlp replaced by `StubYoutubeDL` and Telegram replaced
+by `FakeBotApi`. Reports throughput, update-to-reply latency percentiles, peak memory and
+peak temporary disk usage.
+
+Usage:
+
+    python -m benchmarks.harness --updates 500 --unique-media 100 --chats 20 --rate 100
+"""
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from typing import Any, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder
+
+from benchmarks.fake_bot_api import FakeBotApi, RecordedCall, percentiles
+from benchmarks.fake_yt_dlp import StubYoutubeDL, stub_yt_dlp
+from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.buffer import DEFAULT_SPOOL_THRESHOLD
+
+TOKEN: str = "123456:benchmark"
+
+# Bot API methods that count as the reply to a link message.
+REPLY_METHODS = ("sendVideo", "sendMessage", "sendMediaGroup")
+
+
+def make_link_update(update_id: int, chat_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"Group {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        },
+    }
+
+
+def _replied_message_id(params: Dict[str, Any]) -> Optional[int]:
+    reply_parameters = params.get("reply_parameters")
+    if isinstance(reply_parameters, str):
+        reply_parameters = json.loads(reply_parameters)
+    if isinstance(reply_parameters, dict) and "message_id" in reply_parameters:
+        return int(reply_parameters["message_id"])
+    if "reply_to_message_id" in params:
+        return int(params["reply_to_message_id"])
+    return None
+
+
+class DiskUsageSampler(object):
+    """
+    Samples the total size of the files under a directory in a background thread and keeps the peak.
+    """
+
+    def __init__(self, directory: str, interval: float = 0.01):
+        self._directory: str = directory
+        self._interval: float = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.peak_bytes: int = 0
+
+    def __enter__(self) -> "DiskUsageSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            total: int = 0
+            for root, _, files in os.walk(self._directory):
+                for name in files:
+                    try:
+                        total += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass  # Removed while walking.
+            self.peak_bytes = max(self.peak_bytes, total)
+            self._stop.wait(self._interval)
+
+
+async def run_benchmark(args: Namespace, bot_kwargs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Run one benchmark and return its results.
+
+    :param args: the benchmark configuration (see `build_parser`).
+    :param bot_kwargs: extra keyword arguments for `MediaDownloaderBot`.
+    """
+    api = FakeBotApi(response_delay=args.upload_delay).start()
+    pushed_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    all_replied = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def on_call(call: RecordedCall) -> None:
+        if call.method not in REPLY_METHODS:
+            return
+        message_id: Optional[int] = _replied_message_id(call.params)
+        if message_id is None or message_id not in pushed_at:
+            return
+        latencies.append(call.received_at - pushed_at[message_id])
+        if len(latencies) == args.updates:
+            loop.call_soon_threadsafe(all_replied.set)
+
+    api.listeners.append(on_call)
+
+    app: Application = (ApplicationBuilder()
+                        .token(TOKEN)
+                        .base_url(api.base_url)
+                        .base_file_url(api.base_file_url)
+                        .concurrent_updates(True)
+                        .build())
+    bot = MediaDownloaderBot(
+        token=TOKEN,
+        bot_user_id="9999",
+        log_file="",
+        download_workers=args.workers,
+        max_queue_depth=args.queue_depth,
+        spool_threshold=args.spool_threshold,
+        scratch_dir=os.getcwd(),
+        scratch_quota=0,
+        **(bot_kwargs or {}))
+    bot.logger.setLevel(logging.WARNING)
+    bot.init_handlers(app)
+
+    tracemalloc.start()
+    with DiskUsageSampler(os.getcwd()) as disk:
+        async with app:
+            await app.start()
+
+            start: float = time.perf_counter()
+            for update_id in range(1, args.updates + 1):
+                media: int = update_id % args.unique_media
+                update = Update.de_json(make_link_update(
+                    update_id,
+                    chat_id=-(update_id % args.chats) - 1,
+                    user_id=update_id % (args.chats * 5) + 1,
+                    text=f"https://www.instagram.com/reel/BENCH{media:06d}/?igsh=share{update_id}"), app.bot)
+                pushed_at[update_id] = time.perf_counter()
+                await app.update_queue.put(update)
+                if args.rate > 0:
+                    await asyncio.sleep(1 / args.rate)
+
+            try:
+                await asyncio.wait_for(all_replied.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            elapsed: float = time.perf_counter() - start
+
+            await app.stop()
+
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bot.close()
+    api.stop()
+
+    points = percentiles(latencies, (50, 95, 99))
+    return {
+        "updates": args.updates,
+        "replies": len(latencies),
+        "downloads": StubYoutubeDL.downloads,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": points[50],
+        "p95": points[95],
+        "p99": points[99],
+        "peak_traced_memory": peak_traced,
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_disk": disk.peak_bytes,
+    }
+
+
+def build_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Replay synthetic link messages through MediaDownloaderBot.")
+    parser.add_argument("--updates", type=int, default=300, help="Number of link messages.")
+    parser.add_argument("--unique-media", type=int, default=100, help="Number of distinct videos linked.")
+    parser.add_argument("--chats", type=int, default=10, help="Number of group chats the messages come from.")
+    parser.add_argument("--rate", type=float, default=100, help="Messages per second (0 = all at once).")
+    parser.add_argument("--download-latency", type=float, default=0.3, help="Seconds per stub download.")
+    parser.add_argument("--file-size", type=int, default=2 * 1024 * 1024, help="Bytes per stub download.")
+    parser.add_argument("--upload-delay", type=float, default=0.05, help="Seconds the fake Bot API takes per call.")
+    parser.add_argument("--spool-threshold", type=int, default=DEFAULT_SPOOL_THRESHOLD,
+                        help="Bytes of each download kept in memory before spilling to disk.")
+    parser.add_argument("--workers", type=int, default=4, help="Download workers.")
+    parser.add_argument("--queue-depth", type=int, default=1000, help="Maximum download queue depth.")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for all replies.")
+    return parser
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    mb: float = 1024 * 1024
+    return "\n".join([
+        f"replies:          {results['replies']}/{results['updates']} ({results['downloads']} downloads)",
+        f"throughput:       {results['throughput']:.1f} replies/s",
+        f"latency p50:      {results['p50'] * 1000:.1f} ms",
+        f"latency p95:      {results['p95'] * 1000:.1f} ms",
+        f"latency p99:      {results['p99'] * 1000:.1f} ms",
+        f"peak traced heap: {results['peak_traced_memory'] / mb:.1f} MB",
+        f"max RSS:          {results['max_rss'] / mb:.1f} MB",
+        f"peak temp disk:   {results['peak_disk'] / mb:.1f} MB",
+    ])
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+
+    # Downloads are written relative to the working directory, so run in a scratch directory.
+    cwd: str = os.getcwd()
+    workdir: str = tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(os.path.join(workdir, "video"))
+    os.chdir(workdir)
+    try:
+        with stub_yt_dlp(args.download_latency, args.file_size):
+            results = asyncio.run(run_benchmark(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_results(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,27 @@
 import os
 import logging
+from importlib.util import find_spec
 from argparse import ArgumentParser
 from typing import List
-from requests import get
 
 from dotenv import load_dotenv
 
 from telegram import Update
 from telegram.ext import ApplicationBuilder, Application
 
-from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.bot import DEFAULT_HTTP_PORT, DEFAULT_INLINE_ANSWER_TIMEOUT, DEFAULT_SHUTDOWN_TIMEOUT, DEFAULT_WEBHOOK_PATH, SERVING_MODES, MediaDownloaderBot
+from telegram_media_downloader_bot.buffer import DEFAULT_SPOOL_THRESHOLD
+from telegram_media_downloader_bot.cache import DEFAULT_FILE_ID_CACHE_SIZE, DEFAULT_FILE_ID_CACHE_TTL, DEFAULT_METADATA_CACHE_SIZE, DEFAULT_METADATA_CACHE_TTL
+from telegram_media_downloader_bot.downloader import DEFAULT_DOWNLOAD_WORKERS, DEFAULT_MAX_UPLOAD_SIZE, EXECUTOR_TYPES
+from telegram_media_downloader_bot.jobs import DEFAULT_JOB_TIMEOUT, JobQueue, open_job_queue
+from telegram_media_downloader_bot.logs import DEFAULT_LOG_BACKUP_COUNT, DEFAULT_LOG_MAX_BYTES
+from telegram_media_downloader_bot.parallel import DEFAULT_CONNECTIONS_PER_DOWNLOAD, DEFAULT_MAX_CONNECTIONS
+from telegram_media_downloader_bot.postprocess import DEFAULT_POSTPROCESS_HEADROOM, DEFAULT_POSTPROCESS_TIMEOUT, DEFAULT_POSTPROCESS_WORKERS
+from telegram_media_downloader_bot.ratelimit import DEFAULT_CHAT_RATE, DEFAULT_OVERALL_RATE, TelegramRateLimiter
+from telegram_media_downloader_bot.resilience import DEFAULT_BREAKER_COOLDOWN, DEFAULT_DOWNLOAD_ATTEMPTS
+from telegram_media_downloader_bot.scheduler import DEFAULT_MAX_QUEUE_DEPTH
+from telegram_media_downloader_bot.scratch import DEFAULT_ORPHAN_TTL, DEFAULT_SCRATCH_DIR, DEFAULT_SCRATCH_QUOTA
+from telegram_media_downloader_bot.ydl_pool import DEFAULT_YDL_MAX_USES
 
 load_dotenv()
 
@@ -20,7 +32,44 @@ parser.add_argument("-c", "--chat-ids", type = str, nargs = "*", default=[], hel
 parser.add_argument("-a", "--admin-user-id", type = str, default = "", help = "Telegram user ID of the admin. To get your own Telegram user ID, send a message to @userinfobot.")
 parser.add_argument("-b", "--bot-user-id", type = str, default = "", help = "Telegram user ID of the bot. Accessible by viewing the bot's page within Telegram.")
 parser.add_argument("-l", "--log-file", type = str, default = "telegram_bot.log", help = "Path for log file. If the empty string is specified, then logs will only be written to stdout.")
-parser.add_argument("-i", "--ip", type = str, help = "Public IPv4.")
+parser.add_argument("--log-max-bytes", type = int, default = DEFAULT_LOG_MAX_BYTES, help = "Size (in bytes) at which the log file is rotated. 0 disables rotation. You may also specify this via the `LOG_MAX_BYTES` environment variable.")
+parser.add_argument("--log-backup-count", type = int, default = DEFAULT_LOG_BACKUP_COUNT, help = "Number of rotated log files to keep. You may also specify this via the `LOG_BACKUP_COUNT` environment variable.")
+parser.add_argument("--log-update-sample-rate", type = float, default = 0.0, help = "Fraction (between 0 and 1) of incoming updates that are logged in full at the debug level. 0 disables these dumps. You may also specify this via the `LOG_UPDATE_SAMPLE_RATE` environment variable.")
+parser.add_argument("-i", "--ip", type = str, default = "", help = "Public IPv4 of this host, used for the default webhook URL. In webhook mode, either this or `--webhook-url` is required. You may also specify this via the `PUBLIC_IPV4` environment variable.")
+parser.add_argument("-w", "--download-workers", type = int, default = DEFAULT_DOWNLOAD_WORKERS, help = "Maximum number of downloads that may run concurrently. You may also specify this via the `DOWNLOAD_WORKERS` environment variable.")
+parser.add_argument("--download-executor", type = str, choices = EXECUTOR_TYPES, default = "thread", help = "Whether downloads run in a thread pool or a process pool. You may also specify this via the `DOWNLOAD_EXECUTOR` environment variable.")
+parser.add_argument("--ydl-max-uses", type = int, default = DEFAULT_YDL_MAX_USES, help = "Number of downloads for which a warm yt-dlp instance is reused before it is replaced. Instances are also replaced after any failed download. 1 disables reuse. You may also specify this via the `YDL_MAX_USES` environment variable.")
+parser.add_argument("--download-connections", type = int, default = DEFAULT_CONNECTIONS_PER_DOWNLOAD, help = "Maximum number of connections over which each video is downloaded in parallel (byte ranges of single files, fragments of HLS/DASH streams). 1 disables parallel downloads. You may also specify this via the `DOWNLOAD_CONNECTIONS` environment variable.")
+parser.add_argument("--max-download-connections", type = int, default = DEFAULT_MAX_CONNECTIONS, help = "Maximum number of connections that all downloads open at the same time. You may also specify this via the `MAX_DOWNLOAD_CONNECTIONS` environment variable.")
+parser.add_argument("--postprocess-workers", type = int, default = DEFAULT_POSTPROCESS_WORKERS, help = "Maximum number of ffmpeg processes that remux or re-encode downloaded videos at the same time. 0 disables post-processing, as does a missing ffmpeg. You may also specify this via the `POSTPROCESS_WORKERS` environment variable.")
+parser.add_argument("--postprocess-headroom", type = float, default = DEFAULT_POSTPROCESS_HEADROOM, help = "Videos up to this multiple of the maximum upload size are downloaded and re-encoded to fit. You may also specify this via the `POSTPROCESS_HEADROOM` environment variable.")
+parser.add_argument("--postprocess-timeout", type = float, default = DEFAULT_POSTPROCESS_TIMEOUT, help = "Seconds after which an ffmpeg process is killed. You may also specify this via the `POSTPROCESS_TIMEOUT` environment variable.")
+parser.add_argument("--file-id-cache-size", type = int, default = DEFAULT_FILE_ID_CACHE_SIZE, help = "Maximum number of uploaded videos whose Telegram file IDs are cached so that repeat links can be answered without re-downloading. You may also specify this via the `FILE_ID_CACHE_SIZE` environment variable.")
+parser.add_argument("--file-id-cache-ttl", type = float, default = DEFAULT_FILE_ID_CACHE_TTL, help = "Number of seconds for which a cached Telegram file ID is reused. You may also specify this via the `FILE_ID_CACHE_TTL` environment variable.")
+parser.add_argument("--metadata-cache-size", type = int, default = DEFAULT_METADATA_CACHE_SIZE, help = "Maximum number of links whose probed metadata (or the reason they were rejected, e.g., because the video is too large) is cached. You may also specify this via the `METADATA_CACHE_SIZE` environment variable.")
+parser.add_argument("--metadata-cache-ttl", type = float, default = DEFAULT_METADATA_CACHE_TTL, help = "Number of seconds for which probed metadata is reused. You may also specify this via the `METADATA_CACHE_TTL` environment variable.")
+parser.add_argument("--state-db", type = str, default = "", help = "Path of a SQLite database in which cached file IDs, authenticated chats, user chats and counters are persisted across restarts. If unspecified, state is kept in memory only. You may also specify this via the `STATE_DB` environment variable.")
+parser.add_argument("-q", "--max-queue-depth", type = int, default = DEFAULT_MAX_QUEUE_DEPTH, help = "Maximum number of downloads that may be waiting to start. Further requests are rejected with a 'busy' reply. You may also specify this via the `MAX_QUEUE_DEPTH` environment variable.")
+parser.add_argument("--max-upload-size", type = int, default = DEFAULT_MAX_UPLOAD_SIZE, help = "Maximum size (in bytes) of media that will be sent. The best mp4 format within this size is selected, and media for which no format fits is rejected before it is downloaded. The Bot API limits uploads to 50 MB; a local Bot API server allows up to 2000 MB. You may also specify this via the `MAX_UPLOAD_SIZE` environment variable.")
+parser.add_argument("--inline-answer-timeout", type = float, default = DEFAULT_INLINE_ANSWER_TIMEOUT, help = "Seconds an inline query waits for its video before it is answered with a placeholder while the download continues in the background. You may also specify this via the `INLINE_ANSWER_TIMEOUT` environment variable.")
+parser.add_argument("--spool-threshold", type = int, default = DEFAULT_SPOOL_THRESHOLD, help = "Downloaded media up to this size (in bytes) is kept in memory and uploaded straight from it; larger media is written to disk. You may also specify this via the `SPOOL_THRESHOLD` environment variable.")
+parser.add_argument("--scratch-dir", type = str, default = DEFAULT_SCRATCH_DIR, help = "Directory for downloads that are too large to keep in memory, e.g., on a tmpfs. You may also specify this via the `SCRATCH_DIR` environment variable.")
+parser.add_argument("--scratch-quota", type = int, default = DEFAULT_SCRATCH_QUOTA, help = "Maximum number of bytes that downloads may use in the scratch directory. Each download reserves the maximum upload size before it starts and waits if the quota is exhausted. 0 means unlimited. You may also specify this via the `SCRATCH_QUOTA` environment variable.")
+parser.add_argument("--scratch-orphan-ttl", type = float, default = DEFAULT_ORPHAN_TTL, help = "Files in the scratch directory older than this many seconds that don't belong to an active download are deleted by a periodic sweeper. You may also specify this via the `SCRATCH_ORPHAN_TTL` environment variable.")
+parser.add_argument("--download-attempts", type = int, default = DEFAULT_DOWNLOAD_ATTEMPTS, help = "Number of times a download is attempted when it fails with a transient error (e.g., rate limiting or a timeout), with jittered exponential backoff in between. 1 disables retries. You may also specify this via the `DOWNLOAD_ATTEMPTS` environment variable.")
+parser.add_argument("--circuit-breaker-cooldown", type = float, default = DEFAULT_BREAKER_COOLDOWN, help = "When most recent downloads from a platform have failed, downloads from that platform are rejected immediately for this many seconds. You may also specify this via the `CIRCUIT_BREAKER_COOLDOWN` environment variable.")
+parser.add_argument("--api-rate-limit", type = float, default = DEFAULT_OVERALL_RATE, help = "Maximum number of outbound Telegram Bot API requests per second across all chats. Bursts beyond this are queued, media replies first. 0 disables the limit. You may also specify this via the `API_RATE_LIMIT` environment variable.")
+parser.add_argument("--chat-rate-limit", type = float, default = DEFAULT_CHAT_RATE, help = "Maximum number of outbound Telegram Bot API requests per second to a single private chat (groups are limited to 20 per minute). 0 disables the per-chat limits. You may also specify this via the `CHAT_RATE_LIMIT` environment variable.")
+parser.add_argument("--job-queue", type = str, default = "", help = "Run in split mode: instead of downloading media itself, the bot puts download jobs on this queue, and download workers (`python -m telegram_media_downloader_bot.worker`) download and send the media. Either `sqlite:///<path>` for workers on this host or `redis://<host>:<port>/<db>` (requires `pip install redis`). You may also specify this via the `JOB_QUEUE` environment variable.")
+parser.add_argument("--job-timeout", type = float, default = DEFAULT_JOB_TIMEOUT, help = "In split mode, seconds to wait for a download worker to complete a job before replying with an error. You may also specify this via the `JOB_TIMEOUT` environment variable.")
+parser.add_argument("--shutdown-timeout", type = float, default = DEFAULT_SHUTDOWN_TIMEOUT, help = "On /exit, SIGINT or SIGTERM, the bot stops receiving updates and waits up to this many seconds for downloads in progress to be sent before cancelling them. You may also specify this via the `SHUTDOWN_TIMEOUT` environment variable.")
+parser.add_argument("--metrics-port", type = int, default = 0, help = "If specified, serve Prometheus metrics (per-stage latency histograms, bytes transferred, cache hits and errors) at http://127.0.0.1:<port>/metrics. You may also specify this via the `METRICS_PORT` environment variable.")
+parser.add_argument("-m", "--mode", type = str, choices = SERVING_MODES, default = "polling", help = "Whether to receive updates by long polling or via a webhook. Webhook mode requires `python-telegram-bot[webhooks]`; if it is not installed, the bot falls back to polling. You may also specify this via the `BOT_MODE` environment variable.")
+parser.add_argument("--port", type = int, default = DEFAULT_HTTP_PORT, help = "Port on which the webhook server listens. You may also specify this via the `HTTP_PORT` environment variable.")
+parser.add_argument("--webhook-url", type = str, default = "", help = f"Public URL at which Telegram delivers updates in webhook mode. Defaults to `https://<public IPv4>:<port>/{DEFAULT_WEBHOOK_PATH}`. Useful when running behind a reverse proxy. You may also specify this via the `WEBHOOK_URL` environment variable.")
+parser.add_argument("--webhook-secret", type = str, default = "", help = "Secret token that Telegram sends with every webhook request, so that requests from anyone else are rejected. You may also specify this via the `WEBHOOK_SECRET` environment variable.")
+parser.add_argument("--webhook-cert", type = str, default = "", help = "Path of the TLS certificate for the webhook server (e.g., a self-signed certificate). You may also specify this via the `WEBHOOK_CERT` environment variable.")
+parser.add_argument("--webhook-key", type = str, default = "", help = "Path of the TLS private key for the webhook server. You may also specify this via the `WEBHOOK_KEY` environment variable.")
 
 args = parser.parse_args()
 
@@ -33,16 +82,58 @@ bot_password: str = os.environ.get("BOT_PASSWORD", args.password)
 preauthenticated_chat_ids: str | List[str] = os.environ.get("CHAT_IDS", args.chat_ids)
 bot_user_id: str = os.environ.get("BOT_USER_ID", args.bot_user_id)
 public_ipv4:str = os.environ.get("PUBLIC_IPV4", args.ip)
+download_workers: int = int(os.environ.get("DOWNLOAD_WORKERS", args.download_workers))
+download_executor: str = os.environ.get("DOWNLOAD_EXECUTOR", args.download_executor)
+ydl_max_uses: int = int(os.environ.get("YDL_MAX_USES", args.ydl_max_uses))
+download_connections: int = int(os.environ.get("DOWNLOAD_CONNECTIONS", args.download_connections))
+max_download_connections: int = int(os.environ.get("MAX_DOWNLOAD_CONNECTIONS", args.max_download_connections))
+postprocess_workers: int = int(os.environ.get("POSTPROCESS_WORKERS", args.postprocess_workers))
+postprocess_headroom: float = float(os.environ.get("POSTPROCESS_HEADROOM", args.postprocess_headroom))
+postprocess_timeout: float = float(os.environ.get("POSTPROCESS_TIMEOUT", args.postprocess_timeout))
+file_id_cache_size: int = int(os.environ.get("FILE_ID_CACHE_SIZE", args.file_id_cache_size))
+file_id_cache_ttl: float = float(os.environ.get("FILE_ID_CACHE_TTL", args.file_id_cache_ttl))
+metadata_cache_size: int = int(os.environ.get("METADATA_CACHE_SIZE", args.metadata_cache_size))
+metadata_cache_ttl: float = float(os.environ.get("METADATA_CACHE_TTL", args.metadata_cache_ttl))
+state_db: str = os.environ.get("STATE_DB", args.state_db)
+max_queue_depth: int = int(os.environ.get("MAX_QUEUE_DEPTH", args.max_queue_depth))
+max_upload_size: int = int(os.environ.get("MAX_UPLOAD_SIZE", args.max_upload_size))
+inline_answer_timeout: float = float(os.environ.get("INLINE_ANSWER_TIMEOUT", args.inline_answer_timeout))
+spool_threshold: int = int(os.environ.get("SPOOL_THRESHOLD", args.spool_threshold))
+scratch_dir: str = os.environ.get("SCRATCH_DIR", args.scratch_dir)
+scratch_quota: int = int(os.environ.get("SCRATCH_QUOTA", args.scratch_quota))
+scratch_orphan_ttl: float = float(os.environ.get("SCRATCH_ORPHAN_TTL", args.scratch_orphan_ttl))
+download_attempts: int = int(os.environ.get("DOWNLOAD_ATTEMPTS", args.download_attempts))
+circuit_breaker_cooldown: float = float(os.environ.get("CIRCUIT_BREAKER_COOLDOWN", args.circuit_breaker_cooldown))
+api_rate_limit: float = float(os.environ.get("API_RATE_LIMIT", args.api_rate_limit))
+chat_rate_limit: float = float(os.environ.get("CHAT_RATE_LIMIT", args.chat_rate_limit))
+job_queue_url: str = os.environ.get("JOB_QUEUE", args.job_queue)
+job_timeout: float = float(os.environ.get("JOB_TIMEOUT", args.job_timeout))
+shutdown_timeout: float = float(os.environ.get("SHUTDOWN_TIMEOUT", args.shutdown_timeout))
+metrics_port: int = int(os.environ.get("METRICS_PORT", args.metrics_port))
+mode: str = os.environ.get("BOT_MODE", args.mode)
+http_port: int = int(os.environ.get("HTTP_PORT", args.port))
+webhook_url: str = os.environ.get("WEBHOOK_URL", args.webhook_url)
+webhook_secret: str = os.environ.get("WEBHOOK_SECRET", args.webhook_secret)
+webhook_cert: str = os.environ.get("WEBHOOK_CERT", args.webhook_cert)
+webhook_key: str = os.environ.get("WEBHOOK_KEY", args.webhook_key)
 
 log_file: str = args.log_file
+log_max_bytes: int = int(os.environ.get("LOG_MAX_BYTES", args.log_max_bytes))
+log_backup_count: int = int(os.environ.get("LOG_BACKUP_COUNT", args.log_backup_count))
+log_update_sample_rate: float = float(os.environ.get("LOG_UPDATE_SAMPLE_RATE", args.log_update_sample_rate))
 
 if not bot_user_id:
     raise ValueError("No Telegram bot user ID specified")
 
-if not public_ipv4:
-    public_ipv4 = get('https://api.ipify.org').content.decode('utf8')
+if mode == "webhook" and find_spec("tornado") is None:
+    print("⚠️ Webhook mode requires `pip install python-telegram-bot[webhooks]`. Falling back to polling.")
+    mode = "polling"
 
-app: Application = ApplicationBuilder().token(token).build()
+# The bot doesn't look up its public IP address, so that it starts without any network requests.
+if mode == "webhook" and not webhook_url and not public_ipv4:
+    raise ValueError("Webhook mode requires a public IPv4 address (`PUBLIC_IPV4`) or a webhook URL (`WEBHOOK_URL`)")
+
+job_queue: JobQueue | None = open_job_queue(job_queue_url) if job_queue_url else None
 
 if preauthenticated_chat_ids is not None and isinstance(preauthenticated_chat_ids, str) and preauthenticated_chat_ids != "":
     preauthenticated_chat_ids = preauthenticated_chat_ids.split(",")
@@ -56,10 +147,61 @@ bot: MediaDownloaderBot = MediaDownloaderBot(
     admin_user_id=admin_user_id,
     bot_user_id=bot_user_id,
     public_ipv4=public_ipv4,
+    http_port=http_port,
     log_file=log_file,
+    log_max_bytes=log_max_bytes,
+    log_backup_count=log_backup_count,
+    log_update_sample_rate=log_update_sample_rate,
+    download_workers=download_workers,
+    download_executor=download_executor,
+    ydl_max_uses=ydl_max_uses,
+    download_connections=download_connections,
+    max_download_connections=max_download_connections,
+    postprocess_workers=postprocess_workers,
+    postprocess_headroom=postprocess_headroom,
+    postprocess_timeout=postprocess_timeout,
+    file_id_cache_size=file_id_cache_size,
+    file_id_cache_ttl=file_id_cache_ttl,
+    metadata_cache_size=metadata_cache_size,
+    metadata_cache_ttl=metadata_cache_ttl,
+    state_db=state_db,
+    max_queue_depth=max_queue_depth,
+    max_upload_size=max_upload_size,
+    inline_answer_timeout=inline_answer_timeout,
+    spool_threshold=spool_threshold,
+    scratch_dir=scratch_dir,
+    scratch_quota=scratch_quota,
+    scratch_orphan_ttl=scratch_orphan_ttl,
+    download_attempts=download_attempts,
+    circuit_breaker_cooldown=circuit_breaker_cooldown,
+    job_queue=job_queue,
+    job_timeout=job_timeout,
+    shutdown_timeout=shutdown_timeout,
+    metrics_port=metrics_port,
 )
 
+# The bot drains in-flight downloads before stopping, so it handles the stop signals itself. It also
+# imports yt-dlp in the background once it is running, rather than delaying start-up.
+app: Application = ApplicationBuilder().token(token).rate_limiter(
+    TelegramRateLimiter(overall_rate=api_rate_limit, chat_rate=chat_rate_limit)).post_init(bot.post_init).build()
+
 bot.init_handlers(app)
 
-print("🤖 Bot is running...")
-app.run_polling(allowed_updates=Update.ALL_TYPES)
+if mode == "webhook":
+    print(f"🤖 Bot is running (webhook on port {http_port})...")
+    app.run_webhook(
+        listen="0.0.0.0",
+        port=http_port,
+        url_path=DEFAULT_WEBHOOK_PATH,
+        webhook_url=webhook_url or bot.webhook_url(DEFAULT_WEBHOOK_PATH),
+        cert=webhook_cert or None,
+        key=webhook_key or None,
+        secret_token=webhook_secret or None,
+        allowed_updates=Update.ALL_TYPES,
+        stop_signals=None,
+    )
+else:
+    print("🤖 Bot is running...")
+    app.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
+
+bot.close()
@@ -1,15 +1,37 @@
 import asyncio
-import os
+import copy
+import functools
 import logging
+import signal
+from contextlib import AsyncExitStack, ExitStack, contextmanager
 from datetime import datetime, timedelta
-import traceback
-from typing import List, Optional, Dict, Any
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar, Union, cast
 import uuid
-import yt_dlp
-from telegram import InlineQueryResultArticle, InlineQueryResultCachedVideo, InlineQueryResultsButton, InputTextMessageContent, Update
+import weakref
+from concurrent.futures import Executor, Future
+from telegram import Bot, InlineQueryResultArticle, InlineQueryResultCachedVideo, InlineQueryResultsButton, InputMediaVideo, InputTextMessageContent, Message, Update
 from telegram.ext import MessageHandler, CommandHandler, ContextTypes, filters, Application, InlineQueryHandler
 from telegram import Update
 import threading
+import time
+
+from telegram_media_downloader_bot.buffer import DEFAULT_SPOOL_THRESHOLD, MediaBuffer
+from telegram_media_downloader_bot.cache import DEFAULT_FILE_ID_CACHE_SIZE, DEFAULT_FILE_ID_CACHE_TTL, DEFAULT_METADATA_CACHE_SIZE, DEFAULT_METADATA_CACHE_TTL, TTLCache
+from telegram_media_downloader_bot.coalescer import RequestCoalescer
+from telegram_media_downloader_bot.downloader import DEFAULT_DOWNLOAD_WORKERS, DEFAULT_MAX_UPLOAD_SIZE, MAX_MEDIA_GROUP_SIZE, DownloadResult, MediaInfo, create_download_executor, fetch_media, probe_media, warm_up
+from telegram_media_downloader_bot.errors import CircuitOpenError, JobFailedError, MediaTooLargeError, QueueFullError, RestrictedMediaError, ShuttingDownError
+from telegram_media_downloader_bot.jobs import DEFAULT_JOB_TIMEOUT, Job, JobDispatcher, JobQueue, JobResult
+from telegram_media_downloader_bot.logs import DEFAULT_LOG_BACKUP_COUNT, DEFAULT_LOG_MAX_BYTES, PACKAGE_LOGGER, UPDATES_LOGGER, LoggingPipeline
+from telegram_media_downloader_bot.metrics import Metrics, MetricsServer
+from telegram_media_downloader_bot.parallel import DEFAULT_CONNECTIONS_PER_DOWNLOAD, DEFAULT_MAX_CONNECTIONS
+from telegram_media_downloader_bot.postprocess import DEFAULT_POSTPROCESS_HEADROOM, DEFAULT_POSTPROCESS_TIMEOUT, DEFAULT_POSTPROCESS_WORKERS, PostProcessor, PostprocessJob, PostprocessResult, find_ffmpeg, plan_postprocess
+from telegram_media_downloader_bot.ratelimit import PRIORITY_LOW, TelegramRateLimiter
+from telegram_media_downloader_bot.resilience import DEFAULT_BREAKER_COOLDOWN, DEFAULT_DOWNLOAD_ATTEMPTS, HALF_OPEN, OPEN, RESTRICTED, Resilience, classify_error
+from telegram_media_downloader_bot.scheduler import DEFAULT_MAX_QUEUE_DEPTH, FairScheduler
+from telegram_media_downloader_bot.scratch import DEFAULT_ORPHAN_TTL, DEFAULT_SCRATCH_DIR, DEFAULT_SCRATCH_QUOTA, Reservation, ScratchSpace
+from telegram_media_downloader_bot.store import StateStore
+from telegram_media_downloader_bot.urls import MediaUrl, classify_url, find_media_urls
+from telegram_media_downloader_bot.ydl_pool import DEFAULT_YDL_MAX_USES
 
 LOGGER_FORMAT: str = '%(asctime)s | %(levelname)s | %(message)s | %(name)s | %(funcName)s'
 
@@ -19,17 +41,42 @@ download - /download <url>: download the specified media.
 metrics - /metrics: return the total number of downloads.
 """
 
+T = TypeVar("T")
+
+# The videos downloaded from one URL. There is more than one for, e.g., an Instagram carousel.
+MediaItems = Tuple[MediaBuffer, ...]
+
+# A video to send: either a Telegram file ID or downloaded media.
+Video = Union[str, MediaBuffer]
+
 DEFAULT_AUTH_TIMEOUT: int = 15  # seconds
 
+DEFAULT_HTTP_PORT: int = 8081
 
-class MediaDownloaderBot(object):
-    valid_url_prefixes: List[str] = [
-        "youtube.com/shorts/",
-        "youtu.be/shorts/",
-        'instagram.com/reel/',
-        'instagram.com/p/'
-    ]
+# How long an inline query waits for its video before being answered with a placeholder.
+# Telegram discards answers that arrive more than ~10 seconds after the query.
+DEFAULT_INLINE_ANSWER_TIMEOUT: float = 3.0  # seconds
+
+# Prefix of the keys of file IDs that are cached by content (see `MediaDownloaderBot._content_key`).
+CONTENT_KEY_PREFIX: str = "sha256:"
+
+# Probed sizes are often yt-dlp's estimates (`filesize_approx`), so downloads reserve this much more scratch space.
+RESERVATION_SIZE_MARGIN: float = 1.25
+
+# How long a graceful shutdown waits for in-flight downloads (and their replies) before cancelling them.
+DEFAULT_SHUTDOWN_TIMEOUT: float = 30.0  # seconds
+
+# How long cancelled requests get to tell their users to try again.
+_SHUTDOWN_GRACE_PERIOD: float = 5.0  # seconds
+
+# Path at which the webhook server receives updates from Telegram.
+DEFAULT_WEBHOOK_PATH: str = "webhook"
+
+# How the bot receives updates from Telegram.
+SERVING_MODES: List[str] = ["polling", "webhook"]
 
+
+class MediaDownloaderBot(object):
     def __init__(
         self,
         token: str = "",
@@ -38,10 +85,39 @@ class MediaDownloaderBot(object):
         admin_user_id: str = "",
         bot_user_id: str = "",
         public_ipv4: str = "",
-        http_port: int = 8081,
+        http_port: int = DEFAULT_HTTP_PORT,
         log_file: str = "telegram_bot.log",
         auth_timeout: int = DEFAULT_AUTH_TIMEOUT,
-        logger_format: str = LOGGER_FORMAT
+        logger_format: str = LOGGER_FORMAT,
+        log_max_bytes: int = DEFAULT_LOG_MAX_BYTES,
+        log_backup_count: int = DEFAULT_LOG_BACKUP_COUNT,
+        log_update_sample_rate: float = 0.0,
+        download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        download_executor: str = "thread",
+        ydl_max_uses: int = DEFAULT_YDL_MAX_USES,
+        download_connections: int = DEFAULT_CONNECTIONS_PER_DOWNLOAD,
+        max_download_connections: int = DEFAULT_MAX_CONNECTIONS,
+        postprocess_workers: int = DEFAULT_POSTPROCESS_WORKERS,
+        postprocess_headroom: float = DEFAULT_POSTPROCESS_HEADROOM,
+        postprocess_timeout: float = DEFAULT_POSTPROCESS_TIMEOUT,
+        file_id_cache_size: int = DEFAULT_FILE_ID_CACHE_SIZE,
+        file_id_cache_ttl: float = DEFAULT_FILE_ID_CACHE_TTL,
+        metadata_cache_size: int = DEFAULT_METADATA_CACHE_SIZE,
+        metadata_cache_ttl: float = DEFAULT_METADATA_CACHE_TTL,
+        state_db: str = "",
+        max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH,
+        max_upload_size: int = DEFAULT_MAX_UPLOAD_SIZE,
+        inline_answer_timeout: float = DEFAULT_INLINE_ANSWER_TIMEOUT,
+        metrics_port: int = 0,
+        spool_threshold: int = DEFAULT_SPOOL_THRESHOLD,
+        scratch_dir: str = DEFAULT_SCRATCH_DIR,
+        scratch_quota: int = DEFAULT_SCRATCH_QUOTA,
+        scratch_orphan_ttl: float = DEFAULT_ORPHAN_TTL,
+        download_attempts: int = DEFAULT_DOWNLOAD_ATTEMPTS,
+        circuit_breaker_cooldown: float = DEFAULT_BREAKER_COOLDOWN,
+        job_queue: Optional[JobQueue] = None,
+        job_timeout: float = DEFAULT_JOB_TIMEOUT,
+        shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT,
     ):
         self._authenticated_chats = set()
         self._user_to_group: Dict[str, str] = {}
@@ -61,25 +137,322 @@ class MediaDownloaderBot(object):
 
         self._num_downloads: int = 0
 
+        self._metrics: Metrics = Metrics()
+        self._metrics_server: Optional[MetricsServer] = None
+        if metrics_port:
+            self._metrics_server = MetricsServer(self._metrics, metrics_port).start()
+
+        # Transient download errors are retried, and platforms that keep failing are paused by a circuit breaker.
+        self._resilience: Resilience = Resilience(
+            max_attempts=download_attempts,
+            cooldown=circuit_breaker_cooldown,
+            on_retry=lambda platform, ex: self._metrics.retries.inc(platform=platform),
+            on_state_change=lambda platform, state: self._metrics.circuit_state.set(
+                {OPEN: 2, HALF_OPEN: 1}.get(state, 0), platform=platform),
+            on_reject=lambda platform: self._metrics.circuit_rejections.inc(platform=platform),
+        )
+
+        # Media larger than this (in bytes) is rejected before it is downloaded, unless it can be post-processed to fit.
+        self._max_upload_size: int = max_upload_size
+
+        # Videos that Telegram can't stream, or that are up to `postprocess_headroom` times too large, are remuxed or
+        # re-encoded by ffmpeg, in a pool of its own so that CPU-heavy encodes don't hold up the downloads.
+        if postprocess_headroom < 1:
+            raise ValueError(f"postprocess_headroom must be at least 1, got {postprocess_headroom}")
+        ffmpeg: Optional[str] = find_ffmpeg() if postprocess_workers > 0 else None
+        self._postprocessor: Optional[PostProcessor] = PostProcessor(
+            postprocess_workers, ffmpeg, timeout=postprocess_timeout) if ffmpeg else None
+        # Videos up to this size (in bytes) are downloaded to be post-processed. 0 if post-processing is disabled.
+        self._postprocess_size: int = int(max_upload_size * postprocess_headroom) if self._postprocessor else 0
+
+        # Downloaded media up to this size (in bytes) is kept in memory rather than written to disk.
+        self._spool_threshold: int = spool_threshold
+
+        # Every download reserves the largest possible download of scratch space, plus the maximum upload size for
+        # the output of post-processing, so the quota must allow at least one.
+        self._download_reservation: int = max(max_upload_size, self._postprocess_size)
+        required_quota: int = self._download_reservation + (max_upload_size if self._postprocessor else 0)
+        if scratch_quota and scratch_quota < required_quota:
+            raise ValueError(
+                f"The scratch quota ({scratch_quota} bytes) must be at least {required_quota} bytes: the maximum upload size "
+                f"({max_upload_size} bytes), or, with post-processing, the largest download plus the maximum upload size")
+        self._scratch: ScratchSpace = ScratchSpace(scratch_dir, quota=scratch_quota, orphan_ttl=scratch_orphan_ttl)
+
+        # Telegram file IDs of media that has already been uploaded, keyed by media (see `MediaUrl.key`).
+        self._file_id_cache: TTLCache[str] = TTLCache(
+            max_size=file_id_cache_size, ttl=file_id_cache_ttl)
+        # The same file IDs keyed by content (see `_content_key`), so that identical media from different URLs is
+        # only uploaded once. A cache of its own, so that content entries don't evict the entries of URLs.
+        self._content_file_id_cache: TTLCache[str] = TTLCache(
+            max_size=file_id_cache_size, ttl=file_id_cache_ttl)
+        # Downloaded media that was sent by the file ID of identical media, rather than uploaded.
+        self._deduplicated: "weakref.WeakSet[MediaBuffer]" = weakref.WeakSet()
+
+        # Probed metadata of media, or the reason it was rejected (e.g., it is too large), keyed by canonical URL.
+        self._metadata_cache: TTLCache[Union[MediaInfo, Exception]] = TTLCache(
+            max_size=metadata_cache_size, ttl=metadata_cache_ttl)
+
+        # Downloads that are currently in progress, keyed by media (see `MediaUrl.key`).
+        self._in_flight_downloads: RequestCoalescer[str] = RequestCoalescer()
+
+        # In split mode, downloads are handed to worker processes through a job queue rather than run here.
+        self._jobs: Optional[JobDispatcher] = JobDispatcher(job_queue, job_timeout) if job_queue is not None else None
+        # Jobs that are currently in progress, keyed by media (see `MediaUrl.key`).
+        self._in_flight_jobs: RequestCoalescer[JobResult] = RequestCoalescer()
+
+        # Background inline preparations (download + upload to the user's private chat), keyed by media.
+        self._inline_preparations: Dict[str, "asyncio.Task[str]"] = {}
+        # Media whose inline query was answered with a placeholder because the video wasn't ready in time.
+        self._deferred_inline_deliveries: Set[str] = set()
+        self._inline_answer_timeout: float = inline_answer_timeout
+
+        # References to fire-and-forget tasks, so that they aren't garbage collected while running.
+        self._background_tasks: Set["asyncio.Task[Any]"] = set()
+        # Timers that make the bot leave groups that don't authenticate in time.
+        self._auth_timer_tasks: Set["asyncio.Task[Any]"] = set()
+
+        # Number of download requests and inline queries being handled right now.
+        self._active_requests: int = 0
+        # Set once a graceful shutdown has started.
+        self._shutdown_task: Optional["asyncio.Task[None]"] = None
+        self._shutting_down: bool = False
+        # Cleared once a graceful shutdown has drained in-flight downloads. New downloads are rejected from then on.
+        self._accepting: bool = True
+        self._shutdown_timeout: float = shutdown_timeout
+        self._closed: bool = False
+
+        # Throttles outbound Bot API requests. Set by `init_handlers` if the application uses one.
+        self._rate_limiter: Optional[TelegramRateLimiter] = None
+
+        # Queues downloads per chat/user and starts them fairly, at most `download_workers` at a time.
+        self._scheduler: FairScheduler = FairScheduler(
+            max_concurrency=download_workers, max_queue_depth=max_queue_depth)
+
+        # yt-dlp is blocking, so downloads run in a bounded worker pool rather than on the event loop.
+        # Each worker reuses warm YoutubeDL instances for up to `ydl_max_uses` downloads, and downloads each
+        # video over up to `download_connections` connections, out of `max_download_connections` shared by all workers.
+        if download_connections < 1:
+            raise ValueError(f"download_connections must be at least 1, got {download_connections}")
+        self._download_connections: int = download_connections
+        self._download_executor_type: str = download_executor
+        self._download_executor: Executor = create_download_executor(
+            download_executor, download_workers, ydl_max_uses, max_download_connections)
+
+        # Log records are formatted and written by a background thread, so logging doesn't block the event loop.
+        self._logging: LoggingPipeline = LoggingPipeline(
+            PACKAGE_LOGGER,
+            log_file=log_file,
+            logger_format=logger_format,
+            max_bytes=log_max_bytes,
+            backup_count=log_backup_count,
+            update_sample_rate=log_update_sample_rate,
+        )
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
+        if postprocess_workers > 0 and self._postprocessor is None:
+            self.logger.warning("ffmpeg was not found, so downloaded videos aren't post-processed.")
+        # Full dumps of incoming updates, sampled at `log_update_sample_rate`.
+        self._update_logger = logging.getLogger(UPDATES_LOGGER)
+
+        # Optional on-disk persistence of state so that it survives restarts.
+        self._store: Optional[StateStore] = None
+        if state_db:
+            # Room for both the URL and the content entries.
+            self._store = StateStore(state_db, max_file_ids=2 * file_id_cache_size)
+            self._load_state(self._store)
 
-        # Create a handler and set the formatter
-        stream_handler = logging.StreamHandler()
-        formatter = logging.Formatter(logger_format)
-        stream_handler.setFormatter(formatter)
+        for preauth_chat_id in self._preauth_chat_ids:
+            self.logger.debug('Pre-autenticating chat "%s"', preauth_chat_id)
+            self.authenticate_chat(preauth_chat_id)
 
-        # Add the handler to the logger
-        self.logger.addHandler(stream_handler)
+    def _load_state(self, store: StateStore) -> None:
+        """
+        Restore state persisted by a previous run.
+        """
+        self._authenticated_chats.update(store.load_authenticated_chats())
+        self._user_to_chat_id.update(store.load_user_chats())
+        self._num_downloads = store.load_counters().get("num_downloads", 0)
 
-        if log_file:
-            file_handler = logging.FileHandler(log_file)
-            file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+        file_ids = store.load_file_ids()
+        for key, file_id, expires_at in file_ids:
+            self._file_id_cache_for(key).put(key, file_id, expires_at=expires_at)
 
-        for preauth_chat_id in self._preauth_chat_ids:
-            self.logger.debug(f'Pre-autenticating chat "{preauth_chat_id}"')
-            self.authenticate_chat(preauth_chat_id)
+        self.logger.info(
+            'Loaded state from "%s": %d authenticated chat(s), %d user chat(s), %d cached file ID(s), %d download(s).',
+            store.path, len(self._authenticated_chats), len(self._user_to_chat_id), len(file_ids), self._num_downloads)
+
+    def close(self) -> None:
+        """
+        Release resources held by the bot, committing any pending state writes.
+
+        Use `shutdown` to wait for in-flight downloads first.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._store:
+            self._store.close()
+        if self._jobs:
+            self._jobs.close()
+        if self._metrics_server:
+            self._metrics_server.stop()
+        if self._postprocessor:
+            self._postprocessor.shutdown()
+        self._scratch.close()
+        # Leftovers of abandoned downloads are deleted by the sweeper as usual, once they are old enough.
+        self._scratch.sweep()
+        self._logging.close()
+
+    @property
+    def shutting_down(self) -> bool:
+        return self._shutting_down
+
+    async def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Shut down gracefully: wait up to `timeout` seconds for in-flight downloads and replies, fail the rest
+        with a "try again" reply, reject new downloads, and release all resources.
+
+        Stop receiving updates first (see `request_shutdown`), so that Telegram keeps new ones for the next start.
+
+        :param timeout: defaults to the `shutdown_timeout` the bot was created with.
+        """
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        timeout = self._shutdown_timeout if timeout is None else timeout
+
+        queue_stats: Dict[str, Any] = self._scheduler.stats()
+        self.logger.info(
+            "Shutting down: waiting up to %gs for %d request(s), %d running and %d queued download(s).",
+            timeout, self._active_requests, queue_stats['running'], queue_stats['queue_depth'])
+
+        # Nobody is waiting for these timers' groups to authenticate across a restart.
+        for task in self._auth_timer_tasks:
+            task.cancel()
+
+        drained: bool = await self._drain(timeout)
+        self._accepting = False
+        if not drained:
+            cancelled: int = self._scheduler.cancel_all(ShuttingDownError("The bot is shutting down"))
+            if self._jobs is not None:
+                # These jobs stay on the queue, and the workers still reply with their media.
+                cancelled += self._jobs.cancel_all(ShuttingDownError("The bot is shutting down"))
+            self.logger.warning("Shutdown timeout reached: cancelled %d download(s).", cancelled)
+            # Give the requests whose downloads were cancelled a moment to tell their users.
+            if not await self._drain(_SHUTDOWN_GRACE_PERIOD):
+                self.logger.warning("Cancelling %d remaining background task(s).", len(self._background_tasks))
+
+        tasks: List["asyncio.Task[Any]"] = [task for task in self._background_tasks | self._auth_timer_tasks
+                                            if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Downloads that were already running in the worker pool can't be interrupted. Wait for them, so
+        # that their media is released before the process exits.
+        await asyncio.to_thread(self._download_executor.shutdown, wait=True, cancel_futures=True)
+
+        self.logger.info("Final metrics:\n%s", "\n".join(self._metrics_summary_lines()))
+        self.close()
+
+    async def _drain(self, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for in-flight requests and background tasks to finish.
+
+        :return: whether everything finished in time.
+        """
+        loop = asyncio.get_running_loop()
+        deadline: float = loop.time() + timeout
+        while self._active_requests or any(task is not asyncio.current_task() for task in self._background_tasks):
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def request_shutdown(self, app: Application) -> None:
+        """
+        Shut down gracefully in the background (see `shutdown`), then stop the application.
+        """
+        if self._shutdown_task is not None:
+            return
+
+        async def shutdown_and_stop() -> None:
+            try:
+                # Stop fetching updates, so that Telegram keeps new ones for the next start. Updates that
+                # were already fetched are still handled while the bot drains.
+                if app.updater is not None and app.updater.running:
+                    await app.updater.stop()
+                await self.shutdown()
+            finally:
+                app.stop_running()
+
+        self._shutdown_task = asyncio.ensure_future(shutdown_and_stop())
+
+    async def install_signal_handlers(self, app: Application) -> None:
+        """
+        Shut down gracefully on SIGINT and SIGTERM, rather than dropping in-flight downloads.
+
+        Pass this as the `post_init` callback of the application, and run it with `stop_signals=None`.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.request_shutdown, app)
+            except NotImplementedError:
+                # Not supported on Windows, where Ctrl+C still stops the application right away.
+                return
+
+    async def post_init(self, app: Application) -> None:
+        """
+        Start-up hook: install the signal handlers (see `install_signal_handlers`) and warm up the downloads
+        in the background (see `warm_up`).
+
+        Pass this as the `post_init` callback of the application, and run it with `stop_signals=None`.
+        """
+        await self.install_signal_handlers(app)
+        self.warm_up()
+
+    def warm_up(self) -> Optional["asyncio.Task[None]"]:
+        """
+        Import yt-dlp and prepare a YoutubeDL instance in the download pool in the background, so that
+        neither start-up nor the first download waits for it.
+
+        :return: the warm-up task, or None in split mode, where the workers download the media.
+        """
+        if self._jobs is not None:
+            return None
+        return self._spawn(self._warm_up())
+
+    async def _warm_up(self) -> None:
+        start: float = time.perf_counter()
+        try:
+            await asyncio.wrap_future(self._download_executor.submit(
+                warm_up, self._scratch.directory, self._max_upload_size, None, self._postprocess_size))
+        except Exception as ex:
+            # The first download imports yt-dlp itself (and reports the error, if any).
+            self.logger.warning("Failed to warm up the downloads: %s", ex)
+            return
+        self.logger.info("Warmed up the downloads in %.2fs.", time.perf_counter() - start)
+
+    @contextmanager
+    def _track_request(self) -> Iterator[None]:
+        self._active_requests += 1
+        try:
+            yield
+        finally:
+            self._active_requests -= 1
+
+    @property
+    def http_port(self) -> int:
+        return self._http_port
+
+    def webhook_url(self, url_path: str = DEFAULT_WEBHOOK_PATH) -> str:
+        """
+        Return the public URL at which Telegram should deliver updates in webhook mode.
+
+        :param url_path: path at which the webhook server receives updates.
+        """
+        return f"https://{self._public_ipv4}:{self._http_port}/{url_path}"
 
     def init_handlers(self, app: Application) -> None:
         """
@@ -91,6 +464,7 @@ class MediaDownloaderBot(object):
         app.add_handler(CommandHandler("exit", self.exit_command))
         app.add_handler(CommandHandler("start", self.start_command))
         app.add_handler(CommandHandler("clear_auth", self.clear_auth_command))
+        app.add_handler(CommandHandler("status", self.status_command))
 
         app.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND, self.handle_message))
@@ -100,6 +474,10 @@ class MediaDownloaderBot(object):
         app.add_handler(InlineQueryHandler(self.inline_download_command))
         app.add_error_handler(self.error_handler)
 
+        rate_limiter = getattr(app.bot, "rate_limiter", None)
+        if isinstance(rate_limiter, TelegramRateLimiter):
+            self._rate_limiter = rate_limiter
+
     # Handler for /start
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         assert update.effective_chat
@@ -109,9 +487,11 @@ class MediaDownloaderBot(object):
         user_id = str(update.effective_user.id)
 
         self._user_to_chat_id[user_id] = chat_id
+        if self._store:
+            self._store.put_user_chat(user_id, chat_id)
 
         self.logger.debug(
-            f'Registerd chat ID "{chat_id}" for user "{user_id}".')
+            'Registerd chat ID "%s" for user "%s".', chat_id, user_id)
 
         if update.message:
             await update.message.reply_text("🚀 Thanks! You can now use inline queries.")
@@ -131,9 +511,11 @@ class MediaDownloaderBot(object):
         self.logger.info("/clear_auth: clearing all authenticated chat IDs.")
 
         self._authenticated_chats.clear()
+        if self._store:
+            self._store.clear_authenticated_chats()
 
         for preauth_chat_id in self._preauth_chat_ids:
-            self.logger.debug(f'Pre-autenticating chat "{preauth_chat_id}"')
+            self.logger.debug('Pre-autenticating chat "%s"', preauth_chat_id)
             self.authenticate_chat(preauth_chat_id)
 
     # Handler for /exit
@@ -150,7 +532,11 @@ class MediaDownloaderBot(object):
 
         self.logger.info("Received 'exit' command from admin. Goodbye!")
 
-        exit(0)
+        if update.message:
+            await update.message.reply_text("👋 Shutting down once the downloads in progress are done...")
+
+        # Shut down in the background, so that this handler returns and the application can stop.
+        self.request_shutdown(context.application)
 
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Log the error and send a telegram message to notify the developer."""
@@ -165,6 +551,8 @@ class MediaDownloaderBot(object):
         :param chat_id: the ID of the Telegram chat to be authenticated.
         """
         self._authenticated_chats.add(str(chat_id))
+        if self._store:
+            self._store.add_authenticated_chat(str(chat_id))
 
     # Command handler for /auth
     async def auth_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -210,48 +598,144 @@ class MediaDownloaderBot(object):
             self._group_auth_timers[chat_id]["authenticated"] = True
 
         self.authenticate_chat(chat_id)
-        self.logger.info(f'Authenticated chat: "{chat_id}"')
+        self.logger.info('Authenticated chat: "%s"', chat_id)
 
         await update.message.reply_text(f"✅ Authentication successful! Thanks {update.effective_user.first_name}.")
 
     # Command handler for /download
-    async def download_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    async def download_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[MediaBuffer]:
         """
         Inspect messages to see if they are a link to an Instagram reel or YouTube short.
         If so, download them, and reply to the message with the downloaded media. 
         """
         if not update.message or not update.message.text:
-            return None
+            return []
 
         text: str = update.message.text.strip()
         splits: list[str] = text.split(" ")
 
         if len(splits) <= 1:
-            return None
+            return []
 
-        text = splits[1]
+        text = " ".join(splits[1:])
 
-        self.logger.info(f'Received /download command: "{text}"')
+        self.logger.info('Received /download command: "%s"', text)
 
         return await self._handle_download_request(text, update)
 
     # Command handler for /metrics
     async def metrics_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Reply with the total number of downloads. The admin also receives per-stage latency percentiles.
+        """
+        assert update.message
+        lines: List[str] = [f"⬇️ Total number of downloads: {self._num_downloads}"]
+
+        if update.effective_user and str(update.effective_user.id) == self._admin_user_id:
+            lines.extend(self._metrics_summary_lines())
+
+        await update.message.reply_text("\n".join(lines))
+
+    def _metrics_summary_lines(self) -> List[str]:
+        """
+        Build the admin-only part of the /metrics report.
+        """
+        metrics: Metrics = self._metrics
+        lines: List[str] = [
+            f"🗂️ File ID cache: {metrics.cache_hits.total():g} hit(s), {metrics.cache_misses.total():g} miss(es)",
+            f"🔎 Metadata cache: {metrics.metadata_cache_hits.total():g} hit(s), {metrics.metadata_cache_misses.total():g} miss(es)",
+            f"🔗 Coalesced requests: {metrics.coalesced.total():g}",
+            f"🧬 Identical media sent by file ID instead of uploaded: {metrics.content_dedup_hits.total():g}",
+            f"🎞️ Post-processed: {metrics.stage_duration.count(stage='postprocess')} video(s), "
+            f"{metrics.postprocess_cpu_seconds.total():.1f} CPU second(s)",
+            f"📦 Downloaded: {metrics.downloaded_bytes.total() / (1024 * 1024):.1f} MB, "
+            f"uploaded: {metrics.uploaded_bytes.total() / (1024 * 1024):.1f} MB",
+            f"❌ Errors: {metrics.errors.total():g}",
+            f"🔁 Retries: {metrics.retries.total():g}, rejected by circuit breakers: {metrics.circuit_rejections.total():g}",
+        ]
+
+        breakers: Dict[str, Tuple[str, float]] = self._resilience.states()
+        if breakers:
+            lines.append("🔌 Circuit breakers:")
+            for platform, (state, retry_after) in breakers.items():
+                lines.append(f"  • {platform}: {state}" + (f" (retry in {retry_after:.0f}s)" if state == OPEN else ""))
+
+        stage_lines: List[str] = metrics.summary_lines()
+        if stage_lines:
+            lines.append("⏱️ Stage latency:")
+            lines.extend(stage_lines)
+
+        return lines
+
+    # Command handler for /status
+    async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Report the state of the download queue.
+
+        /status
+
+        Only works if sent by the admin user.
+        """
+        if not update.effective_user or str(update.effective_user.id) != self._admin_user_id:
+            return
+
         assert update.message
-        await update.message.reply_text(f"⬇️ Total number of downloads: {self._num_downloads}")
+        await update.message.reply_text("\n".join(self._status_lines()))
+
+    def _status_lines(self) -> List[str]:
+        """
+        Build the lines of the admin /status report.
+        """
+        queue_stats: Dict[str, Any] = self._scheduler.stats()
+        lines: List[str] = [
+            f"📥 Queued downloads: {queue_stats['queue_depth']}/{queue_stats['max_queue_depth']}",
+            f"⚙️ Running downloads: {queue_stats['running']}/{queue_stats['max_concurrency']}",
+            f"⏱️ Queue wait: mean {queue_stats['mean_wait']:.2f}s, p95 {queue_stats['p95_wait']:.2f}s, max {queue_stats['max_wait']:.2f}s",
+            f"🚫 Rejected (queue full): {queue_stats['rejected']}",
+        ]
+
+        for chat_id, depth in queue_stats["queued_per_chat"][:5]:
+            lines.append(f"  • chat {chat_id}: {depth} queued")
+
+        mb: int = 1024 * 1024
+        scratch: Dict[str, Any] = self._scratch.usage()
+        quota: str = f"{scratch['quota'] / mb:.0f} MB" if scratch['quota'] else "unlimited"
+        lines.extend([
+            f"💾 Scratch space: {scratch['disk_bytes'] / mb:.1f} MB in {scratch['files']} file(s), "
+            f"{scratch['reserved'] / mb:.1f} MB reserved of {quota}, {scratch['waiting']} download(s) waiting",
+            f"🧹 Orphaned files swept: {scratch['swept']} ({scratch['bytes_swept'] / mb:.1f} MB)",
+        ])
+
+        if self._rate_limiter is not None:
+            limiter_stats: Dict[str, int] = self._rate_limiter.stats()
+            lines.append(
+                f"🚦 Outbound API requests: {limiter_stats['waiting']} waiting, {limiter_stats['throttled']} throttled, "
+                f"{limiter_stats['flood_waits']} flood wait(s)")
+
+        if self._jobs is not None:
+            lines.append(f"🏭 Jobs waiting for download workers: {self._jobs.in_flight}")
+
+        if self._postprocessor is not None:
+            lines.append(f"🎞️ Post-processing jobs: {self._postprocessor.active_jobs}")
+
+        if self._logging.dropped:
+            lines.append(f"📝 Log records dropped (queue full): {self._logging.dropped}")
+
+        return lines
 
     # General message handler.
-    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[MediaBuffer]:
         """
-        Message handler. Inspect messages to see if they are a link to an Instagram reel or YouTube short.
+        Message handler. Inspect messages to see if they contain links to Instagram reels or YouTube shorts.
         If so, download them, and reply to the message with the downloaded media. 
         """
         if not update.message or not update.message.text:
-            return
+            return []
 
         text = update.message.text.strip()
 
-        self.logger.info(f'Received message: "{text}"')
+        self.logger.info('Received message: "%s"', text)
+        self._update_logger.debug("update: %s", update)
 
         return await self._handle_download_request(text, update)
 
@@ -275,7 +759,7 @@ class MediaDownloaderBot(object):
 
         chat_id = chat.id
         self.logger.info(
-            f"TelegramMediaDownloaderBot added to new group: {chat.title} (ID: {chat_id})")
+            "TelegramMediaDownloaderBot added to new group: %s (ID: %s)", chat.title, chat_id)
 
         # Send welcome message with instructions
         await context.bot.send_message(
@@ -283,7 +767,8 @@ class MediaDownloaderBot(object):
             text="🤖 Hello! I'm a protected bot. "
             f"Please authenticate me within {self._auth_timeout} second(s) by sending:\n"
             f"/auth <password>\n\n"
-            "Otherwise I'll automatically leave this group."
+            "Otherwise I'll automatically leave this group.",
+            **self._low_priority(),
         )
 
         # Set the removal time (current time + timeout)
@@ -294,20 +779,24 @@ class MediaDownloaderBot(object):
         }
 
         # Schedule a check for this group
-        asyncio.create_task(self._check_group_auth(chat_id, context))
+        timer: "asyncio.Task[None]" = asyncio.ensure_future(self._check_group_auth(chat_id, context))
+        self._auth_timer_tasks.add(timer)
+        timer.add_done_callback(self._auth_timer_tasks.discard)
 
     # Inline command handler.
     async def inline_download_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        with self._track_request():
+            await self._answer_inline_query(update, context)
+
+    async def _answer_inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         assert update.inline_query is not None
         query = update.inline_query.query
 
-        self.logger.debug(f"update: {update}")
-
-        self.logger.debug(f"context: {context}")
+        self._update_logger.debug("update: %s, context: %s", update, context)
 
         user_id = str(update.inline_query.from_user.id)
         if user_id not in self._user_to_chat_id:
-            self.logger.debug(f"_user_to_chat_id: {self._user_to_chat_id}")
+            self.logger.debug('User "%s" has no private chat with the bot.', user_id)
             # User hasn't started a private chat with the bot
             await update.inline_query.answer(
                 [],
@@ -319,45 +808,93 @@ class MediaDownloaderBot(object):
             return
         private_chat_id: str = self._user_to_chat_id[user_id]
 
-        if "?" in query:
-            query = query[0:query.index("?")]
-
-        self.logger.info(f'Received inline download query: "{query}"')
-        self.logger.info(update)
-
         if not query:  # empty query should not be handled
             return
 
-        self.logger.info(f'Received inline download query: "{query}"')
-        
+        self.logger.info('Received inline download query: "%s"', query)
+
         split_query: List[str] = query.split(" ")
-        url: str = split_query[0]
+        with self._metrics.time_stage("classify"):
+            media_url: Optional[MediaUrl] = classify_url(split_query[0])
+        if not media_url:
+            return
 
-        found: bool = False
-        for prefix in MediaDownloaderBot.valid_url_prefixes:
-            if prefix in url:
-                found = True
-                break
+        url: str = media_url.canonical_url
+        cache_key: str = media_url.key
+        caption: str = " ".join(split_query[1:])
+
+        # Media that has already been uploaded can be re-sent by file ID without downloading it again.
+        cached_file_ids: Optional[str] = self._lookup_file_id(cache_key, media_url.platform)
+        if cached_file_ids:
+            self.logger.info('Answering inline query for "%s" from the file ID cache.', url)
+            await update.inline_query.answer(self._cached_video_results(cached_file_ids, caption))
+            return
 
-        if not found:
+        if not self._accepting:
+            await update.inline_query.answer([InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title='Restarting: Please Try Again',
+                description="The bot is restarting right now. Please try again in a minute.",
+                input_message_content=InputTextMessageContent(message_text=url)
+            )], cache_time=0, is_personal=True)
             return
 
+        # Download and upload in the background, so that the query is answered before Telegram's deadline
+        # even when the download is slow. Retries of the same query join the same background task.
+        preparation: "asyncio.Task[str]" = self._inline_preparations.get(cache_key) or self._start_inline_preparation(
+            media_url, user_id, private_chat_id, context)
+
         try:
-            # Download the video
-            video_id: str = str(uuid.uuid4())
-            video_path: str = os.path.join("./video", f"{video_id}.mp4")
-            self.logger.info(f'Will save reel to file "{video_path}"\n')
-            self._download_media(url, output_path=video_path)
-            self.logger.info(
-                f'Successfully downloaded Instagram reel to file "{video_path}"\n\n')
+            file_ids: str = await asyncio.wait_for(asyncio.shield(preparation), timeout=self._inline_answer_timeout)
+        except asyncio.TimeoutError:
+            self.logger.info('Video for inline query "%s" is not ready yet. Answering with a placeholder.', url)
+            self._deferred_inline_deliveries.add(cache_key)
+            await update.inline_query.answer([InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title='⏳ Preparing Video...',
+                description='The video is still downloading. Retry in a few seconds to send it, or tap to send the link.',
+                input_message_content=InputTextMessageContent(message_text=url)
+            )], cache_time=0, is_personal=True)
+            return
+        except QueueFullError as ex:
+            self.logger.warning('Rejected inline download of "%s": %s', url, ex)
+            await update.inline_query.answer([InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title='Busy: Please Try Again',
+                description='Too many downloads are queued right now. Please try again in a minute.',
+                input_message_content=InputTextMessageContent(
+                    message_text='Error: the bot is busy right now. Please try again in a minute.',
+                )
+            )], cache_time=0, is_personal=True)
+            return
+        except CircuitOpenError as ex:
+            self.logger.warning('Rejected inline download of "%s": %s', url, ex)
+            await update.inline_query.answer([InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title='Error: Temporarily Unavailable',
+                description=f'Downloads from {media_url.platform} are failing right now. Please try again in {ex.retry_after:.0f} seconds.',
+                input_message_content=InputTextMessageContent(
+                    message_text=f'Error: downloads from {media_url.platform} are paused right now. Please try again later.',
+                )
+            )], cache_time=0, is_personal=True)
+            return
+        except MediaTooLargeError as ex:
+            self.logger.warning('Rejected inline download of "%s": %s', url, ex)
+            await update.inline_query.answer([InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title='Error: Video Too Large',
+                description=f'The requested video is larger than {self._max_upload_size_mb()} MB, which is too large to send.',
+                input_message_content=InputTextMessageContent(
+                    message_text='Error: the requested video is too large to send on Telegram. Sorry!',
+                )
+            )])
+            return
         except Exception as ex:
-            self.logger.error(f'Failed to download video at URL "{url}"')
-            self.logger.error(ex)
-            self.logger.error(traceback.format_exc())
+            self.logger.error('Failed to download video at URL "%s"', url, exc_info=ex)
 
             results = []
 
-            if "Restricted Video" in str(ex):
+            if isinstance(ex, RestrictedMediaError):
                 results.append(InlineQueryResultArticle(
                     id=str(uuid.uuid4()),
                     title='Error: Age Restricted Video',
@@ -380,44 +917,185 @@ class MediaDownloaderBot(object):
 
             return
 
-        message = await context.bot.send_video(
-            chat_id=private_chat_id,
-            video=open(video_path, "rb")
-        )
-
-        assert message.video
+        await update.inline_query.answer(self._cached_video_results(file_ids, caption))
 
-        # Use get_file() to retrieve the File object
-        file = await message.video.get_file()
+    def _start_inline_preparation(
+        self,
+        media_url: MediaUrl,
+        user_id: str,
+        private_chat_id: str,
+        context: ContextTypes.DEFAULT_TYPE
+    ) -> "asyncio.Task[str]":
+        """
+        Start downloading the media for an inline query and uploading it to the user's private chat in the background.
+        """
+        url: str = media_url.canonical_url
+        cache_key: str = media_url.key
+        preparation: "asyncio.Task[str]" = self._spawn(
+            self._prepare_inline_video(media_url, user_id, private_chat_id, context))
+        self._inline_preparations[cache_key] = preparation
+
+        def on_done(task: "asyncio.Task[str]") -> None:
+            if self._inline_preparations.get(cache_key) is task:
+                del self._inline_preparations[cache_key]
+            if not task.cancelled() and task.exception() is not None and cache_key in self._deferred_inline_deliveries:
+                # Nobody is waiting for the result anymore; the user will see the error when they retry.
+                self._deferred_inline_deliveries.discard(cache_key)
+                self.logger.error('Background download for inline query "%s" failed: %s', url, task.exception())
+
+        preparation.add_done_callback(on_done)
+        return preparation
+
+    async def _prepare_inline_video(
+        self,
+        media_url: MediaUrl,
+        user_id: str,
+        private_chat_id: str,
+        context: ContextTypes.DEFAULT_TYPE
+    ) -> str:
+        """
+        Download the media for an inline query and upload it to the user's private chat to obtain file IDs.
 
-        # You now have access to file.file_id
-        file_id = file.file_id
-        
-        if len(split_query) > 0:
-            caption:str = split_query[1]
+        :return: the comma-separated Telegram file IDs of the uploaded videos.
+        """
+        cache_key: str = media_url.key
+
+        # IDs of the messages in the private chat that hold the uploaded videos.
+        message_ids: List[int] = []
+        if self._jobs is not None:
+            result, own_job = await self._run_job(media_url, private_chat_id, user_id)
+            file_ids: str = ",".join(result.file_ids)
+            if own_job:
+                message_ids = list(result.message_ids)
+                for _ in result.file_ids:
+                    self._record_delivery(media_url.platform, source="worker")
         else:
-            caption:str = ""
+            self._resilience.check(media_url.platform)
+            self._check_rejected(media_url.canonical_url)
+            self._count_if_coalesced(cache_key)
+            async with self._in_flight_downloads.acquire(
+                cache_key,
+                lambda: self._scheduler.submit(
+                    private_chat_id, user_id, lambda: self._download_to_buffer(media_url.canonical_url, media_url.platform)),
+                release=self._release_media
+            ) as items:
+                messages: List[Message] = await self._send_videos(
+                    list(items),
+                    functools.partial(context.bot.send_video, chat_id=private_chat_id),
+                    functools.partial(context.bot.send_media_group, chat_id=private_chat_id),
+                    media_url.platform,
+                )
+                for media in items:
+                    self._record_delivery(media_url.platform, media)
+
+            file_ids = self._join_file_ids(messages)
+            message_ids = [message.message_id for message in messages]
 
-        results = [
+        self._put_file_id(cache_key, file_ids)
+
+        async def clean_up():
+            await asyncio.sleep(2)
+
+            # If the inline query was answered with a placeholder, the user receives the video in the
+            # private chat instead, so leave it there.
+            if cache_key in self._deferred_inline_deliveries:
+                self._deferred_inline_deliveries.discard(cache_key)
+                return
+
+            self.logger.debug("Cleaning up.")
+            for message_id in message_ids:
+                await context.bot.delete_message(chat_id=private_chat_id, message_id=message_id)
+
+        # Delete it after 2 seconds
+        self._spawn(clean_up())
+
+        return file_ids
+
+    def _spawn(self, coroutine: Coroutine[Any, Any, T]) -> "asyncio.Task[T]":
+        """
+        Run a coroutine in the background, keeping a reference to it until it is done.
+        """
+        task: "asyncio.Task[T]" = asyncio.ensure_future(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+
+    @staticmethod
+    def _cached_video_results(file_ids: str, caption: str = "") -> List[InlineQueryResultCachedVideo]:
+        """
+        Create inline query results for videos that have already been uploaded to Telegram, one per video
+        of a carousel.
+
+        :param file_ids: comma-separated Telegram file IDs, as stored in the file ID cache.
+        """
+        return [
             InlineQueryResultCachedVideo(
-                id="inline-video-1",
+                id=f"inline-video-{i}",
                 video_file_id=file_id,
                 title="Pre-uploaded video",
                 caption=caption,
                 description=caption,
-            ),
+            )
+            for i, file_id in enumerate(file_ids.split(","), start=1)
         ]
 
-        await update.inline_query.answer(results)
+    @staticmethod
+    def _join_file_ids(messages: Sequence[Optional[Message]]) -> str:
+        """
+        Join the file IDs of the videos in `messages` for the file ID cache. Empty if any of them has no video.
+        """
+        file_ids: List[str] = []
+        for message in messages:
+            if message is None or message.video is None:
+                return ""
+            file_ids.append(message.video.file_id)
+        return ",".join(file_ids)
+
+    def _file_id_cache_for(self, key: str) -> TTLCache[str]:
+        """
+        The cache of file IDs keyed by content for content keys (see `_content_key`), else the one keyed by media.
+        """
+        return self._content_file_id_cache if key.startswith(CONTENT_KEY_PREFIX) else self._file_id_cache
+
+    def _put_file_id(self, key: str, file_id: str) -> None:
+        if not file_id:
+            return
+        cache: TTLCache[str] = self._file_id_cache_for(key)
+        expires_at: float = time.time() + cache.ttl
+        cache.put(key, file_id, expires_at=expires_at)
+        if self._store:
+            self._store.put_file_id(key, file_id, expires_at)
+
+    def _evict_file_id(self, key: str) -> None:
+        self._file_id_cache_for(key).pop(key)
+        if self._store:
+            self._store.delete_file_id(key)
+
+    def _low_priority(self) -> Dict[str, Any]:
+        """
+        Keyword arguments that send a Bot API request behind media replies (see `TelegramRateLimiter`).
 
-        async def clean_up():
-            await asyncio.sleep(2)
-            self.logger.debug("Cleaning up.")
-            os.remove(video_path)
-            await context.bot.delete_message(chat_id=private_chat_id, message_id=message.message_id)
+        `ExtBot` rejects `rate_limit_args` unless the application has a rate limiter, so they are empty without one.
+        """
+        if self._rate_limiter is None:
+            return {}
+        return {"rate_limit_args": PRIORITY_LOW}
 
-        # Delete it after 2 seconds
-        asyncio.create_task(clean_up())
+    @staticmethod
+    def _content_key(sha256: str) -> str:
+        """
+        Key of the file ID cache for media with the given content (see `MediaBuffer.sha256`).
+        """
+        return f"{CONTENT_KEY_PREFIX}{sha256}"
+
+    def _content_file_id(self, video: Video) -> Optional[str]:
+        """
+        Return the file ID of media identical to `video` that has already been uploaded, from whichever URL.
+        """
+        if isinstance(video, str):
+            return None
+        return self._content_file_id_cache.get(self._content_key(video.sha256))
 
     async def _check_group_auth(self, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
         """Check if a group has been authenticated after the timeout period."""
@@ -426,50 +1104,558 @@ class MediaDownloaderBot(object):
         # Check if group is still in the timer dict and not authenticated
         if str(chat_id) in self._group_auth_timers and not self._group_auth_timers[str(chat_id)]["authenticated"]:
             self.logger.info(
-                f"Group {chat_id} failed to authenticate in time. Leaving...")
+                "Group %s failed to authenticate in time. Leaving...", chat_id)
             try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text="⏰ Authentication timeout. Goodbye!"
-                )
+                try:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text="⏰ Authentication timeout. Goodbye!",
+                        **self._low_priority(),
+                    )
+                except Exception as e:
+                    # Leave anyway.
+                    self.logger.error("Error saying goodbye to group %s: %s", chat_id, e)
                 await context.bot.leave_chat(chat_id)
             except Exception as e:
-                self.logger.error(f"Error leaving group {chat_id}: {e}")
+                self.logger.error("Error leaving group %s: %s", chat_id, e)
             finally:
                 # Clean up
                 if str(chat_id) in self._group_auth_timers:
                     del self._group_auth_timers[str(chat_id)]
 
-    def _download_media(self, url: str, output_path: str = "./") -> None:
+    def _probe_media(self, url: str) -> MediaInfo:
+        """
+        Extract the metadata of the specified media without downloading it.
+
+        This blocks until the metadata has been extracted. Use `_probe` from async handlers.
+
+        :param url: URL of the Instagram reel or YouTube short to probe.
+        """
+        return probe_media(url, self._max_upload_size, postprocess_size=self._postprocess_size)
+
+    async def _probe(self, url: str, platform: str = "") -> MediaInfo:
+        """
+        Return the metadata of the specified media from the metadata cache, or probe it using the download worker pool.
+
+        Media that is rejected (because it is too large or restricted) is cached as well, so that further
+        requests for it are rejected without extracting it again.
+
+        :param url: canonical URL of the Instagram reel or YouTube short to probe.
+        :param platform: platform of the media, for metrics.
+        """
+        self._check_rejected(url)
+        cached: Optional[Union[MediaInfo, Exception]] = self._metadata_cache.get(url)
+        if cached is not None:
+            self._metrics.metadata_cache_hits.inc(platform=platform)
+            return cast(MediaInfo, cached)
+        self._metrics.metadata_cache_misses.inc(platform=platform)
+
+        if self._download_executor_type == "process":
+            probe: "Future[MediaInfo]" = self._download_executor.submit(
+                probe_media, url, self._max_upload_size, None, self._postprocess_size)
+        else:
+            probe = self._download_executor.submit(self._probe_media, url)
+
+        try:
+            info: MediaInfo = await asyncio.wrap_future(probe)
+        except Exception as ex:
+            raise self._download_error(ex, url, platform, "extract")
+
+        self._metrics.stage_duration.observe(info.extract_time, stage="extract", platform=platform)
+        self._metadata_cache.put(url, info)
+        return info
+
+    def _check_rejected(self, url: str) -> None:
+        """
+        Raise the reason for which the specified media was rejected, if it was rejected recently.
+
+        :param url: canonical URL of the media.
+        """
+        # Not `get`, so that checking doesn't count as a cache hit or refresh the entry.
+        entry = self._metadata_cache.peek(url)
+        if isinstance(entry, Exception):
+            # A copy, since concurrent requests raise it, too.
+            raise copy.copy(entry)
+
+    def _download_error(self, ex: Exception, url: str, platform: str, stage: str) -> Exception:
+        """
+        Count an error of a download (or probe), and remember the media as rejected if it can never be downloaded.
+
+        :return: the error to raise.
+        """
+        if not isinstance(ex, RestrictedMediaError) and classify_error(ex) == RESTRICTED:
+            ex = RestrictedMediaError(str(ex))
+        if isinstance(ex, (MediaTooLargeError, RestrictedMediaError)):
+            self._metadata_cache.put(url, ex)
+        else:
+            # E.g., the media's download URLs expired, so probe it again.
+            self._metadata_cache.pop(url)
+        self._metrics.errors.inc(stage=stage, platform=platform, error=type(ex).__name__)
+        return ex
+
+    def _download_media(self, url: str, directory: str = "./", info: Optional[MediaInfo] = None) -> DownloadResult:
+        """
+        Download the specified media into `MediaBuffer`s.
+
+        This blocks until the download completes. Use `_download_media_async` from async handlers.
+
+        :param url: URL of the Instagram reel or YouTube short to download.
+        :param directory: directory for media that doesn't fit in memory.
+        :param info: the media's metadata, if it was already probed.
         """
-        Download the specified media to the specified path.
+        result: DownloadResult = fetch_media(
+            url, directory, self._max_upload_size, self._spool_threshold, info=info, connections=self._download_connections,
+            postprocess_size=self._postprocess_size)
+        self.logger.debug('Download timings for URL "%s": %s', url, result.timings)
+        return result
+
+    async def _download_media_async(
+        self, url: str, directory: str = "./", platform: str = "", info: Optional[MediaInfo] = None
+    ) -> MediaItems:
+        """
+        Download the specified media into `MediaBuffer`s using the download worker pool.
 
         :param url: URL of the Instagram reel or YouTube short to download.
-        :param output_path: File path of downloaded file.
-        """
-        ydl_opts = {
-            'outtmpl': f'{output_path}',
-            'format': 'mp4',
-            'quiet': False,
-            'age_limit': 21,
-            'ignoreerrors': False,
-        }
+        :param directory: directory for media that doesn't fit in memory.
+        :param platform: platform of the media, for metrics.
+        :param info: the media's metadata, if it was already probed. Otherwise, the download extracts it.
+        """
+        if self._download_executor_type == "process":
+            # Bound methods can't be pickled, so the process pool runs the module-level function.
+            download: "Future[DownloadResult]" = self._download_executor.submit(
+                fetch_media, url, directory, self._max_upload_size, self._spool_threshold, None, info, self._download_connections,
+                self._postprocess_size)
+        elif info is None:
+            download = self._download_executor.submit(self._download_media, url, directory)
+        else:
+            download = self._download_executor.submit(self._download_media, url, directory, info)
+
+        try:
+            result = await asyncio.wrap_future(download)
+        except asyncio.CancelledError:
+            # A running download can't be interrupted, so release its media once it's done.
+            download.add_done_callback(_release_abandoned_download)
+            raise
+        except Exception as ex:
+            raise self._download_error(ex, url, platform, "download")
+
+        if isinstance(result, DownloadResult):
+            if info is None:
+                self._metrics.stage_duration.observe(result.timings.extract, stage="extract", platform=platform)
+            self._metrics.stage_duration.observe(result.timings.download, stage="download", platform=platform)
+            self._metrics.downloaded_bytes.inc(result.timings.size, platform=platform)
+
+        return result.items
+
+    async def _download_to_buffer(self, url: str, platform: str = "") -> MediaItems:
+        """
+        Download the specified media, keeping it in memory if it is small enough and in the scratch directory otherwise.
+
+        The media is probed first (see `_probe`), so that media that can't be sent is rejected before anything
+        is downloaded. Transient errors are retried with backoff (see `Resilience`). Once the media has been probed, its
+        estimated size (see `_reservation_size`) is reserved against the scratch quota before the download starts.
+        Videos that need it are post-processed (see `_postprocess`) once they have been downloaded.
+        Once the download is complete, the reservation shrinks to the space actually used, and it is
+        released when all of the media is.
+
+        :param url: URL of the Instagram reel or YouTube short to download.
+        :param platform: platform of the media, for metrics.
+        """
+        reservation: Optional[Reservation] = None
+        try:
+            info: Optional[MediaInfo] = None
+
+            async def probe_and_download() -> MediaItems:
+                nonlocal info, reservation
+                info = await self._probe(url, platform)
+                # Probing doesn't use any scratch space, so concurrent probes don't wait for each other's reservations.
+                if reservation is None:
+                    reservation = await self._scratch.reserve(self._reservation_size(info))
+                return await self._download_media_async(url, self._scratch.directory, platform, info)
+
+            items: MediaItems = await self._resilience.call(platform, probe_and_download)
+            if self._postprocessor is not None:
+                assert info is not None
+                items = await self._postprocess(url, items, info, platform)
+        except BaseException:
+            if reservation is not None:
+                reservation.release()
+            raise
+        assert reservation is not None
+
+        # Media held in memory doesn't use any scratch space.
+        reservation.resize(sum(media.size for media in items if not media.in_memory))
+        for media in items:
+            reservation.attach(media.path)
+
+        remaining: Set[int] = {id(media) for media in items}
+
+        def on_close(media: MediaBuffer) -> None:
+            remaining.discard(id(media))
+            if not remaining:
+                reservation.release()
+
+        for media in items:
+            media.add_close_callback(on_close)
+
+        self.logger.info('Successfully downloaded reel "%s" into %s.', url, items)
+        return items
+
+    def _reservation_size(self, info: MediaInfo) -> int:
+        """
+        Return the scratch space to reserve for downloading probed media: its estimated size, with a margin for
+        approximate sizes, or the largest possible download if the size is unknown.
+        """
+        if info.size is None:
+            return self._download_reservation
+        return min(self._download_reservation, int(info.size * RESERVATION_SIZE_MARGIN))
+
+    async def _postprocess(self, url: str, items: MediaItems, info: MediaInfo, platform: str = "") -> MediaItems:
+        """
+        Remux or re-encode the downloaded videos that Telegram can't stream or that are larger than the upload limit
+        (see `plan_postprocess`), using the post-processing pool. The media that is replaced is released.
+
+        :param url: canonical URL of the media.
+        :param items: the downloaded videos.
+        :param info: the media's probed metadata, with one entry per video.
+        :param platform: platform of the media, for metrics.
+
+        :raises MediaTooLargeError: if a video is too large and can't be re-encoded to fit.
+        """
+        assert self._postprocessor is not None
+        processed: List[MediaBuffer] = list(items)
+        try:
+            for i, media in enumerate(items):
+                entry: Dict[str, Any] = info.entries[i] if i < len(info.entries) else {}
+                action: Optional[str] = plan_postprocess(entry, media.size, self._max_upload_size)
+                if action is None:
+                    if media.size > self._max_upload_size:
+                        raise MediaTooLargeError(media.size, self._max_upload_size)
+                    continue
+
+                # The output is written next to the download, so it reserves space of its own while both exist.
+                reservation: Reservation = await self._scratch.reserve(self._max_upload_size)
+                job: PostprocessJob = self._postprocessor.submit(
+                    media, action, self._max_upload_size, entry.get("duration"), self._scratch.directory)
+                try:
+                    result: PostprocessResult = await asyncio.wrap_future(job.future)
+                except asyncio.CancelledError:
+                    job.cancel()
+                    raise
+                finally:
+                    reservation.release()
+
+                processed[i] = result.media
+                media.close()
+                self._metrics.stage_duration.observe(result.duration, stage="postprocess", platform=platform)
+                self._metrics.postprocess_cpu_seconds.inc(result.cpu_time, action=action, platform=platform)
+                self.logger.info(
+                    'Post-processed (%s) video %d of "%s" from %d to %d bytes in %.2fs, using %.2f CPU seconds.',
+                    action, i + 1, url, result.input_size, result.output_size, result.duration, result.cpu_time)
+        except asyncio.CancelledError:
+            self._release_media(tuple(processed) + items)
+            raise
+        except Exception as ex:
+            self._release_media(tuple(processed) + items)
+            raise self._download_error(ex, url, platform, "postprocess")
+
+        return tuple(processed)
+
+    def _max_upload_size_mb(self) -> int:
+        return self._max_upload_size // (1024 * 1024)
+
+    def _release_media(self, items: MediaItems) -> None:
+        """
+        Release the memory or files holding downloaded media, logging (rather than raising) any error.
+        """
+        with self._metrics.time_stage("cleanup"):
+            for media in items:
+                try:
+                    media.close()
+                except Exception as e:
+                    self.logger.error("Error: %s", e)
+
+    def _lookup_file_id(self, key: str, platform: str) -> Optional[str]:
+        """
+        Look up the file ID cache, counting the hit or miss.
+        """
+        file_id: Optional[str] = self._file_id_cache.get(key)
+        if file_id:
+            self._metrics.cache_hits.inc(platform=platform)
+        else:
+            self._metrics.cache_misses.inc(platform=platform)
+        return file_id
+
+    def _count_if_coalesced(self, key: str) -> None:
+        if key in self._in_flight_downloads:
+            self._metrics.coalesced.inc()
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            download_retcode = ydl.download([url])
-            self.logger.debug(
-                f'Download return code for URL "{url}": {download_retcode}')
+    def _record_delivery(self, platform: str, media: Optional[MediaBuffer] = None, source: str = "") -> None:
+        """
+        Count a video that was successfully sent to a chat.
 
+        :param media: the uploaded media, if the video was uploaded rather than re-sent by file ID.
+        :param source: how the video was sent. Defaults to "upload" if `media` is given and "cache" otherwise.
+        """
         self._num_downloads += 1
+        if self._store:
+            self._store.set_counter("num_downloads", self._num_downloads)
+
+        deduplicated: bool = media is not None and media in self._deduplicated
+        source = source or ("content" if deduplicated else "upload" if media is not None else "cache")
+        self._metrics.deliveries.inc(platform=platform, source=source)
+        if isinstance(media, MediaBuffer) and not deduplicated:
+            self._metrics.uploaded_bytes.inc(media.size, platform=platform)
+
+    async def _acquire_media(
+        self,
+        media_urls: List[MediaUrl],
+        chat_id: str,
+        user_id: str,
+        stack: AsyncExitStack,
+        delete_after_reply: bool = True,
+    ) -> List[Union[MediaItems, Exception]]:
+        """
+        Download the media at every URL concurrently. Each download stays acquired until `stack` is closed.
+
+        :return: the downloaded media or the error for each URL, in order.
+        """
+        async def acquire(media_url: MediaUrl) -> MediaItems:
+            # Don't queue downloads from a platform that is failing.
+            self._resilience.check(media_url.platform)
+            self._check_rejected(media_url.canonical_url)
+            # Concurrent requests for the same media share a single download.
+            self._count_if_coalesced(media_url.key)
+            return await stack.enter_async_context(self._in_flight_downloads.acquire(
+                media_url.key,
+                lambda: self._scheduler.submit(
+                    chat_id, user_id, lambda: self._download_to_buffer(media_url.canonical_url, media_url.platform)),
+                release=self._release_media if delete_after_reply else None
+            ))
+
+        results = await asyncio.gather(*[acquire(media_url) for media_url in media_urls], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+        return results
+
+    async def _run_job(
+        self,
+        media_url: MediaUrl,
+        chat_id: str,
+        user_id: str,
+        reply_to_message_id: Optional[int] = None,
+    ) -> Tuple[JobResult, bool]:
+        """
+        Have a download worker download the media and send it to `chat_id` (split mode).
+
+        Concurrent requests for the same media share a single job, whose videos are sent to the chat of
+        the request that started it.
+
+        :return: the job's result, and whether the videos were sent to `chat_id` (rather than another chat).
+        :raises: the error that failed the job, or `asyncio.TimeoutError` if no worker completed it in time.
+        """
+        assert self._jobs is not None
+        jobs: JobDispatcher = self._jobs
+        job: Job = Job.create(media_url.canonical_url, media_url.platform, chat_id, user_id, reply_to_message_id, jobs.consumer)
+
+        if media_url.key in self._in_flight_jobs:
+            self._metrics.coalesced.inc()
+        async with self._in_flight_jobs.acquire(media_url.key, lambda: jobs.submit(job)) as result:
+            pass
+
+        if result.failed:
+            raise result.error()
+        return result, result.job_id == job.id
+
+    async def _delegate_download(self, media_url: MediaUrl, update: Update) -> None:
+        """
+        Reply to the message with the media at `media_url`, downloaded and sent by a download worker (split mode).
+        """
+        assert update.message
+        assert update.effective_chat
+        assert update.effective_user
+        message: Message = update.message
+
+        try:
+            result, own_job = await self._run_job(
+                media_url, str(update.effective_chat.id), str(update.effective_user.id), message.message_id)
+            if not own_job:
+                # The worker sent the videos to the chat that requested them first, so re-send them here by file ID.
+                await self._send_videos(
+                    list(result.file_ids),
+                    functools.partial(message.reply_video, reply_to_message_id=message.message_id),
+                    functools.partial(message.reply_media_group, reply_to_message_id=message.message_id),
+                    media_url.platform,
+                )
+        except ShuttingDownError:
+            self.logger.info('Stopped waiting for the job for "%s", which a worker will still deliver.', media_url.canonical_url)
+            return
+        except Exception as ex:
+            await self._reply_download_error(update, media_url.canonical_url, ex)
+            return
+
+        for _ in result.file_ids:
+            self._record_delivery(media_url.platform, source="worker" if own_job else "cache")
+        self._put_file_id(media_url.key, ",".join(result.file_ids))
+
+    async def process_job(self, job: Job, bot: Bot, job_queue: Optional[JobQueue] = None) -> JobResult:
+        """
+        Download the media of a job from the job queue and send it to the job's chat (run by download workers).
+
+        :param bot: the bot with which the videos are sent.
+        :param job_queue: the queue the job was taken from. If given, the media of jobs that the frontend cancelled
+                          (because it stopped waiting for them) isn't sent.
+        :return: the job's result. Errors are returned rather than raised, so that they reach the frontend.
+        """
+        async def check_cancelled() -> None:
+            if job_queue is not None and await asyncio.to_thread(job_queue.cancelled, job):
+                raise JobFailedError(f'Job "{job.id}" was cancelled')
 
-        self.logger.debug(f'Created file: "{output_path}"')
+        try:
+            self._resilience.check(job.platform)
+            self._check_rejected(job.url)
+            await check_cancelled()
+            items: MediaItems = await self._scheduler.submit(
+                job.chat_id, job.user_id, lambda: self._download_to_buffer(job.url, job.platform))
+            try:
+                await check_cancelled()
+                messages: List[Message] = await self._send_videos(
+                    list(items),
+                    functools.partial(bot.send_video, chat_id=job.chat_id, reply_to_message_id=job.reply_to_message_id),
+                    functools.partial(bot.send_media_group, chat_id=job.chat_id, reply_to_message_id=job.reply_to_message_id),
+                    job.platform,
+                )
+                for media in items:
+                    if media in self._deduplicated:
+                        self._metrics.deliveries.inc(platform=job.platform, source="content")
+                        continue
+                    self._metrics.deliveries.inc(platform=job.platform, source="upload")
+                    self._metrics.uploaded_bytes.inc(media.size, platform=job.platform)
+            finally:
+                self._release_media(items)
+        except Exception as ex:
+            self.logger.warning('Job "%s" for "%s" failed: %s', job.id, job.url, ex)
+            return JobResult.failure(job.id, ex)
+
+        file_ids: str = self._join_file_ids(messages)
+        self.logger.info('Completed job "%s" for "%s" in %.2fs.', job.id, job.url, time.time() - job.created_at)
+        return JobResult(job.id, tuple(file_ids.split(",")) if file_ids else (), tuple(message.message_id for message in messages))
+
+    async def _send_videos(
+        self,
+        videos: List[Video],
+        send_video: Callable[..., Awaitable[Message]],
+        send_media_group: Callable[..., Awaitable[Sequence[Message]]],
+        platform: str = "",
+    ) -> List[Message]:
+        """
+        Send videos as media groups of up to `MAX_MEDIA_GROUP_SIZE` videos, or as a single video if there is only one.
+
+        Downloaded media that is identical to media that has already been uploaded (even from another URL) is
+        sent by that media's file ID instead. The file IDs of uploaded media are cached by content for this.
 
-    async def _handle_download_request(self, text: str, update: Update, delete_after_reply: bool = True) -> Optional[str]:
+        :param videos: Telegram file IDs or downloaded media, in the order in which to send them.
+        :param send_video: sends one video, e.g., `Message.reply_video`.
+        :param send_media_group: sends a media group, e.g., `Message.reply_media_group`.
+        :param platform: platform of the media, for metrics.
+
+        :return: the sent messages, one per video.
+        """
+        messages: List[Message] = []
+        with self._metrics.time_stage("upload", platform):
+            for start in range(0, len(videos), MAX_MEDIA_GROUP_SIZE):
+                group: List[Video] = videos[start:start + MAX_MEDIA_GROUP_SIZE]
+                unhashed: List[MediaBuffer] = [video for video in group if isinstance(video, MediaBuffer) and not video.hashed]
+                if unhashed:
+                    # Hashing media that was written by someone else (e.g., yt-dlp) reads its file.
+                    await asyncio.to_thread(lambda media_list=unhashed: [media.sha256 for media in media_list])
+                deduplicated: List[Video] = [self._content_file_id(video) or video for video in group]
+                try:
+                    sent: List[Message] = await self._send_group(deduplicated, send_video, send_media_group)
+                except Exception as ex:
+                    if all(video is original for video, original in zip(deduplicated, group)):
+                        raise
+                    # The file IDs may be stale, so upload the media itself.
+                    self.logger.error("Failed to send media by the file ID of identical media: %s", ex)
+                    for video in group:
+                        if isinstance(video, MediaBuffer):
+                            self._evict_file_id(self._content_key(video.sha256))
+                    deduplicated = group
+                    sent = await self._send_group(group, send_video, send_media_group)
+                messages.extend(sent)
+
+                for original, video, message in zip(group, deduplicated, sent):
+                    if isinstance(original, str):
+                        continue
+                    if isinstance(video, str):
+                        self._deduplicated.add(original)
+                        self._metrics.content_dedup_hits.inc(platform=platform)
+                    else:
+                        self._put_file_id(self._content_key(original.sha256), self._join_file_ids([message]))
+        return messages
+
+    @staticmethod
+    async def _send_group(
+        videos: List[Video],
+        send_video: Callable[..., Awaitable[Message]],
+        send_media_group: Callable[..., Awaitable[Sequence[Message]]],
+    ) -> List[Message]:
+        """
+        Send up to `MAX_MEDIA_GROUP_SIZE` videos as a media group, or as a single video if there is only one.
+        """
+        with ExitStack() as readers:
+            inputs = [video if isinstance(video, str) else readers.enter_context(video.open()) for video in videos]
+            if len(inputs) == 1:
+                return [await send_video(video=inputs[0])]
+            return list(await send_media_group(media=[InputMediaVideo(media=video) for video in inputs]))
+
+    async def _reply_download_error(self, update: Update, url: str, ex: Exception) -> None:
+        """
+        Tell the user why the media at `url` could not be sent.
+        """
+        assert update.message
+        if isinstance(ex, ShuttingDownError):
+            self.logger.warning('Rejected download of "%s": %s', url, ex)
+            await update.message.reply_text("🔄 I'm restarting right now. Please send the link again in a minute.",
+                                            reply_to_message_id=update.message.message_id)
+        elif isinstance(ex, QueueFullError):
+            self.logger.warning('Rejected download of "%s": %s', url, ex)
+            await update.message.reply_text("⏳ I'm busy right now. Please try again in a minute.",
+                                            reply_to_message_id=update.message.message_id)
+        elif isinstance(ex, MediaTooLargeError):
+            self.logger.warning('Rejected download of "%s": %s', url, ex)
+            await update.message.reply_text(f"⚠️ The requested video is larger than {self._max_upload_size_mb()} MB, which is too large to send on Telegram. Sorry!",
+                                            reply_to_message_id=update.message.message_id)
+        elif isinstance(ex, CircuitOpenError):
+            self.logger.warning('Rejected download of "%s": %s', url, ex)
+            await update.message.reply_text(f"🚧 Downloads from {ex.platform} are failing right now, so I've paused them. Please try again in {ex.retry_after:.0f} seconds.",
+                                            reply_to_message_id=update.message.message_id)
+        else:
+            self.logger.error('Failed to download video at URL "%s"', url, exc_info=ex)
+
+            if isinstance(ex, RestrictedMediaError):
+                await update.message.reply_text(f"⚠️ Failed to download the requested video. Video is age restricted, and downloading age restricted videos is not supported at this time. Sorry!",
+                                                reply_to_message_id=update.message.message_id)
+            else:
+                await update.message.reply_text(f"⚠️ Failed to download the requested video. Sorry!",
+                                                reply_to_message_id=update.message.message_id)
+
+    async def _handle_download_request(self, text: str, update: Update, delete_after_reply: bool = True) -> List[MediaBuffer]:
         """
         Generic handler for messages and download commands.
+
+        Every supported URL in `text` is downloaded concurrently, and all of the videos (including every
+        video of a carousel) are sent in a single media group.
+
+        :return: the media that was downloaded (rather than re-sent from the file ID cache).
         """
+        with self._track_request():
+            return await self._process_download_request(text, update, delete_after_reply)
+
+    async def _process_download_request(self, text: str, update: Update, delete_after_reply: bool = True) -> List[MediaBuffer]:
         if not update.message or not update.message.text:
-            return
+            return []
 
         assert update.effective_chat
         assert update.effective_user
@@ -479,45 +1665,95 @@ class MediaDownloaderBot(object):
 
         if self._password and str(update.effective_chat.id) not in self._authenticated_chats:
             self.logger.info(
-                f'Unauthenticated chat: "{update.effective_chat.id}"')
-            return
-
-        for prefix in MediaDownloaderBot.valid_url_prefixes:
-            if prefix in text:
-                try:
-                    # Download the video
-                    video_path = f"./{str(uuid.uuid4())}.mp4"
-                    self.logger.info(
-                        f'Will save reel to file "{video_path}"\n')
-                    self._download_media(text, output_path=video_path)
-                    self.logger.info(
-                        f'Successfully downloaded Instagram reel "{text}" to file "{video_path}".\n\n')
-                except Exception as ex:
-                    self.logger.error(
-                        f'Failed to download video at URL "{text}"')
-                    self.logger.error(ex)
-                    self.logger.error(traceback.format_exc())
-
-                    if "Restricted Video" in str(ex):
-                        await update.message.reply_text(f"⚠️ Failed to download the requested video. Video is age restricted, and downloading age restricted videos is not supported at this time. Sorry!",
-                                                        reply_to_message_id=update.message.message_id)
+                'Unauthenticated chat: "%s"', update.effective_chat.id)
+            return []
+
+        with self._metrics.time_stage("classify"):
+            media_urls: List[MediaUrl] = find_media_urls(text)
+        if not media_urls:
+            return []
+
+        if not self._accepting:
+            await self._reply_download_error(update, media_urls[0].canonical_url, ShuttingDownError("The bot is shutting down"))
+            return []
+
+        chat_id: str = str(update.effective_chat.id)
+        user_id: str = str(update.effective_user.id)
+        platforms: Set[str] = {media_url.platform for media_url in media_urls}
+        platform: str = platforms.pop() if len(platforms) == 1 else "mixed"
+
+        # Media that has already been uploaded can be re-sent by file ID without downloading it again.
+        cached: Dict[str, List[str]] = {}
+        for media_url in media_urls:
+            cached_file_ids: Optional[str] = self._lookup_file_id(media_url.key, media_url.platform)
+            if cached_file_ids:
+                cached[media_url.key] = cached_file_ids.split(",")
+
+        if self._jobs is not None:
+            # In split mode, the workers reply with the media that isn't cached.
+            delegated: List[MediaUrl] = [media_url for media_url in media_urls if media_url.key not in cached]
+            await asyncio.gather(*[self._delegate_download(media_url, update) for media_url in delegated])
+            media_urls = [media_url for media_url in media_urls if media_url.key in cached]
+            if not media_urls:
+                return []
+
+        downloaded: Dict[str, MediaItems] = {}
+        async with AsyncExitStack() as stack:
+            # If re-sending a cached file ID fails, the cached media is downloaded and sent once more.
+            for attempt in range(2):
+                pending: List[MediaUrl] = [media_url for media_url in media_urls
+                                           if media_url.key not in cached and media_url.key not in downloaded]
+                results = await self._acquire_media(pending, chat_id, user_id, stack, delete_after_reply)
+                for media_url, result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        await self._reply_download_error(update, media_url.canonical_url, result)
                     else:
-                        await update.message.reply_text(f"⚠️ Failed to download the requested video. Sorry!",
-                                                        reply_to_message_id=update.message.message_id)
+                        downloaded[media_url.key] = result
 
-                    return None
+                ready: List[MediaUrl] = [media_url for media_url in media_urls
+                                         if media_url.key in cached or media_url.key in downloaded]
+                if not ready:
+                    return []
 
+                videos: List[List[Video]] = [list(cached.get(media_url.key) or downloaded[media_url.key]) for media_url in ready]
                 try:
-                    await update.message.reply_video(video=open(video_path, 'rb'), reply_to_message_id=update.message.message_id)
+                    messages: List[Message] = await self._send_videos(
+                        [video for group in videos for video in group],
+                        functools.partial(update.message.reply_video, reply_to_message_id=update.message.message_id),
+                        functools.partial(update.message.reply_media_group, reply_to_message_id=update.message.message_id),
+                        platform,
+                    )
                 except Exception as e:
-                    self.logger.error(f"Error: {e}")
-                    return None
+                    stale: List[MediaUrl] = [media_url for media_url in ready if media_url.key in cached]
+                    if not stale or attempt:
+                        self.logger.error("Error: %s", e)
+                        return []
+
+                    for media_url in stale:
+                        self.logger.error('Failed to re-send cached file ID for "%s": %s', media_url.canonical_url, e)
+                        self._evict_file_id(media_url.key)
+                        del cached[media_url.key]
+                    continue
+
+                offset: int = 0
+                for media_url, group in zip(ready, videos):
+                    for video in group:
+                        self._record_delivery(media_url.platform, video if isinstance(video, MediaBuffer) else None)
+                    if media_url.key in cached:
+                        self.logger.info('Replied to "%s" from the file ID cache.', media_url.canonical_url)
+                    else:
+                        self._put_file_id(media_url.key, self._join_file_ids(messages[offset:offset + len(group)]))
+                    offset += len(group)
+                break
+
+        return [media for items in downloaded.values() for media in items]
 
-                try:
-                    if delete_after_reply:
-                        os.remove(video_path)
-                except Exception as e:
-                    self.logger.error(f"Error: {e}")
-                    return video_path
 
-                return video_path
+def _release_abandoned_download(download: "Future[DownloadResult]") -> None:
+    """
+    Release the media of a download whose requester gave up on it, e.g., because the bot is shutting down.
+    """
+    if download.cancelled() or download.exception() is not None:
+        return
+    for media in download.result().items:
+        media.close()
@@ -0,0 +1,231 @@
+"""
+Spooled buffers that hold downloaded media between the download and the upload.
+
+Short clips stay in memory and are uploaded straight from it. Only media larger than
+the spool threshold is written to disk.
+
+Every buffer hashes its bytes as they are written, so that identical media downloaded from
+different URLs can be recognized without reading it again. Files written by someone else (e.g.,
+yt-dlp) are hashed in the same read that loads them into memory if they are small, and otherwise
+on first use of the hash.
+"""
+import hashlib
+import io
+import os
+import uuid
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+
+# Media up to this size (in bytes) is kept in memory.
+DEFAULT_SPOOL_THRESHOLD: int = 16 * 1024 * 1024
+
+# Size of the reads with which files written by someone else are hashed.
+_HASH_CHUNK_SIZE: int = 1024 * 1024
+
+
+class MediaBuffer(object):
+    """
+    The bytes of one downloaded video. They are kept in memory up to `spool_threshold` bytes and spill
+    to a uniquely-named file in `directory` beyond that.
+
+    Unlike `tempfile.SpooledTemporaryFile`, every reader gets its own handle from `open()`, so one buffer
+    can be uploaded to several chats concurrently. Once writing is finished, a buffer can be pickled,
+    e.g., to return it from a process pool.
+
+    :param directory: directory in which to create the file if the buffer spills to disk.
+    :param spool_threshold: maximum number of bytes to keep in memory.
+    :param suffix: file name suffix, used for the spill file and the file name reported to Telegram.
+    """
+
+    def __init__(self, directory: str = "./", spool_threshold: int = DEFAULT_SPOOL_THRESHOLD, suffix: str = ".mp4"):
+        self._directory: str = directory
+        self._spool_threshold: int = spool_threshold
+        self._suffix: str = suffix
+
+        self._memory: Optional[bytearray] = bytearray()
+        self._data: Optional[bytes] = None
+        self._path: Optional[str] = None
+        self._file: Optional[BinaryIO] = None
+        self._size: int = 0
+        self._hash: Optional["hashlib._Hash"] = hashlib.sha256()
+        self._sha256: Optional[str] = None
+        self._closed: bool = False
+        self._close_callbacks: List[Callable[["MediaBuffer"], None]] = []
+
+    @classmethod
+    def from_file(cls, path: str, spool_threshold: int = 0) -> "MediaBuffer":
+        """
+        Take over a file that was written by someone else, e.g., yt-dlp.
+
+        A file of up to `spool_threshold` bytes is read into memory, and hashed in the same read, and then removed.
+        A larger file is kept, and removed when the buffer is closed. It is only read to hash it when `sha256` is
+        first used, e.g., not at all if it is replaced by a post-processed copy first.
+
+        Call this from a worker thread rather than the event loop, as it may read the file.
+        """
+        directory, name = os.path.split(path)
+        buffer = cls(directory or "./", spool_threshold=spool_threshold, suffix=os.path.splitext(name)[1])
+        size: int = os.path.getsize(path) if os.path.exists(path) else 0
+        if 0 < size <= spool_threshold:
+            with open(path, "rb") as f:
+                buffer.write(f.read())
+            buffer.finish()
+            os.remove(path)
+            return buffer
+
+        buffer._memory = None
+        buffer._path = path
+        buffer._size = size
+        # Hashed on demand, by `sha256`.
+        buffer._hash = None
+        buffer.finish()
+        return buffer
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def path(self) -> Optional[str]:
+        """
+        The path of the file backing this buffer, or None if it is held in memory.
+        """
+        return self._path
+
+    @property
+    def hashed(self) -> bool:
+        """
+        Whether `sha256` is known without reading the file (see `from_file`).
+        """
+        return self._sha256 is not None or self._hash is not None
+
+    @property
+    def sha256(self) -> str:
+        """
+        The hex SHA-256 digest of the media. Finishes writing, like `open()`.
+
+        Unless the buffer is `hashed`, this reads the file, so use it from a worker thread then.
+        """
+        self.finish()
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            with self.open() as reader:
+                while True:
+                    chunk: bytes = reader.read(_HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    @property
+    def in_memory(self) -> bool:
+        return self._path is None
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def write(self, data: bytes) -> None:
+        if self._closed:
+            raise ValueError("write to a closed MediaBuffer")
+
+        if self._memory is not None and self._size + len(data) > self._spool_threshold:
+            self._spill()
+
+        if self._memory is not None:
+            self._memory += data
+        else:
+            if self._file is None:
+                raise ValueError("write to a finished MediaBuffer")
+            self._file.write(data)
+
+        assert self._hash is not None
+        self._hash.update(data)
+        self._size += len(data)
+
+    def _spill(self) -> None:
+        assert self._memory is not None
+        self._path = os.path.join(self._directory, f"{uuid.uuid4()}{self._suffix}")
+        self._file = open(self._path, "xb")
+        self._file.write(self._memory)
+        self._memory = None
+
+    def finish(self) -> None:
+        """
+        Finish writing. Called implicitly by `open()`.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._memory is not None:
+            self._data = bytes(self._memory)
+            self._memory = None
+        if self._hash is not None:
+            self._sha256 = self._hash.hexdigest()
+            # Hash objects can't be pickled.
+            self._hash = None
+
+    def open(self) -> BinaryIO:
+        """
+        Open a new, independent reader. The caller is responsible for closing it.
+        """
+        if self._closed:
+            raise ValueError("I/O operation on a closed MediaBuffer")
+
+        self.finish()
+        if self._data is not None:
+            # Sharing the immutable bytes avoids copying them for every reader.
+            reader: BinaryIO = io.BytesIO(self._data)
+            # Telegram uses the name to guess the file type.
+            reader.name = f"video{self._suffix}"  # type: ignore[attr-defined]
+            return reader
+
+        assert self._path
+        return open(self._path, "rb")
+
+    def close(self) -> None:
+        """
+        Release the memory or remove the file backing this buffer. Readers that are already open
+        remain usable until they are closed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = None
+        self._data = None
+
+        try:
+            if self._path is not None and os.path.exists(self._path):
+                os.remove(self._path)
+        finally:
+            callbacks, self._close_callbacks = self._close_callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def add_close_callback(self, callback: Callable[["MediaBuffer"], None]) -> None:
+        """
+        Call `callback(buffer)` once the buffer has been closed, or immediately if it already is.
+        """
+        if self._closed:
+            callback(self)
+        else:
+            self._close_callbacks.append(callback)
+
+    def __enter__(self) -> "MediaBuffer":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.finish()
+        # Callbacks belong to the process that registered them.
+        return {**self.__dict__, "_close_callbacks": []}
+
+    def __repr__(self) -> str:
+        where: str = "memory" if self.in_memory else f'"{self._path}"'
+        return f"MediaBuffer({self._size} bytes in {where})"
@@ -0,0 +1,112 @@
+"""
+In-memory caches.
+"""
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Optional, Tuple, TypeVar
+
+DEFAULT_FILE_ID_CACHE_SIZE: int = 1024
+DEFAULT_FILE_ID_CACHE_TTL: float = 7 * 24 * 60 * 60  # seconds
+
+# Probed metadata holds the media's download URLs, which the platforms expire after a while.
+DEFAULT_METADATA_CACHE_SIZE: int = 256
+DEFAULT_METADATA_CACHE_TTL: float = 10 * 60  # seconds
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    Size-bounded LRU cache whose entries expire after a fixed time-to-live.
+
+    :param max_size: maximum number of entries. The least recently used entry is evicted when full.
+    :param ttl: number of seconds after which an entry expires.
+    :param clock: returns the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_FILE_ID_CACHE_SIZE,
+        ttl: float = DEFAULT_FILE_ID_CACHE_TTL,
+        clock: Callable[[], float] = time.time
+    ):
+        if max_size < 1:
+            raise ValueError(f"max_size must be at least 1, got {max_size}")
+
+        self._max_size: int = max_size
+        self._ttl: float = ttl
+        self._clock: Callable[[], float] = clock
+
+        # Maps key -> (value, expiry time), ordered from least to most recently used.
+        self._entries: "OrderedDict[str, Tuple[V, float]]" = OrderedDict()
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > self._clock()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl
+
+    def get(self, key: str) -> Optional[V]:
+        """
+        Return the cached value for the specified key, or None if it is missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: str) -> Optional[V]:
+        """
+        Like `get`, but without counting a hit or a miss, or marking the entry as recently used.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= self._clock():
+            return None
+        return entry[0]
+
+    def put(self, key: str, value: V, expires_at: Optional[float] = None) -> None:
+        """
+        Insert or replace the value for the specified key.
+
+        :param expires_at: explicit expiry time. Defaults to now + ttl.
+        """
+        if expires_at is None:
+            expires_at = self._clock() + self._ttl
+
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str) -> Optional[V]:
+        """
+        Remove the specified key, returning its value if it was present.
+        """
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self) -> None:
+        self._entries.clear()
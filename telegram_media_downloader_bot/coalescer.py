@@ -0,0 +1,93 @@
+"""
+In-flight request deduplication.
+
+When the same media is requested several times while it is still being downloaded,
+only the first request performs the download. Later requests wait on the same task
+and receive the same result (or the same exception).
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _InFlight(Generic[T]):
+    def __init__(self, task: "asyncio.Task[T]", release: Optional[Callable[[T], None]]):
+        self.task: "asyncio.Task[T]" = task
+        self.release: Optional[Callable[[T], None]] = release
+        self.holders: int = 0
+
+
+class RequestCoalescer(Generic[T]):
+    """
+    Coalesces concurrent requests that share a key into a single task.
+
+    The result stays shared for as long as at least one requester holds it. Once the
+    last holder is done, the optional `release` callback supplied by the first requester
+    is invoked with the result (e.g., to delete a downloaded file).
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, _InFlight[T]] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._in_flight
+
+    def holders(self, key: str) -> int:
+        """
+        Return the number of requesters currently holding the result for the specified key.
+        """
+        entry = self._in_flight.get(key)
+        return entry.holders if entry else 0
+
+    @asynccontextmanager
+    async def acquire(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[T]],
+        release: Optional[Callable[[T], None]] = None
+    ) -> AsyncIterator[T]:
+        """
+        Join the in-flight task for `key`, starting it with `factory` if there is none.
+
+        :param key: the deduplication key (e.g., a normalized URL).
+        :param factory: creates the awaitable to run if no task is in flight for `key`.
+        :param release: called with the result once the last holder is done with it.
+                        Only the callback of the requester that started the task is used.
+        """
+        entry = self._in_flight.get(key)
+        if entry is None:
+            entry = _InFlight(asyncio.ensure_future(factory()), release)
+            self._in_flight[key] = entry
+
+        entry.holders += 1
+        try:
+            # Shield the shared task so that one cancelled requester doesn't cancel it for everyone.
+            yield await asyncio.shield(entry.task)
+        finally:
+            entry.holders -= 1
+            if entry.holders == 0:
+                self._finish(key, entry)
+
+    def _finish(self, key: str, entry: _InFlight[T]) -> None:
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+
+        if entry.task.done():
+            self._release(entry)
+        else:
+            # Every requester gave up before the task finished.
+            entry.task.add_done_callback(lambda _: self._release(entry))
+            entry.task.cancel()
+
+    @staticmethod
+    def _release(entry: _InFlight[T]) -> None:
+        task = entry.task
+        if task.cancelled() or task.exception() is not None or entry.release is None:
+            return
+
+        entry.release(task.result())
@@ -0,0 +1,406 @@
+"""
+Helpers for running yt-dlp downloads outside of the asyncio event loop.
+
+yt-dlp is entirely synchronous, so every download is handed to a bounded
+worker pool. The pool size caps the number of concurrent downloads.
+
+Importing yt-dlp and its extractors takes a noticeable share of the bot's start-up time, so it
+is only imported by the first download, or by `warm_up` in the background once the bot is running.
+"""
+import copy
+import os
+import tempfile
+import time
+import uuid
+from contextlib import closing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from telegram_media_downloader_bot.buffer import DEFAULT_SPOOL_THRESHOLD, MediaBuffer
+from telegram_media_downloader_bot.errors import MediaTooLargeError
+from telegram_media_downloader_bot.parallel import DEFAULT_MAX_CONNECTIONS, RANGE_CHUNK_SIZE, STREAM_CHUNK_SIZE, connection_budget, fetch_ranges
+from telegram_media_downloader_bot.ydl_pool import DEFAULT_YDL_MAX_USES, YoutubeDLPool, set_output_path
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+DEFAULT_DOWNLOAD_WORKERS: int = 4
+
+# Maximum size of a file that a bot may upload via the Bot API.
+DEFAULT_MAX_UPLOAD_SIZE: int = 50 * 1024 * 1024  # bytes
+
+EXECUTOR_TYPES: List[str] = ["thread", "process"]
+
+# Telegram sends at most this many videos in one media group, so longer playlists are truncated.
+MAX_MEDIA_GROUP_SIZE: int = 10
+
+# Formats served over these protocols are a single file that can be streamed straight into a buffer.
+STREAMABLE_PROTOCOLS: Tuple[str, ...] = ("http", "https")
+
+# Extractors of the supported platforms, which `warm_up` initializes ahead of the first download.
+WARM_UP_EXTRACTORS: Tuple[str, ...] = ("Youtube", "Instagram")
+
+# Warm YoutubeDL instances shared by the downloads in this process (i.e., by each worker process,
+# or by all worker threads).
+ydl_pool: YoutubeDLPool = YoutubeDLPool()
+
+
+def configure_ydl_pool(max_uses: int = DEFAULT_YDL_MAX_USES, max_connections: int = DEFAULT_MAX_CONNECTIONS) -> None:
+    """
+    Configure this process' YoutubeDL pool and connection budget. Used as the initializer of download worker processes.
+    """
+    ydl_pool.max_uses = max_uses
+    connection_budget.resize(max_connections)
+
+
+class DownloadTimings(NamedTuple):
+    """
+    Timings (in seconds) and size of a completed download.
+    """
+    extract: float
+    download: float
+    size: int
+
+
+class MediaInfo(NamedTuple):
+    """
+    What a probe learned about the media at a URL, without downloading it.
+
+    Rejections aren't part of it: probing raises `MediaTooLargeError` for media that can't fit, and
+    yt-dlp's error for restricted media.
+    """
+    # The videos (more than one for a carousel), each with its format selected. `fetch_media` downloads these.
+    entries: Tuple[Dict[str, Any], ...]
+    # Total duration of the videos in seconds, if known.
+    duration: Optional[float]
+    # Estimated total size of the videos in bytes, if known for all of them.
+    size: Optional[int]
+    # Seconds spent extracting the metadata.
+    extract_time: float
+
+
+class DownloadResult(NamedTuple):
+    """
+    The downloaded videos (more than one for, e.g., an Instagram carousel) and how long they took to download.
+    """
+    items: Tuple[MediaBuffer, ...]
+    timings: DownloadTimings
+
+
+def estimate_size(fmt: Dict[str, Any]) -> Optional[int]:
+    """
+    Return the exact or approximate size of a yt-dlp format in bytes, if known.
+
+    yt-dlp fills in `filesize_approx` from the bitrate and duration when the exact size is unknown.
+    """
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    return int(size) if size else None
+
+
+class SizeLimitedFormatSelector(object):
+    """
+    yt-dlp format selector that picks the best single-file mp4 format that fits within a byte budget.
+
+    It is passed as yt-dlp's `format` option, so it runs on the extracted metadata before anything is
+    downloaded. If every candidate format is known to be too large, `MediaTooLargeError` is raised and
+    the download never starts. Formats of unknown size are only used when nothing is known to fit.
+
+    With a `postprocess_size`, formats that can be post-processed to fit (see `postprocess`) are picked
+    when no mp4 format fits as it is: first the best format in another container that fits, then the
+    smallest format up to `postprocess_size` bytes, which is re-encoded.
+
+    :param max_size: the byte budget.
+    :param postprocess_size: the size up to which formats may be picked to be post-processed. 0 disables this.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_UPLOAD_SIZE, postprocess_size: int = 0):
+        self.max_size: int = max_size
+        self.postprocess_size: int = postprocess_size
+
+    def __repr__(self) -> str:
+        # YoutubeDL instances are pooled by the repr of their options.
+        return f"{type(self).__name__}(max_size={self.max_size}, postprocess_size={self.postprocess_size})"
+
+    def __call__(self, ctx: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        # yt-dlp sorts formats from worst to best. Like the "mp4" format spec, only consider formats
+        # served as a single file, i.e., formats that aren't known to lack audio or video.
+        single_file: List[Dict[str, Any]] = [
+            fmt for fmt in ctx["formats"] if fmt.get("vcodec") != "none" and fmt.get("acodec") != "none"
+        ]
+        candidates: List[Dict[str, Any]] = [fmt for fmt in single_file if fmt.get("ext") == "mp4"]
+        # Other containers can only be sent once they have been remuxed into mp4.
+        others: List[Dict[str, Any]] = [fmt for fmt in single_file if fmt.get("ext") != "mp4"] if self.postprocess_size else []
+        if not candidates and not others:
+            return
+
+        def fitting(formats: List[Dict[str, Any]], max_size: int) -> List[Dict[str, Any]]:
+            return [fmt for fmt in formats if (estimate_size(fmt) or max_size + 1) <= max_size]
+
+        def unknown(formats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            return [fmt for fmt in formats if estimate_size(fmt) is None]
+
+        for choices in (
+            fitting(candidates, self.max_size),
+            unknown(candidates),
+            fitting(others, self.max_size),
+            # The smallest one takes the least re-encoding to fit.
+            sorted(fitting(candidates + others, self.postprocess_size), key=estimate_size, reverse=True),
+            unknown(others),
+        ):
+            if choices:
+                yield choices[-1]
+                return
+
+        sizes: List[Optional[int]] = [estimate_size(fmt) for fmt in candidates + others]
+        raise MediaTooLargeError(min(size for size in sizes if size is not None), self.max_size)
+
+
+def build_ydl_opts(output_path: str, max_size: int = DEFAULT_MAX_UPLOAD_SIZE, postprocess_size: int = 0) -> Dict[str, Any]:
+    """
+    Build the yt-dlp options used for a single download.
+
+    :param output_path: File path of downloaded file.
+    :param max_size: maximum size of the downloaded file in bytes.
+    :param postprocess_size: maximum size of a file that is post-processed to fit within `max_size` (see
+                             `SizeLimitedFormatSelector`). 0 disables post-processing.
+    """
+    return {
+        'outtmpl': f'{output_path}',
+        'format': SizeLimitedFormatSelector(max_size, postprocess_size),
+        'playlistend': MAX_MEDIA_GROUP_SIZE,
+        'quiet': False,
+        'age_limit': 21,
+        'ignoreerrors': False,
+    }
+
+
+def probe_media(
+    url: str,
+    max_size: int = DEFAULT_MAX_UPLOAD_SIZE,
+    pool: Optional[YoutubeDLPool] = None,
+    postprocess_size: int = 0,
+) -> MediaInfo:
+    """
+    Extract the metadata of the media at the specified URL and select the format of each video, without
+    downloading anything. Pass the result to `fetch_media` to download the media without extracting it again.
+
+    This is a module-level function so that it can be submitted to a process pool.
+
+    :param url: URL of the Instagram reel or YouTube short to probe.
+    :param max_size: maximum size of each video in bytes.
+    :param pool: pool of YoutubeDL instances to use. Defaults to this process' pool.
+    :param postprocess_size: maximum size of a video that is post-processed to fit within `max_size`.
+                             0 disables post-processing.
+
+    :raises MediaTooLargeError: if a video does not fit within `max_size`, and can't be post-processed to fit.
+    """
+    # Nothing is downloaded, so the output path doesn't matter. It is only part of the options so that
+    # the probe shares the pooled instances of the downloads.
+    output_path: str = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.mp4")
+    with (pool or ydl_pool).acquire(build_ydl_opts(output_path, max_size, postprocess_size)) as ydl:
+        return _probe(ydl, url)
+
+
+def _probe(ydl: "yt_dlp.YoutubeDL", url: str) -> MediaInfo:
+    start: float = time.perf_counter()
+    info = ydl.extract_info(url, download=False, process=False)
+    # Resolves playlist entries and selects the format of each video, without downloading anything.
+    selected: Dict[str, Any] = ydl.process_ie_result(info, download=False)
+    entries: Tuple[Dict[str, Any], ...] = tuple(_video_entries(selected))
+
+    durations: List[Optional[float]] = [entry.get("duration") for entry in entries]
+    sizes: List[Optional[int]] = [estimate_size(entry) for entry in entries]
+    return MediaInfo(
+        entries=entries,
+        duration=sum(d for d in durations if d) if all(durations) else None,
+        size=sum(s for s in sizes if s) if all(sizes) else None,
+        extract_time=time.perf_counter() - start,
+    )
+
+
+def fetch_media(
+    url: str,
+    directory: str = "./",
+    max_size: int = DEFAULT_MAX_UPLOAD_SIZE,
+    spool_threshold: int = DEFAULT_SPOOL_THRESHOLD,
+    pool: Optional[YoutubeDLPool] = None,
+    info: Optional[MediaInfo] = None,
+    connections: int = 1,
+    postprocess_size: int = 0,
+) -> DownloadResult:
+    """
+    Download the video(s) at the specified URL into `MediaBuffer`s. A URL for a playlist, such as
+    an Instagram carousel, yields up to `MAX_MEDIA_GROUP_SIZE` videos.
+
+    When the selected format is a single file served over HTTP(S), it is streamed straight into the
+    buffer, so media smaller than `spool_threshold` never touches the disk. Otherwise, yt-dlp downloads
+    it to a file in `directory` as usual.
+
+    This is a module-level function so that it can be submitted to a process pool.
+
+    :param url: URL of the Instagram reel or YouTube short to download.
+    :param directory: directory for media that doesn't fit in memory.
+    :param max_size: maximum size of each video in bytes.
+    :param spool_threshold: maximum number of bytes of each video to keep in memory.
+    :param pool: pool of YoutubeDL instances to use. Defaults to this process' pool.
+    :param info: the result of `probe_media` for `url`, if it was already probed. Its extraction time
+                 isn't counted again.
+    :param connections: the maximum number of connections over which each video is downloaded in
+                        parallel, as far as this process' connection budget allows.
+    :param postprocess_size: maximum size of a video that is post-processed to fit within `max_size`.
+                             Videos up to this size are downloaded. 0 disables post-processing.
+
+    :raises MediaTooLargeError: if a video does not fit within `max_size`, and can't be post-processed to fit.
+    """
+    items: List[MediaBuffer] = []
+
+    with (pool or ydl_pool).acquire(build_ydl_opts(os.path.join(directory, f"{uuid.uuid4()}.mp4"), max_size, postprocess_size)) as ydl:
+        extract_time: float = 0.0
+        if info is None:
+            info = _probe(ydl, url)
+            extract_time = info.extract_time
+        start: float = time.perf_counter()
+
+        try:
+            with connection_budget.acquire(connections) as granted:
+                for entry in info.entries:
+                    items.append(_download_entry(ydl, entry, directory, max(max_size, postprocess_size), spool_threshold, granted))
+        except BaseException:
+            for media in items:
+                media.close()
+            raise
+
+        downloaded: float = time.perf_counter()
+
+    size: int = sum(media.size for media in items)
+    return DownloadResult(tuple(items), DownloadTimings(extract=extract_time, download=downloaded - start, size=size))
+
+
+def warm_up(
+    directory: str = "./",
+    max_size: int = DEFAULT_MAX_UPLOAD_SIZE,
+    pool: Optional[YoutubeDLPool] = None,
+    postprocess_size: int = 0,
+) -> None:
+    """
+    Import yt-dlp and leave a YoutubeDL instance with initialized extractors in the pool, so that the
+    first download doesn't pay for them.
+
+    This is a module-level function so that it can be submitted to a process pool, which warms up the
+    worker process that runs it.
+
+    :param directory: directory for media that doesn't fit in memory, as passed to `fetch_media`.
+    :param max_size: maximum size of each video in bytes, as passed to `fetch_media`.
+    :param pool: pool of YoutubeDL instances to warm up. Defaults to this process' pool.
+    :param postprocess_size: as passed to `fetch_media`.
+    """
+    with (pool or ydl_pool).acquire(build_ydl_opts(os.path.join(directory, f"{uuid.uuid4()}.mp4"), max_size, postprocess_size)) as ydl:
+        for ie_key in WARM_UP_EXTRACTORS:
+            ydl.get_info_extractor(ie_key)
+
+
+def _video_entries(info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if info.get("_type", "video") != "playlist":
+        return [info]
+
+    entries: List[Dict[str, Any]] = []
+    for entry in info.get("entries") or []:
+        entries.extend(_video_entries(entry) if entry else [])
+    return entries[:MAX_MEDIA_GROUP_SIZE]
+
+
+def _download_entry(
+    ydl: "yt_dlp.YoutubeDL",
+    entry: Dict[str, Any],
+    directory: str,
+    max_size: int,
+    spool_threshold: int,
+    connections: int = 1,
+) -> MediaBuffer:
+    """
+    Download one video whose format has already been selected, over up to `connections` connections.
+    """
+    if _is_streamable(entry):
+        media = MediaBuffer(directory, spool_threshold)
+        try:
+            _stream_to_buffer(ydl, entry, media, max_size, connections)
+            media.finish()
+        except BaseException:
+            media.close()
+            raise
+        return media
+
+    output_path: str = os.path.join(directory, f"{uuid.uuid4()}.mp4")
+    set_output_path(ydl, output_path)
+    # yt-dlp reads this when the download starts, so it can be changed between the downloads of a pooled instance.
+    ydl.params["concurrent_fragment_downloads"] = connections
+    # yt-dlp annotates the info as it downloads, and the entry may be cached for another download.
+    ydl.process_info(copy.deepcopy(entry))
+    media = MediaBuffer.from_file(output_path, spool_threshold)
+
+    # Formats of unknown size are only checked once they have been downloaded.
+    if media.size > max_size:
+        media.close()
+        raise MediaTooLargeError(media.size, max_size)
+
+    return media
+
+
+def _is_streamable(info: Dict[str, Any]) -> bool:
+    return (bool(info.get("url"))
+            and not info.get("requested_formats")
+            and info.get("protocol", "https") in STREAMABLE_PROTOCOLS)
+
+
+def _stream_to_buffer(ydl: "yt_dlp.YoutubeDL", info: Dict[str, Any], media: MediaBuffer, max_size: int, connections: int = 1) -> None:
+    from yt_dlp.networking import Request
+
+    headers: Dict[str, str] = info.get("http_headers") or {}
+    size: Optional[int] = estimate_size(info)
+    if connections > 1 and (size is None or size > RANGE_CHUNK_SIZE):
+        fetch_ranges(lambda url, headers: ydl.urlopen(Request(url, headers=headers)),
+                     info["url"], headers, media, max_size, connections)
+        return
+
+    request = Request(info["url"], headers=headers)
+    with closing(ydl.urlopen(request)) as response:
+        while True:
+            chunk: bytes = response.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            if media.size + len(chunk) > max_size:
+                raise MediaTooLargeError(media.size + len(chunk), max_size)
+            media.write(chunk)
+
+
+def create_download_executor(
+    executor_type: str = "thread",
+    max_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    ydl_max_uses: int = DEFAULT_YDL_MAX_USES,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+) -> Executor:
+    """
+    Create the worker pool that downloads are submitted to.
+
+    :param executor_type: either "thread" or "process".
+    :param max_workers: the maximum number of concurrent downloads.
+    :param ydl_max_uses: number of downloads after which a pooled YoutubeDL instance is replaced.
+    :param max_connections: the maximum number of connections that all downloads open at the same time.
+    """
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+    if ydl_max_uses < 1:
+        raise ValueError(f"ydl_max_uses must be at least 1, got {ydl_max_uses}")
+    if max_connections < 1:
+        raise ValueError(f"max_connections must be at least 1, got {max_connections}")
+
+    if executor_type == "thread":
+        configure_ydl_pool(ydl_max_uses, max_connections)
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+    if executor_type == "process":
+        # Each worker process has its own pool, and its share of the connections.
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=configure_ydl_pool,
+                                   initargs=(ydl_max_uses, max(1, max_connections // max_workers)))
+
+    raise ValueError(
+        f'Unknown executor type "{executor_type}". Expected one of: {", ".join(EXECUTOR_TYPES)}')
@@ -0,0 +1,62 @@
+"""
+Exceptions raised by the download pipeline.
+"""
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a download is rejected because the download queue is full.
+    """
+
+
+class MediaTooLargeError(Exception):
+    """
+    Raised when no format of the requested media fits within the upload size limit.
+    """
+
+    def __init__(self, size: int, max_size: int):
+        # Both values are passed to Exception so that the error survives pickling (e.g., from a process pool).
+        super().__init__(size, max_size)
+        self.size: int = size
+        self.max_size: int = max_size
+
+    def __str__(self) -> str:
+        return f"Media is {self.size} bytes, which exceeds the limit of {self.max_size} bytes"
+
+
+class RestrictedMediaError(Exception):
+    """
+    Raised when the requested media is age-restricted, private or only available to logged-in users.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a download is rejected without being attempted because the platform's circuit breaker is open.
+    """
+
+    def __init__(self, platform: str, retry_after: float):
+        super().__init__(platform, retry_after)
+        self.platform: str = platform
+        self.retry_after: float = retry_after
+
+    def __str__(self) -> str:
+        return f"Circuit breaker for {self.platform or 'platform'} is open, retry in {self.retry_after:.0f} seconds"
+
+
+class JobFailedError(Exception):
+    """
+    Raised when a download worker failed a job with an error that the frontend has no special handling for.
+    """
+
+
+class ShuttingDownError(Exception):
+    """
+    Raised when a download is rejected or abandoned because the bot is shutting down.
+    """
+
+
+class PostprocessError(Exception):
+    """
+    Raised when ffmpeg fails to remux or re-encode downloaded media, or is cancelled or times out.
+    """
@@ -0,0 +1,512 @@
+"""
+A job queue that separates the bot frontend from download workers.
+
+In split mode, the frontend (which receives updates from Telegram) doesn't download anything
+itself. It puts a `Job` for every link on a `JobQueue`, and any number of worker processes
+(see `telegram_media_downloader_bot.worker`) take jobs off the queue, download the media, send it
+to the chat and put a `JobResult` back, which the frontend picks up with a `JobDispatcher`.
+
+There are two backends:
+
+- `SQLiteJobQueue`, for workers on the same host (or threads of the same process, with `:memory:`).
+- `RedisJobQueue`, for workers on other hosts. It works with any client that has the interface of
+  `redis.Redis`.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type, TypeVar
+
+from telegram_media_downloader_bot.errors import CircuitOpenError, JobFailedError, MediaTooLargeError, QueueFullError, RestrictedMediaError
+
+T = TypeVar("T")
+
+DEFAULT_JOB_TIMEOUT: float = 300.0  # seconds
+# Jobs taken by a worker that hasn't completed them within this many seconds are handed out again.
+DEFAULT_VISIBILITY_TIMEOUT: float = 600.0  # seconds
+DEFAULT_POLL_INTERVAL: float = 0.05  # seconds
+DEFAULT_RESULT_TTL: int = 3600  # seconds
+
+# Errors that are passed from workers to the frontend as-is, so that it can reply as it would for a local download.
+_ERROR_TYPES: Dict[str, Type[Exception]] = {
+    error_type.__name__: error_type
+    for error_type in (CircuitOpenError, MediaTooLargeError, QueueFullError, RestrictedMediaError)
+}
+
+
+class Job(NamedTuple):
+    """
+    A request to download the media at `url` and send it to `chat_id`.
+
+    :param reply_to: consumer name of the frontend that is waiting for the result.
+    """
+    id: str
+    url: str
+    platform: str
+    chat_id: str
+    user_id: str
+    reply_to_message_id: Optional[int]
+    reply_to: str
+    created_at: float
+
+    @classmethod
+    def create(
+        cls,
+        url: str,
+        platform: str,
+        chat_id: str,
+        user_id: str,
+        reply_to_message_id: Optional[int],
+        reply_to: str,
+    ) -> "Job":
+        return cls(uuid.uuid4().hex, url, platform, chat_id, user_id, reply_to_message_id, reply_to, time.time())
+
+    def dumps(self) -> str:
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def loads(cls, payload: str) -> "Job":
+        return cls(**json.loads(payload))
+
+
+class JobResult(NamedTuple):
+    """
+    The outcome of a `Job`: the Telegram file IDs (and message IDs) of the videos that were sent, or the error.
+
+    :param error_type: name of the exception that failed the job. Empty if the job succeeded.
+    :param error_args: arguments of that exception.
+    """
+    job_id: str
+    file_ids: Tuple[str, ...]
+    message_ids: Tuple[int, ...] = ()
+    error_type: str = ""
+    error_args: Tuple[Any, ...] = ()
+    worker: str = ""
+
+    @classmethod
+    def failure(cls, job_id: str, ex: BaseException, worker: str = "") -> "JobResult":
+        if type(ex).__name__ in _ERROR_TYPES:
+            return cls(job_id, (), (), type(ex).__name__, tuple(ex.args), worker)
+        return cls(job_id, (), (), JobFailedError.__name__, (f"{type(ex).__name__}: {ex}",), worker)
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.error_type)
+
+    def error(self) -> Exception:
+        """
+        Recreate the error that failed the job.
+        """
+        error_type: Type[Exception] = _ERROR_TYPES.get(self.error_type, JobFailedError)
+        try:
+            return error_type(*self.error_args)
+        except TypeError:
+            return JobFailedError(f"{self.error_type}: {self.error_args}")
+
+    def dumps(self) -> str:
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def loads(cls, payload: str) -> "JobResult":
+        fields: Dict[str, Any] = json.loads(payload)
+        # JSON has no tuples.
+        for name in ("file_ids", "message_ids", "error_args"):
+            fields[name] = tuple(fields.get(name, ()))
+        return cls(**fields)
+
+
+class JobQueue(object):
+    """
+    Interface of the job queue backends.
+
+    Every method blocks, so call them from a worker thread (e.g., with `asyncio.to_thread`) on an event loop.
+    """
+
+    def put(self, job: Job) -> None:
+        raise NotImplementedError()
+
+    def get(self, timeout: float) -> Optional[Job]:
+        """
+        Take the oldest job off the queue, waiting up to `timeout` seconds for one.
+        """
+        raise NotImplementedError()
+
+    def complete(self, job: Job, result: JobResult) -> None:
+        """
+        Remove a job that was taken with `get` and hand its result to the frontend waiting for it.
+        """
+        raise NotImplementedError()
+
+    def get_results(self, consumer: str, timeout: float) -> List[JobResult]:
+        """
+        Take the results for `consumer` off the queue, waiting up to `timeout` seconds for at least one.
+        """
+        raise NotImplementedError()
+
+    def depth(self) -> int:
+        """
+        Number of jobs that no worker has taken yet.
+        """
+        raise NotImplementedError()
+
+    def cancel(self, job: Job) -> None:
+        """
+        Withdraw a job whose frontend stopped waiting for it. A job that no worker has taken yet is removed, and a
+        worker that has taken it sees that it was cancelled (see `cancelled`).
+        """
+        raise NotImplementedError()
+
+    def cancelled(self, job: Job) -> bool:
+        """
+        Whether `job`, which was taken with `get`, has been cancelled, so its media shouldn't be sent.
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    taken_at REAL
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    consumer TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_results_consumer ON job_results (consumer);
+"""
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    A job queue in a SQLite database, shared by the processes (or threads) that open the same file.
+
+    Waiting processes poll the database every `poll_interval` seconds; threads of the same process are
+    woken up right away.
+
+    :param path: path of the database file. `:memory:` keeps the queue within this process.
+    :param visibility_timeout: seconds after which a job that was taken but not completed (e.g., because
+                               its worker crashed) is handed out again.
+    :param result_ttl: seconds after which results that nobody picked up (e.g., because their frontend
+                       is gone) are deleted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        result_ttl: int = DEFAULT_RESULT_TTL,
+    ):
+        self._path: str = path
+        self._visibility_timeout: float = visibility_timeout
+        self._poll_interval: float = poll_interval
+        self._result_ttl: int = result_ttl
+
+        # One connection shared by this process's threads; SQLite serializes access across processes.
+        self._conn: sqlite3.Connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._changed = threading.Condition()
+        with self._changed:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _transaction(self, work: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Run `work` in a write transaction, which keeps other processes from claiming the same rows in between
+        its statements. Call with `self._changed` held.
+
+        Rows are read and then updated, rather than with `RETURNING`, which needs SQLite 3.35.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result: T = work(self._conn)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return result
+
+    def _wait(self, take: Callable[[], T], timeout: float) -> T:
+        deadline: float = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                taken = take()
+                remaining: float = deadline - time.monotonic()
+                if taken or remaining <= 0:
+                    return taken
+                self._changed.wait(min(remaining, self._poll_interval))
+
+    def put(self, job: Job) -> None:
+        with self._changed:
+            self._transaction(lambda conn: conn.execute(
+                "INSERT INTO jobs (id, payload) VALUES (?, ?)", (job.id, job.dumps())))
+            self._changed.notify_all()
+
+    def _exists(self, sql: str, params: Tuple[Any, ...] = ()) -> bool:
+        # Reads don't lock the database in WAL mode, so pollers only take the write lock when there is work.
+        return self._conn.execute(sql, params).fetchone() is not None
+
+    def get(self, timeout: float) -> Optional[Job]:
+        def take() -> Optional[Job]:
+            now: float = time.time()
+            if not self._exists("SELECT 1 FROM jobs WHERE taken_at IS NULL OR taken_at < ? LIMIT 1",
+                                (now - self._visibility_timeout,)):
+                return None
+
+            def claim(conn: sqlite3.Connection) -> Optional[Job]:
+                row = conn.execute("SELECT seq, payload FROM jobs WHERE taken_at IS NULL OR taken_at < ? ORDER BY seq LIMIT 1",
+                                   (now - self._visibility_timeout,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE jobs SET taken_at = ? WHERE seq = ?", (now, row[0]))
+                return Job.loads(row[1])
+
+            return self._transaction(claim)
+
+        return self._wait(take, timeout)
+
+    def complete(self, job: Job, result: JobResult) -> None:
+        def complete(conn: sqlite3.Connection) -> None:
+            now: float = time.time()
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+            conn.execute("DELETE FROM job_results WHERE created_at < ?", (now - self._result_ttl,))
+            conn.execute("INSERT INTO job_results (consumer, payload, created_at) VALUES (?, ?, ?)",
+                         (job.reply_to, result.dumps(), now))
+
+        with self._changed:
+            self._transaction(complete)
+            self._changed.notify_all()
+
+    def get_results(self, consumer: str, timeout: float) -> List[JobResult]:
+        def take() -> List[JobResult]:
+            if not self._exists("SELECT 1 FROM job_results WHERE consumer = ? LIMIT 1", (consumer,)):
+                return []
+
+            def claim(conn: sqlite3.Connection) -> List[Tuple[Any, ...]]:
+                rows = conn.execute("SELECT seq, payload FROM job_results WHERE consumer = ? ORDER BY seq", (consumer,)).fetchall()
+                if rows:
+                    conn.execute("DELETE FROM job_results WHERE consumer = ? AND seq <= ?", (consumer, rows[-1][0]))
+                return rows
+
+            return [JobResult.loads(payload) for _, payload in self._transaction(claim)]
+
+        return self._wait(take, timeout)
+
+    def depth(self) -> int:
+        with self._changed:
+            return int(self._conn.execute("SELECT COUNT(*) FROM jobs WHERE taken_at IS NULL").fetchone()[0])
+
+    def cancel(self, job: Job) -> None:
+        with self._changed:
+            self._transaction(lambda conn: conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,)))
+
+    def cancelled(self, job: Job) -> bool:
+        # Jobs stay in the table until they are completed, unless they are cancelled.
+        with self._changed:
+            return not self._exists("SELECT 1 FROM jobs WHERE id = ?", (job.id,))
+
+    def close(self) -> None:
+        with self._changed:
+            self._conn.close()
+
+
+class RedisJobQueue(JobQueue):
+    """
+    A job queue in Redis (or any server that speaks its protocol, e.g., Valkey or KeyDB).
+
+    Jobs are pushed onto a list that workers pop with `BRPOP`, and results are pushed onto a list per
+    consumer. A job whose worker crashes before completing it is lost, and its frontend times out waiting.
+
+    :param client: a `redis.Redis` client, or anything with its `lpush`, `brpop`, `rpop`, `llen`, `lrem`, `set`,
+                   `exists` and `expire` methods.
+    :param prefix: prefix of the keys used by the queue, so that several bots can share a server.
+    :param result_ttl: seconds after which results that nobody picked up are deleted.
+    """
+
+    def __init__(self, client: Any, prefix: str = "media_downloader", result_ttl: int = DEFAULT_RESULT_TTL):
+        self._client: Any = client
+        self._jobs_key: str = f"{prefix}:jobs"
+        self._results_prefix: str = f"{prefix}:results:"
+        self._cancelled_prefix: str = f"{prefix}:cancelled:"
+        self._result_ttl: int = result_ttl
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: Any) -> "RedisJobQueue":
+        """
+        Connect to the server at `url`, e.g., `redis://localhost:6379/0`. Requires `pip install redis`.
+        """
+        try:
+            import redis
+        except ImportError as ex:
+            raise ImportError("The Redis job queue requires `pip install redis`") from ex
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    @staticmethod
+    def _decode(payload: Any) -> str:
+        return payload.decode("utf-8") if isinstance(payload, bytes) else str(payload)
+
+    def put(self, job: Job) -> None:
+        self._client.lpush(self._jobs_key, job.dumps())
+
+    def get(self, timeout: float) -> Optional[Job]:
+        # BRPOP only supports whole seconds on older servers, and 0 means "wait forever".
+        popped = self._client.brpop([self._jobs_key], timeout=max(1, round(timeout)))
+        return Job.loads(self._decode(popped[1])) if popped else None
+
+    def complete(self, job: Job, result: JobResult) -> None:
+        key: str = self._results_prefix + job.reply_to
+        self._client.lpush(key, result.dumps())
+        self._client.expire(key, self._result_ttl)
+
+    def get_results(self, consumer: str, timeout: float) -> List[JobResult]:
+        key: str = self._results_prefix + consumer
+        popped = self._client.brpop([key], timeout=max(1, round(timeout)))
+        if not popped:
+            return []
+
+        results: List[JobResult] = [JobResult.loads(self._decode(popped[1]))]
+        # Drain whatever else is there without waiting.
+        while (payload := self._client.rpop(key)) is not None:
+            results.append(JobResult.loads(self._decode(payload)))
+        return results
+
+    def depth(self) -> int:
+        return int(self._client.llen(self._jobs_key))
+
+    def cancel(self, job: Job) -> None:
+        # A worker that has already popped the job checks for this marker before sending its media.
+        self._client.set(self._cancelled_prefix + job.id, 1, ex=self._result_ttl)
+        self._client.lrem(self._jobs_key, 0, job.dumps())
+
+    def cancelled(self, job: Job) -> bool:
+        return bool(self._client.exists(self._cancelled_prefix + job.id))
+
+    def close(self) -> None:
+        close = getattr(self._client, "close", None)
+        if close:
+            close()
+
+
+def open_job_queue(url: str) -> JobQueue:
+    """
+    Open the job queue at `url`: `redis://...` (or `rediss://...`) for Redis, and `sqlite:///<path>` or
+    a plain path for SQLite.
+    """
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue.from_url(url)
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///"):]
+    return SQLiteJobQueue(url)
+
+
+class JobDispatcher(object):
+    """
+    Submits jobs on behalf of a frontend and waits for their results.
+
+    A single background task collects the results for this frontend's consumer name and hands each
+    one to the job that is waiting for it.
+
+    :param job_timeout: seconds to wait for a job's result before giving up on it.
+    :param consumer: name under which this frontend receives results. Defaults to a unique name.
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        job_timeout: float = DEFAULT_JOB_TIMEOUT,
+        consumer: str = "",
+        poll_timeout: float = 1.0,
+    ):
+        self._queue: JobQueue = job_queue
+        self._job_timeout: float = job_timeout
+        self._poll_timeout: float = poll_timeout
+        self.consumer: str = consumer or f"frontend-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._waiting: Dict[str, "asyncio.Future[JobResult]"] = {}
+        self._collector: Optional["asyncio.Task[None]"] = None
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def queue(self) -> JobQueue:
+        return self._queue
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._waiting)
+
+    async def submit(self, job: Job) -> JobResult:
+        """
+        Put a job on the queue and wait for its result.
+
+        :raises asyncio.TimeoutError: if no worker completes the job within `job_timeout` seconds. The job is
+                                      cancelled, so that its media isn't sent after the user was told it failed.
+        """
+        future: "asyncio.Future[JobResult]" = asyncio.get_running_loop().create_future()
+        self._waiting[job.id] = future
+        try:
+            await asyncio.to_thread(self._queue.put, job)
+            if self._collector is None or self._collector.done():
+                self._collector = asyncio.ensure_future(self._collect())
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout=self._job_timeout)
+            except asyncio.TimeoutError:
+                try:
+                    await asyncio.to_thread(self._queue.cancel, job)
+                except Exception as ex:
+                    self.logger.error('Failed to cancel job "%s": %s', job.id, ex)
+                raise
+        finally:
+            self._waiting.pop(job.id, None)
+
+    async def _collect(self) -> None:
+        while self._waiting:
+            try:
+                results: List[JobResult] = await asyncio.to_thread(self._queue.get_results, self.consumer, self._poll_timeout)
+            except Exception as ex:
+                self.logger.error("Failed to collect job results: %s", ex)
+                await asyncio.sleep(self._poll_timeout)
+                continue
+
+            for result in results:
+                future: Optional["asyncio.Future[JobResult]"] = self._waiting.get(result.job_id)
+                if future is None:
+                    self.logger.warning('Dropping result of job "%s", which nobody is waiting for.', result.job_id)
+                elif not future.done():
+                    future.set_result(result)
+
+    def cancel_all(self, error: Exception) -> int:
+        """
+        Stop waiting for the results of submitted jobs, failing them with `error`. The jobs themselves stay queued.
+
+        :return: the number of jobs that were waiting.
+        """
+        waiting: List["asyncio.Future[JobResult]"] = list(self._waiting.values())
+        for future in waiting:
+            if not future.done():
+                future.set_exception(error)
+        return len(waiting)
+
+    def close(self) -> None:
+        """
+        Stop waiting for results and close the queue. Jobs that are still queued stay there for the next frontend.
+        """
+        self._waiting.clear()
+        self._queue.close()
@@ -0,0 +1,147 @@
+"""
+Non-blocking logging.
+
+Log records are put on a bounded queue by the threads (and the event loop) that emit them,
+and a background thread formats them and writes them to the console and to a size-rotated
+log file. Formatting is deferred to that thread as well, so logging with `%`-style arguments
+costs the event loop little more than creating the record.
+
+Because formatting is deferred, `%`-style arguments are rendered when the record is written, not when
+it is logged, so mutable arguments (e.g., an `Update`) show their state at that later time. Log a
+snapshot (e.g., `str(value)`) where that matters. Records of the pipeline's logger don't propagate to
+ancestor loggers, whose handlers would format them on the calling thread again.
+"""
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional, Union
+
+DEFAULT_LOG_MAX_BYTES: int = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT: int = 5
+DEFAULT_LOG_QUEUE_SIZE: int = 10000
+
+# Parent of all of the package's loggers.
+PACKAGE_LOGGER: str = "telegram_media_downloader_bot"
+
+# Name of the logger that receives the full dumps of incoming updates.
+UPDATES_LOGGER: str = f"{PACKAGE_LOGGER}.updates"
+
+# The active pipeline of each logger.
+_pipelines: Dict[str, "LoggingPipeline"] = {}
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    A `QueueHandler` that leaves formatting to the listener thread and drops records when the queue is full,
+    rather than blocking the caller.
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so there is no need to format it before it is queued.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes a random fraction `rate` of records. 0 drops all of them, 1 passes all of them.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate: float = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+
+class LoggingPipeline(object):
+    """
+    Routes the records of `logger_name` (and its children) through a queue to a background writer.
+
+    Creating a new pipeline for the same logger closes the previous one. While the pipeline is open, the
+    logger doesn't propagate records to its ancestors.
+
+    :param logger_name: the logger to attach to, e.g., the package's root logger.
+    :param log_file: path of the log file. If empty, logs are only written to the console.
+    :param logger_format: format of each log line.
+    :param level: level of the logger.
+    :param max_bytes: size at which the log file is rotated. 0 disables rotation.
+    :param backup_count: number of rotated log files to keep.
+    :param update_sample_rate: fraction of incoming updates that are dumped in full at debug level.
+    :param queue_size: maximum number of records waiting to be written. Further records are dropped.
+    """
+
+    def __init__(
+        self,
+        logger_name: str,
+        log_file: str = "",
+        logger_format: str = logging.BASIC_FORMAT,
+        level: Union[int, str] = logging.DEBUG,
+        max_bytes: int = DEFAULT_LOG_MAX_BYTES,
+        backup_count: int = DEFAULT_LOG_BACKUP_COUNT,
+        update_sample_rate: float = 0.0,
+        queue_size: int = DEFAULT_LOG_QUEUE_SIZE,
+    ):
+        previous: Optional[LoggingPipeline] = _pipelines.get(logger_name)
+        if previous is not None:
+            previous.close()
+        _pipelines[logger_name] = self
+
+        self._logger: logging.Logger = logging.getLogger(logger_name)
+
+        formatter = logging.Formatter(logger_format)
+        handlers: List[logging.Handler] = [logging.StreamHandler()]
+        if log_file:
+            handlers.append(RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, delay=True))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self._handler = _DeferredQueueHandler(queue.Queue(queue_size))
+        self._listener: Optional[QueueListener] = QueueListener(self._handler.queue, *handlers, respect_handler_level=True)
+
+        self._logger.addHandler(self._handler)
+        self._logger.setLevel(level)
+        # Handlers of ancestor loggers (e.g., the root logger's) would format every record on the calling thread.
+        self._propagate: bool = self._logger.propagate
+        self._logger.propagate = False
+
+        updates_logger: logging.Logger = logging.getLogger(UPDATES_LOGGER)
+        for existing_filter in list(updates_logger.filters):
+            if isinstance(existing_filter, SamplingFilter):
+                updates_logger.removeFilter(existing_filter)
+        updates_logger.addFilter(SamplingFilter(update_sample_rate))
+
+        self._listener.start()
+
+    @property
+    def dropped(self) -> int:
+        """
+        Number of records dropped because the queue was full.
+        """
+        return self._handler.dropped
+
+    def close(self) -> None:
+        """
+        Write the queued records and stop the writer thread.
+        """
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._handler)
+        self._logger.propagate = self._propagate
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        if _pipelines.get(self._logger.name) is self:
+            del _pipelines[self._logger.name]
@@ -0,0 +1,284 @@
+"""
+Lightweight Prometheus-style instrumentation.
+
+Counters and histograms are kept in memory, can be rendered in the Prometheus text
+exposition format, and can optionally be served on a local HTTP scrape endpoint.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Pipeline stages whose duration is recorded in the `stage_duration_seconds` histogram.
+STAGES: Tuple[str, ...] = ("classify", "extract", "download", "postprocess", "upload", "cleanup")
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> _Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: _Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter(object):
+    def __init__(self, name: str, description: str):
+        self.name: str = name
+        self.description: str = description
+        self._values: Dict[_Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value:g}")
+        return lines
+
+
+class Gauge(object):
+    def __init__(self, name: str, description: str):
+        self.name: str = name
+        self.description: str = description
+        self._values: Dict[_Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value:g}")
+        return lines
+
+
+class _HistogramSeries(object):
+    def __init__(self, num_buckets: int):
+        self.bucket_counts: List[int] = [0] * (num_buckets + 1)  # The last bucket is +Inf.
+        self.count: int = 0
+        self.sum: float = 0.0
+
+
+class Histogram(object):
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.name: str = name
+        self.description: str = description
+        self._buckets: List[float] = sorted(buckets)
+        self._series: Dict[_Labels, _HistogramSeries] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self._buckets))
+            series.bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+            series.count += 1
+            series.sum += value
+
+    def count(self, **labels: str) -> int:
+        return sum(series.count for key, series in self._matching(labels))
+
+    def quantile(self, q: float, **labels: str) -> Optional[float]:
+        """
+        Estimate the q-quantile of the observations whose labels include `labels`.
+
+        Like Prometheus' `histogram_quantile`, this interpolates linearly within the bucket
+        containing the quantile.
+        """
+        bucket_counts: List[int] = [0] * (len(self._buckets) + 1)
+        for _, series in self._matching(labels):
+            bucket_counts = [a + b for a, b in zip(bucket_counts, series.bucket_counts)]
+
+        total: int = sum(bucket_counts)
+        if total == 0:
+            return None
+
+        rank: float = q * total
+        cumulative: int = 0
+        for index, count in enumerate(bucket_counts):
+            if count and cumulative + count >= rank:
+                if index == len(self._buckets):
+                    # Past the last finite bucket; the best estimate is that bucket's upper bound.
+                    return self._buckets[-1]
+                lower: float = self._buckets[index - 1] if index > 0 else 0.0
+                upper: float = self._buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+
+        return self._buckets[-1]
+
+    def _matching(self, labels: Dict[str, str]) -> List[Tuple[_Labels, _HistogramSeries]]:
+        wanted = set(labels.items())
+        with self._lock:
+            return [(key, series) for key, series in self._series.items() if wanted.issubset(key)]
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative: int = 0
+                for bound, count in zip(self._buckets + [float("inf")], series.bucket_counts):
+                    cumulative += count
+                    le: str = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series.sum:g}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series.count}")
+        return lines
+
+
+class Metrics(object):
+    """
+    The bot's metrics.
+    """
+
+    def __init__(self):
+        self.stage_duration = Histogram(
+            "stage_duration_seconds", "Duration of each stage of the download pipeline.")
+        self.downloaded_bytes = Counter(
+            "downloaded_bytes_total", "Bytes of media downloaded.")
+        self.uploaded_bytes = Counter(
+            "uploaded_bytes_total", "Bytes of media uploaded to Telegram.")
+        self.cache_hits = Counter(
+            "file_id_cache_hits_total", "Requests answered from the file ID cache.")
+        self.cache_misses = Counter(
+            "file_id_cache_misses_total", "Requests that were not in the file ID cache.")
+        self.metadata_cache_hits = Counter(
+            "metadata_cache_hits_total", "Probes answered from the metadata cache.")
+        self.metadata_cache_misses = Counter(
+            "metadata_cache_misses_total", "Probes that extracted the media's metadata.")
+        self.postprocess_cpu_seconds = Counter(
+            "postprocess_cpu_seconds_total", "CPU seconds used by ffmpeg to remux or re-encode downloaded media.")
+        self.content_dedup_hits = Counter(
+            "content_dedup_hits_total", "Downloaded videos sent by the file ID of identical, already uploaded media.")
+        self.coalesced = Counter(
+            "coalesced_requests_total", "Requests that joined a download already in progress.")
+        self.deliveries = Counter(
+            "deliveries_total", "Videos successfully sent to a chat.")
+        self.errors = Counter(
+            "errors_total", "Errors by stage, platform and error type.")
+        self.retries = Counter(
+            "download_retries_total", "Downloads retried after a transient error.")
+        self.circuit_rejections = Counter(
+            "circuit_breaker_rejections_total", "Downloads rejected because the platform's circuit breaker was open.")
+        self.circuit_state = Gauge(
+            "circuit_breaker_state", "State of each platform's circuit breaker: 0 closed, 1 half-open, 2 open.")
+
+    def all(self) -> List[object]:
+        return [self.stage_duration, self.downloaded_bytes, self.uploaded_bytes, self.cache_hits,
+                self.cache_misses, self.metadata_cache_hits, self.metadata_cache_misses,
+                self.postprocess_cpu_seconds, self.content_dedup_hits, self.coalesced, self.deliveries,
+                self.errors, self.retries, self.circuit_rejections, self.circuit_state]
+
+    @contextmanager
+    def time_stage(self, stage: str, platform: str = "") -> Iterator[None]:
+        """
+        Record the duration of a pipeline stage, and count it as an error if it raises.
+        """
+        start: float = time.perf_counter()
+        try:
+            yield
+        except Exception as ex:
+            self.errors.inc(stage=stage, platform=platform, error=type(ex).__name__)
+            raise
+        finally:
+            self.stage_duration.observe(time.perf_counter() - start, stage=stage, platform=platform)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines: List[str] = []
+        for metric in self.all():
+            lines.extend(metric.render())  # type: ignore[attr-defined]
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self) -> List[str]:
+        """
+        Human-readable per-stage latency percentiles, for the admin.
+        """
+        lines: List[str] = []
+        for stage in STAGES:
+            count: int = self.stage_duration.count(stage=stage)
+            if not count:
+                continue
+            p50, p95, p99 = (self.stage_duration.quantile(q, stage=stage) or 0.0 for q in (0.5, 0.95, 0.99))
+            lines.append(f"  • {stage}: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms ({count})")
+        return lines
+
+
+class MetricsServer(object):
+    """
+    Serves metrics in the Prometheus text format at `http://<host>:<port>/metrics` from a background thread.
+
+    :param metrics: the metrics to serve.
+    :param port: the port to listen on. 0 picks a free port.
+    :param host: the interface to listen on. Defaults to the loopback interface.
+    """
+
+    def __init__(self, metrics: Metrics, port: int, host: str = "127.0.0.1"):
+        self.logger = logging.getLogger(__name__)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+
+                body: bytes = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        self.logger.info("Serving metrics on port %d.", self.port)
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,177 @@
+"""
+Parallel downloads of large media over several connections.
+
+A single connection often can't use the host's bandwidth: CDNs throttle each connection, and every
+request waits a round trip before its first byte. Media served as a single file is therefore fetched
+in byte ranges over several connections, and media served in fragments (HLS/DASH) is downloaded by
+yt-dlp with several fragments in flight (see `concurrent_fragment_downloads`).
+
+The connections of all downloads in a process come out of one `ConnectionBudget`, so that parallel
+downloads don't multiply the number of connections by the number of download workers.
+"""
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from telegram_media_downloader_bot.buffer import MediaBuffer
+from telegram_media_downloader_bot.errors import MediaTooLargeError
+
+# Maximum number of connections that a single download opens.
+DEFAULT_CONNECTIONS_PER_DOWNLOAD: int = 4
+
+# Maximum number of connections that the downloads of all workers open at the same time.
+DEFAULT_MAX_CONNECTIONS: int = 16
+
+# Maximum size of each byte range requested from the server.
+RANGE_CHUNK_SIZE: int = 4 * 1024 * 1024  # bytes
+
+STREAM_CHUNK_SIZE: int = 256 * 1024
+
+# The first range is only fetched to learn the size of the file, so it is small.
+FIRST_RANGE_SIZE: int = STREAM_CHUNK_SIZE
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class ConnectionBudget(object):
+    """
+    The number of connections that the downloads in this process may open at the same time.
+
+    Thread-safe. A download waits until at least one connection is free, and then takes as many of the
+    connections it asked for as are free, so that it never waits for more than one.
+
+    :param capacity: the number of connections.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_MAX_CONNECTIONS):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+
+        self._capacity: int = capacity
+        self._in_use: int = 0
+        self._released = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def resize(self, capacity: int) -> None:
+        """
+        Change the number of connections. Connections in use above the new capacity are returned as usual.
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+        with self._released:
+            self._capacity = capacity
+            self._released.notify_all()
+
+    @contextmanager
+    def acquire(self, wanted: int) -> Iterator[int]:
+        """
+        Take up to `wanted` connections for the duration of the context.
+
+        :return: the number of connections taken, between 1 and `wanted`.
+        """
+        with self._released:
+            while self._in_use >= self._capacity:
+                self._released.wait()
+            granted: int = max(1, min(wanted, self._capacity - self._in_use))
+            self._in_use += granted
+        try:
+            yield granted
+        finally:
+            with self._released:
+                self._in_use -= granted
+                self._released.notify_all()
+
+
+# The connections of the downloads in this process (i.e., in each worker process, or shared by all worker threads).
+connection_budget: ConnectionBudget = ConnectionBudget()
+
+
+def _content_range(response: Any) -> Optional[Tuple[int, int, int]]:
+    """
+    Return the (first, last, total) bytes of a partial response, or None if the response is the whole file.
+    """
+    if getattr(response, "status", 200) != 206:
+        return None
+    match = _CONTENT_RANGE.fullmatch((response.headers.get("Content-Range") or "").strip())
+    if match is None:
+        return None
+    first, last, total = (int(group) for group in match.groups())
+    return first, last, total
+
+
+def fetch_ranges(
+    urlopen: Callable[[str, Dict[str, str]], Any],
+    url: str,
+    headers: Dict[str, str],
+    media: MediaBuffer,
+    max_size: int,
+    connections: int,
+    chunk_size: int = RANGE_CHUNK_SIZE,
+) -> None:
+    """
+    Download the file at `url` into `media`, fetching up to `connections` byte ranges at a time.
+
+    A small first range tells the size of the file, and the rest is split evenly among the connections,
+    in ranges of at most `chunk_size` bytes. Servers that don't support range requests answer the first
+    range with the whole file, which is then streamed over that one connection. Ranges are written to
+    `media` in order, so at most `connections` ranges are held in memory.
+
+    :param urlopen: opens a request for `url` with the given headers, returning a file-like response
+                    with `status` and `headers`.
+    :param connections: the maximum number of concurrent requests.
+    :param chunk_size: the maximum size of each range in bytes.
+
+    :raises MediaTooLargeError: if the file is larger than `max_size`.
+    """
+    def fetch(first: int, last: int) -> bytes:
+        with closing(urlopen(url, {**headers, "Range": f"bytes={first}-{last}"})) as response:
+            content_range = _content_range(response)
+            if content_range is None or content_range[:2] != (first, last):
+                raise IOError(f"Expected bytes {first}-{last} of {url}, got {content_range}")
+            data: bytes = response.read()
+        if len(data) != last - first + 1:
+            raise IOError(f"Expected {last - first + 1} bytes of {url}, got {len(data)}")
+        return data
+
+    with closing(urlopen(url, {**headers, "Range": f"bytes=0-{min(chunk_size, FIRST_RANGE_SIZE) - 1}"})) as response:
+        content_range = _content_range(response)
+        if content_range is not None and content_range[2] > max_size:
+            raise MediaTooLargeError(content_range[2], max_size)
+        while True:
+            chunk: bytes = response.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if media.size + len(chunk) > max_size:
+                raise MediaTooLargeError(media.size + len(chunk), max_size)
+            media.write(chunk)
+
+    if content_range is None:
+        # The whole file, from a server that ignored the range.
+        return
+
+    total: int = content_range[2]
+    step: int = max(1, min(chunk_size, -(-(total - media.size) // connections)))
+    ranges: Iterator[Tuple[int, int]] = ((first, min(first + step, total) - 1)
+                                         for first in range(media.size, total, step))
+    with ThreadPoolExecutor(max_workers=max(1, connections), thread_name_prefix="range") as pool:
+        pending: Deque["Future[bytes]"] = deque()
+        try:
+            for first, last in ranges:
+                if len(pending) >= connections:
+                    media.write(pending.popleft().result())
+                pending.append(pool.submit(fetch, first, last))
+            while pending:
+                media.write(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,362 @@
+"""
+Post-processing of downloaded media with ffmpeg, so that Telegram can stream it and accepts its size.
+
+Videos in another container than mp4 are remuxed (copied into an mp4 container without re-encoding).
+Videos that are slightly larger than the upload limit, or whose codecs Telegram can't stream, are
+re-encoded to H.264/AAC at a bitrate that makes them fit.
+
+ffmpeg runs in its own bounded pool of processes, separate from the download workers, so that
+CPU-heavy encodes can't starve the network-bound downloads.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from telegram_media_downloader_bot.buffer import MediaBuffer
+from telegram_media_downloader_bot.errors import MediaTooLargeError, PostprocessError
+
+# Post-processing actions.
+REMUX: str = "remux"
+TRANSCODE: str = "transcode"
+
+# Maximum number of ffmpeg processes that run at the same time.
+DEFAULT_POSTPROCESS_WORKERS: int = 1
+
+# Media up to this multiple of the upload limit is downloaded, and re-encoded to fit.
+DEFAULT_POSTPROCESS_HEADROOM: float = 1.5
+
+# ffmpeg processes that run longer than this are killed.
+DEFAULT_POSTPROCESS_TIMEOUT: float = 300.0  # seconds
+
+# Threads of each ffmpeg process, so that one encode doesn't take every core.
+DEFAULT_FFMPEG_THREADS: int = 2
+
+# Bitrate of the audio of re-encoded videos.
+AUDIO_BITRATE: int = 128 * 1000  # bits per second
+
+# Re-encoded videos get a lower bitrate than this only if they can't fit otherwise, which isn't worth it.
+MIN_VIDEO_BITRATE: int = 200 * 1000  # bits per second
+
+# Share of the upload limit that re-encoded videos aim for, since a single-pass encode overshoots its bitrate a little.
+TARGET_SIZE_MARGIN: float = 0.9
+
+# Codecs (as reported by yt-dlp, without their profile) that Telegram clients can stream.
+STREAMABLE_VIDEO_CODECS: Tuple[str, ...] = ("avc1", "h264")
+STREAMABLE_AUDIO_CODECS: Tuple[str, ...] = ("mp4a", "aac")
+
+# Number of bytes of ffmpeg's error output that are kept for the error message.
+_STDERR_TAIL: int = 2000
+
+logger = logging.getLogger(__name__)
+
+
+class PostprocessResult(NamedTuple):
+    """
+    The post-processed media, and what it took to make it.
+    """
+    media: MediaBuffer
+    action: str
+    input_size: int
+    output_size: int
+    # Wall-clock seconds, including writing in-memory media to disk for ffmpeg.
+    duration: float
+    # CPU seconds (user and system) used by the ffmpeg process. 0 on platforms that don't report it (Windows).
+    cpu_time: float
+
+
+def find_ffmpeg() -> Optional[str]:
+    """
+    Return the path of the ffmpeg executable, or None if it is not installed.
+    """
+    return shutil.which("ffmpeg")
+
+
+def _codec(value: Optional[str]) -> Optional[str]:
+    # yt-dlp reports codecs with their profile, e.g., "avc1.64001F" or "mp4a.40.2".
+    return value.split(".")[0].lower() if value and value != "none" else None
+
+
+def _video_bitrate(max_size: int, duration: float) -> int:
+    """
+    Return the video bitrate at which a video of `duration` seconds fits within `max_size` bytes.
+    """
+    return int(max_size * TARGET_SIZE_MARGIN * 8 / duration) - AUDIO_BITRATE
+
+
+def plan_postprocess(entry: Dict[str, Any], size: int, max_size: int) -> Optional[str]:
+    """
+    Decide how a downloaded video has to be post-processed before it can be sent.
+
+    :param entry: the video's metadata from yt-dlp, with its format selected.
+    :param size: the size of the downloaded video in bytes.
+    :param max_size: the upload limit in bytes.
+
+    :return: `REMUX`, `TRANSCODE`, or None if the video can be sent as it is, or can't be made to fit.
+    """
+    duration: Optional[float] = entry.get("duration")
+    can_transcode: bool = bool(duration) and _video_bitrate(max_size, duration) >= MIN_VIDEO_BITRATE
+    if size > max_size:
+        return TRANSCODE if can_transcode else None
+
+    vcodec, acodec = _codec(entry.get("vcodec")), _codec(entry.get("acodec"))
+    # Unknown codecs are assumed to be fine.
+    if (vcodec or STREAMABLE_VIDEO_CODECS[0]) not in STREAMABLE_VIDEO_CODECS or \
+            (acodec or STREAMABLE_AUDIO_CODECS[0]) not in STREAMABLE_AUDIO_CODECS:
+        if can_transcode:
+            return TRANSCODE
+    if entry.get("ext", "mp4") != "mp4":
+        return REMUX
+    return None
+
+
+def ffmpeg_args(
+    ffmpeg: str,
+    action: str,
+    input_path: str,
+    output_path: str,
+    max_size: int,
+    duration: Optional[float] = None,
+    threads: int = DEFAULT_FFMPEG_THREADS,
+) -> List[str]:
+    """
+    Build the ffmpeg command line that remuxes or re-encodes `input_path` into an mp4 at `output_path`.
+
+    :param max_size: the upload limit in bytes, which a re-encoded video must fit within.
+    :param duration: the video's duration in seconds. Required to re-encode it.
+    """
+    args: List[str] = [ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", input_path]
+    if action == REMUX:
+        args += ["-map", "0", "-c", "copy"]
+    elif action == TRANSCODE:
+        if not duration:
+            raise ValueError("The duration is required to re-encode a video")
+        bitrate: int = _video_bitrate(max_size, duration)
+        args += ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                 "-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(2 * bitrate),
+                 "-c:a", "aac", "-b:a", str(AUDIO_BITRATE), "-threads", str(threads)]
+    else:
+        raise ValueError(f'Unknown post-processing action "{action}"')
+    # Put the index at the start of the file, so that Telegram clients can start playing before it is fully loaded.
+    return args + ["-movflags", "+faststart", "-f", "mp4", output_path]
+
+
+class PostprocessJob(object):
+    """
+    A post-processing job submitted to a `PostProcessor`. Cancelling it kills its ffmpeg process.
+    """
+
+    def __init__(self):
+        # Resolves to a `PostprocessResult`. Set by `PostProcessor.submit`.
+        self.future: "Future[PostprocessResult]"
+        self._process: Optional[subprocess.Popen] = None
+        # Why the job was stopped ("cancelled" or "timed out"), if it was.
+        self._stopped: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._stopped is not None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """
+        Cancel the job: it won't start if it hasn't yet, and its ffmpeg process is killed if it is running.
+        If it completes anyway, its media is released.
+        """
+        with self._lock:
+            if self._stopped is None:
+                self._stopped = reason
+            if self._process is not None and self._process.returncode is None:
+                self._process.kill()
+        if not self.future.cancel():
+            self.future.add_done_callback(_release_result)
+
+    def run(self, args: List[str], timeout: float) -> Tuple[int, float, bytes]:
+        """
+        Run ffmpeg with the given arguments and wait for it to exit.
+
+        :return: its exit code, the CPU seconds it used and the end of its error output.
+        """
+        with self._lock:
+            if self._stopped is not None:
+                raise PostprocessError(f"Post-processing was {self._stopped}")
+            self._process = process = subprocess.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        timer: Optional[threading.Timer] = threading.Timer(timeout, self.cancel, args=("timed out",)) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        try:
+            assert process.stderr
+            with process.stderr:
+                # Reading until ffmpeg exits, so that it never blocks on a full pipe.
+                stderr: bytes = process.stderr.read()
+            returncode, cpu_time = _wait(process)
+            with self._lock:
+                process.returncode = returncode
+        finally:
+            if timer:
+                timer.cancel()
+
+        if self._stopped is not None:
+            raise PostprocessError(f"Post-processing was {self._stopped}")
+        return returncode, cpu_time, stderr[-_STDERR_TAIL:]
+
+
+class PostProcessor(object):
+    """
+    A bounded pool of ffmpeg processes that remux and re-encode downloaded media.
+
+    Jobs are queued once `max_workers` ffmpeg processes are running. Each job is supervised by a thread
+    of the pool, which only waits for its ffmpeg process, so the pool's CPU use is bounded by
+    `max_workers` times `threads`.
+
+    :param max_workers: the maximum number of ffmpeg processes that run at the same time.
+    :param ffmpeg: the ffmpeg executable.
+    :param threads: the number of threads of each ffmpeg process.
+    :param timeout: seconds after which an ffmpeg process is killed. 0 means no timeout.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_POSTPROCESS_WORKERS,
+        ffmpeg: str = "ffmpeg",
+        threads: int = DEFAULT_FFMPEG_THREADS,
+        timeout: float = DEFAULT_POSTPROCESS_TIMEOUT,
+    ):
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+
+        self._ffmpeg: str = ffmpeg
+        self._threads: int = threads
+        self._timeout: float = timeout
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="postprocess")
+        self._jobs: Set[PostprocessJob] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def active_jobs(self) -> int:
+        """
+        The number of jobs that are queued or running.
+        """
+        return len(self._jobs)
+
+    def submit(
+        self,
+        media: MediaBuffer,
+        action: str,
+        max_size: int,
+        duration: Optional[float] = None,
+        directory: str = "./",
+    ) -> PostprocessJob:
+        """
+        Remux or re-encode `media` into a new `MediaBuffer` backed by a file in `directory`.
+
+        The job's future resolves to a `PostprocessResult`. `media` is left as it is; the caller releases it.
+
+        :param action: `REMUX` or `TRANSCODE` (see `plan_postprocess`).
+        :param max_size: the upload limit in bytes.
+        :param duration: the video's duration in seconds. Required to re-encode it.
+        """
+        job = PostprocessJob()
+        with self._lock:
+            self._jobs.add(job)
+            job.future = self._executor.submit(self._run, job, media, action, max_size, duration, directory)
+        job.future.add_done_callback(lambda _: self._discard(job))
+        return job
+
+    def _discard(self, job: PostprocessJob) -> None:
+        with self._lock:
+            self._jobs.discard(job)
+
+    def _run(
+        self,
+        job: PostprocessJob,
+        media: MediaBuffer,
+        action: str,
+        max_size: int,
+        duration: Optional[float],
+        directory: str,
+    ) -> PostprocessResult:
+        start: float = time.perf_counter()
+        input_path: Optional[str] = media.path
+        temporary_input: Optional[str] = None
+        output_path: str = os.path.join(directory, f"{uuid.uuid4()}.mp4")
+        try:
+            if input_path is None:
+                # ffmpeg has to seek in the input, so media held in memory is written to disk first.
+                temporary_input = input_path = os.path.join(directory, f"{uuid.uuid4()}.input")
+                with media.open() as reader, open(temporary_input, "xb") as writer:
+                    shutil.copyfileobj(reader, writer)
+
+            returncode, cpu_time, stderr = job.run(
+                ffmpeg_args(self._ffmpeg, action, input_path, output_path, max_size, duration, self._threads),
+                self._timeout)
+            if returncode != 0:
+                raise PostprocessError(
+                    f"ffmpeg failed to {action} the media (exit code {returncode}): {stderr.decode(errors='replace').strip()}")
+
+            output: MediaBuffer = MediaBuffer.from_file(output_path)
+            if output.size > max_size:
+                output.close()
+                raise MediaTooLargeError(output.size, max_size)
+        except BaseException:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        finally:
+            if temporary_input is not None and os.path.exists(temporary_input):
+                os.remove(temporary_input)
+
+        return PostprocessResult(output, action, media.size, output.size, time.perf_counter() - start, cpu_time)
+
+    def cancel_all(self) -> int:
+        """
+        Cancel all queued and running jobs.
+
+        :return: the number of jobs cancelled.
+        """
+        with self._lock:
+            jobs: List[PostprocessJob] = list(self._jobs)
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def shutdown(self) -> None:
+        """
+        Cancel all jobs and wait for their ffmpeg processes to exit.
+        """
+        cancelled: int = self.cancel_all()
+        if cancelled:
+            logger.info("Cancelled %d post-processing job(s).", cancelled)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _wait(process: subprocess.Popen) -> Tuple[int, float]:
+    """
+    Wait for `process` to exit.
+
+    :return: its exit code (negative if a signal killed it, like `Popen.returncode`), and the CPU seconds it
+             used, which are 0 where the platform doesn't report the resources of child processes (Windows).
+    """
+    if not hasattr(os, "wait4"):
+        return process.wait(), 0.0
+
+    # Unlike `Popen.wait`, `wait4` reports the resources that the process used.
+    _, status, usage = os.wait4(process.pid, 0)
+    returncode: int = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return returncode, usage.ru_utime + usage.ru_stime
+
+
+def _release_result(future: "Future[PostprocessResult]") -> None:
+    """
+    Release the media of a job that was cancelled too late to stop it.
+    """
+    if not future.cancelled() and future.exception() is None:
+        future.result().media.close()
@@ -0,0 +1,271 @@
+"""
+Rate limiting of outbound Telegram Bot API requests.
+
+Telegram allows roughly 30 messages per second overall, one per second in a private chat and
+20 per minute in a group. Requests are throttled with token buckets so that bursts stay below
+those limits, media replies and inline answers go ahead of low-priority traffic (e.g., cleanup
+deletes and welcome messages), and flood-wait (`RetryAfter`) errors pause the affected chat
+and are retried.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+DEFAULT_OVERALL_RATE: float = 30.0  # requests per second
+DEFAULT_CHAT_RATE: float = 1.0  # requests per second, per private chat
+DEFAULT_CHAT_BURST: int = 3
+DEFAULT_GROUP_RATE: float = 20 / 60  # requests per second, per group
+DEFAULT_GROUP_BURST: int = 5
+DEFAULT_FLOOD_RETRIES: int = 2
+
+# Request priorities. Lower values are sent first.
+PRIORITY_HIGH: int = 0
+PRIORITY_NORMAL: int = 1
+PRIORITY_LOW: int = 2
+
+# Priority of each endpoint, unless overridden by `rate_limit_args`.
+ENDPOINT_PRIORITIES: Dict[str, int] = {
+    "answerInlineQuery": PRIORITY_HIGH,
+    "sendVideo": PRIORITY_HIGH,
+    "sendMediaGroup": PRIORITY_HIGH,
+    "deleteMessage": PRIORITY_LOW,
+    "deleteMessages": PRIORITY_LOW,
+    "leaveChat": PRIORITY_LOW,
+}
+
+# Idle chat buckets are dropped once there are more than this many.
+_MAX_CHAT_BUCKETS: int = 10000
+
+
+def _retry_after_seconds(ex: RetryAfter) -> float:
+    """
+    Return how long a flood wait lasts, in seconds.
+
+    Like PTB's own rate limiter, this reads the timedelta that PTB 22.2+ keeps, to avoid the deprecation
+    warning of the int `retry_after`. Older versions only have `retry_after`, as an int.
+    """
+    retry_after: Union[int, float, timedelta] = getattr(ex, "_retry_after", None) or ex.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average, with bursts of up to `capacity` requests.
+
+    :param clock: returns the current time in seconds. Defaults to `time.monotonic`.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self._rate: float = rate
+        self._capacity: float = capacity
+        self._clock: Callable[[], float] = clock
+        self._tokens: float = capacity
+        # Tokens accrue from this time on. It is in the future while the bucket is paused.
+        self._updated: float = clock()
+
+    def _refill(self) -> float:
+        now: float = self._clock()
+        if now > self._updated:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+        return now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def delay(self) -> float:
+        """
+        Seconds until a token is available. 0 if one is available now.
+        """
+        now: float = self._refill()
+        return max(0.0, self._updated - now) + max(0.0, 1 - self._tokens) / self._rate
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hand out no tokens for `seconds`, e.g., because Telegram asked us to back off.
+        """
+        now: float = self._refill()
+        self._updated = max(self._updated, now + seconds)
+        self._tokens = min(self._tokens, 1)
+
+
+def _is_group(chat_id: Union[int, str]) -> bool:
+    # Group, supergroup and channel IDs are negative; channels may also be addressed by "@username".
+    return str(chat_id).startswith(("-", "@"))
+
+
+class TelegramRateLimiter(BaseRateLimiter[int]):
+    """
+    Throttles outbound Bot API requests with an overall token bucket and one per chat, and retries
+    requests that fail with `RetryAfter`.
+
+    Requests wait for their chat's bucket first, then for the overall bucket, which is handed out in
+    order of priority: `ENDPOINT_PRIORITIES`, or the `rate_limit_args` passed to an `ExtBot` method
+    (one of `PRIORITY_HIGH`, `PRIORITY_NORMAL` and `PRIORITY_LOW`).
+
+    :param overall_rate: requests per second across all chats. 0 disables the overall limit.
+    :param chat_rate: requests per second per private chat. 0 disables the per-chat limits.
+    :param group_rate: requests per second per group or channel.
+    :param max_retries: how often a request is retried after a `RetryAfter` error.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = DEFAULT_OVERALL_RATE,
+        chat_rate: float = DEFAULT_CHAT_RATE,
+        chat_burst: int = DEFAULT_CHAT_BURST,
+        group_rate: float = DEFAULT_GROUP_RATE,
+        group_burst: int = DEFAULT_GROUP_BURST,
+        max_retries: int = DEFAULT_FLOOD_RETRIES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._overall_rate: float = overall_rate
+        self._chat_rate: float = chat_rate
+        self._chat_burst: int = chat_burst
+        self._group_rate: float = group_rate
+        self._group_burst: int = group_burst
+        self._max_retries: int = max_retries
+        self._clock: Callable[[], float] = clock
+
+        self._overall: Optional[TokenBucket] = TokenBucket(
+            overall_rate, max(1.0, overall_rate), clock) if overall_rate > 0 else None
+        self._chats: Dict[str, TokenBucket] = {}
+
+        # (priority, sequence number, waiter) of requests waiting for the overall bucket.
+        self._waiting: List[Tuple[int, int, "asyncio.Future[None]"]] = []
+        self._sequence = itertools.count()
+        self._dispatcher: Optional["asyncio.Task[None]"] = None
+
+        self._num_throttled: int = 0
+        self._num_flood_waits: int = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for _, _, waiter in self._waiting:
+            waiter.cancel()
+        self._waiting.clear()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        priority: int = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_NORMAL)
+        chat_id: Optional[Union[int, str]] = data.get("chat_id")
+
+        retries: int = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as ex:
+                self._num_flood_waits += 1
+                retry_after: float = _retry_after_seconds(ex)
+                self.logger.warning(
+                    "Flood control on %s for chat %s: pausing for %gs (retry %d/%d).",
+                    endpoint, chat_id, retry_after, retries + 1, self._max_retries)
+
+                bucket: Optional[TokenBucket] = self._chat_bucket(chat_id) if chat_id is not None else None
+                if bucket is None:
+                    bucket = self._overall
+                if bucket is not None:
+                    bucket.pause(retry_after)
+
+                if retries >= self._max_retries:
+                    raise
+                retries += 1
+
+                if bucket is None:
+                    await asyncio.sleep(retry_after)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> Optional[TokenBucket]:
+        if self._chat_rate <= 0:
+            return None
+
+        key: str = str(chat_id)
+        bucket: Optional[TokenBucket] = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                # A full bucket is indistinguishable from a new one.
+                self._chats = {key: bucket for key, bucket in self._chats.items() if not bucket.full}
+            if _is_group(chat_id):
+                bucket = TokenBucket(self._group_rate, self._group_burst, self._clock)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst, self._clock)
+            self._chats[key] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: Optional[Union[int, str]], priority: int) -> None:
+        throttled: bool = False
+
+        bucket: Optional[TokenBucket] = self._chat_bucket(chat_id) if chat_id is not None else None
+        if bucket is not None:
+            # Re-check after sleeping, since the chat may have been paused in the meantime.
+            while (delay := bucket.delay()) > 0:
+                throttled = True
+                await asyncio.sleep(delay)
+            bucket.take()
+
+        if self._overall is not None:
+            if self._waiting or self._overall.delay() > 0:
+                throttled = True
+                waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+                heapq.heappush(self._waiting, (priority, next(self._sequence), waiter))
+                if self._dispatcher is None or self._dispatcher.done():
+                    self._dispatcher = asyncio.ensure_future(self._dispatch())
+                await waiter
+            else:
+                self._overall.take()
+
+        if throttled:
+            self._num_throttled += 1
+
+    async def _dispatch(self) -> None:
+        """
+        Hand out overall tokens to waiting requests in order of priority.
+        """
+        assert self._overall is not None
+        while self._waiting:
+            delay: float = self._overall.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, waiter = heapq.heappop(self._waiting)
+            if waiter.done():
+                continue  # Cancelled while waiting.
+            self._overall.take()
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "waiting": len(self._waiting),
+            "throttled": self._num_throttled,
+            "flood_waits": self._num_flood_waits,
+        }
@@ -0,0 +1,328 @@
+"""
+Retries, backoff and circuit breaking for downloads, per platform.
+
+When a platform rate-limits or throttles the bot, transient errors are retried with jittered
+exponential backoff. If the platform's error rate stays high, its circuit breaker opens and
+downloads from it fail fast until a cool-down period has passed.
+"""
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from telegram_media_downloader_bot.errors import CircuitOpenError, MediaTooLargeError, QueueFullError, RestrictedMediaError
+
+T = TypeVar("T")
+
+DEFAULT_DOWNLOAD_ATTEMPTS: int = 3
+DEFAULT_RETRY_BASE_DELAY: float = 1.0  # seconds
+DEFAULT_RETRY_MAX_DELAY: float = 15.0  # seconds
+
+DEFAULT_BREAKER_FAILURE_RATE: float = 0.5
+DEFAULT_BREAKER_MIN_CALLS: int = 5
+DEFAULT_BREAKER_WINDOW: float = 60.0  # seconds
+DEFAULT_BREAKER_COOLDOWN: float = 30.0  # seconds
+# How long callers rejected while a half-open breaker's trial call is running are told to wait.
+DEFAULT_BREAKER_TRIAL_INTERVAL: float = 5.0  # seconds
+
+# Circuit breaker states.
+CLOSED: str = "closed"
+OPEN: str = "open"
+HALF_OPEN: str = "half-open"
+
+# Error classes.
+TRANSIENT: str = "transient"
+RESTRICTED: str = "restricted"
+PERMANENT: str = "permanent"
+
+# HTTP status codes that are worth retrying.
+_TRANSIENT_STATUSES: Tuple[int, ...] = (408, 425, 429, 500, 502, 503, 504)
+
+_RESTRICTED_PATTERN = re.compile(
+    r"restricted video|age[- ]restricted|confirm your age|inappropriate for some users|login required|"
+    r"requested content is not available|private video", re.IGNORECASE)
+_TRANSIENT_PATTERN = re.compile(
+    r"http error (?:408|425|429|5\d\d)|too many requests|rate[- ]limit|try again later|timed? ?out|"
+    r"connection (?:reset|refused|aborted)|temporary failure|remote end closed|incomplete ?read", re.IGNORECASE)
+
+
+def _causes(ex: BaseException) -> Tuple[BaseException, ...]:
+    """
+    The chain of errors behind `ex`, including the original error wrapped by yt-dlp's `DownloadError`.
+    """
+    chain = []
+    seen = set()
+    current: Optional[BaseException] = ex
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        chain.append(current)
+        exc_info = getattr(current, "exc_info", None)
+        wrapped = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        current = wrapped if isinstance(wrapped, BaseException) else (current.__cause__ or current.__context__)
+    return tuple(chain)
+
+
+def classify_error(ex: BaseException) -> str:
+    """
+    Classify a download error as `TRANSIENT` (worth retrying), `RESTRICTED` (age-restricted, private or
+    login-only media) or `PERMANENT`.
+    """
+    for cause in _causes(ex):
+        if isinstance(cause, RestrictedMediaError):
+            return RESTRICTED
+        if isinstance(cause, (MediaTooLargeError, QueueFullError, CircuitOpenError)):
+            return PERMANENT
+        status = getattr(getattr(cause, "response", None), "status", None) or getattr(cause, "status", None)
+        if isinstance(status, int):
+            return TRANSIENT if status in _TRANSIENT_STATUSES else PERMANENT
+        if isinstance(cause, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+            return TRANSIENT
+
+    message: str = " ".join(str(cause) for cause in _causes(ex))
+    if _RESTRICTED_PATTERN.search(message):
+        return RESTRICTED
+    if _TRANSIENT_PATTERN.search(message):
+        return TRANSIENT
+    # Includes network errors from yt-dlp's own networking stack, which don't subclass the builtins.
+    if any(type(cause).__name__ in ("TransportError", "ProxyError", "SSLError") for cause in _causes(ex)):
+        return TRANSIENT
+    return PERMANENT
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of recent calls and opens once the failure rate within `window` seconds reaches
+    `failure_rate` (over at least `min_calls` calls). While open, calls are rejected. After `cooldown`
+    seconds, the breaker is half-open and lets a single trial call through, which closes it again if
+    it succeeds.
+
+    :param name: name of the protected platform, for errors.
+    :param trial_interval: seconds that calls rejected while the trial call is running are told to wait.
+    :param clock: returns the current time in seconds. Defaults to `time.monotonic`.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        failure_rate: float = DEFAULT_BREAKER_FAILURE_RATE,
+        min_calls: int = DEFAULT_BREAKER_MIN_CALLS,
+        window: float = DEFAULT_BREAKER_WINDOW,
+        cooldown: float = DEFAULT_BREAKER_COOLDOWN,
+        trial_interval: float = DEFAULT_BREAKER_TRIAL_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name: str = name
+        self._failure_rate: float = failure_rate
+        self._min_calls: int = min_calls
+        self._window: float = window
+        self._cooldown: float = cooldown
+        self._trial_interval: float = trial_interval
+        self._clock: Callable[[], float] = clock
+
+        # (time, succeeded) of recent calls.
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._state: str = CLOSED
+        self._opened_at: float = 0.0
+        self._trial_in_progress: bool = False
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self._cooldown:
+            return HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the breaker lets a trial call through, or, while the trial call is running, until it is
+        worth trying again. 0 if calls go through.
+        """
+        state: str = self.state
+        if state == OPEN:
+            return max(0.0, self._opened_at + self._cooldown - self._clock())
+        if state == HALF_OPEN and self._trial_in_progress:
+            return self._trial_interval
+        return 0.0
+
+    def before_call(self) -> None:
+        """
+        :raises CircuitOpenError: if the call must fail fast.
+        """
+        state: str = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self._trial_in_progress:
+            self._state = HALF_OPEN
+            self._trial_in_progress = True
+            return
+        raise CircuitOpenError(self.name, self.retry_after())
+
+    def record_success(self) -> None:
+        if self._state == HALF_OPEN:
+            self._state = CLOSED
+            self._trial_in_progress = False
+            self._outcomes.clear()
+        self._record(True)
+
+    def record_cancelled(self) -> None:
+        """
+        A cancelled trial call didn't tell us anything about the platform, so let another one through.
+        """
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        if self._state == HALF_OPEN:
+            self._open()
+            return
+        self._record(False)
+
+        failures: int = sum(1 for _, succeeded in self._outcomes if not succeeded)
+        if len(self._outcomes) >= self._min_calls and failures / len(self._outcomes) >= self._failure_rate:
+            self._open()
+
+    def _record(self, succeeded: bool) -> None:
+        now: float = self._clock()
+        self._outcomes.append((now, succeeded))
+        while self._outcomes and now - self._outcomes[0][0] > self._window:
+            self._outcomes.popleft()
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._trial_in_progress = False
+        self._outcomes.clear()
+
+
+class Resilience(object):
+    """
+    Runs downloads with retries and a circuit breaker per platform.
+
+    :param max_attempts: attempts per download, including the first one. 1 disables retries.
+    :param base_delay: backoff before the first retry, in seconds. It doubles with every retry.
+    :param max_delay: maximum backoff, in seconds.
+    :param on_retry: called with the platform and the error whenever a download is retried.
+    :param on_state_change: called with the platform and the new state whenever a breaker changes state.
+    :param on_reject: called with the platform whenever a download is rejected because its breaker is open.
+    :param sleep: waits for the backoff. Defaults to `asyncio.sleep`.
+    :param jitter: returns a random factor in [0, 1) for the backoff. Defaults to `random.random`.
+    :param breaker_options: keyword arguments for each platform's `CircuitBreaker`.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = DEFAULT_DOWNLOAD_ATTEMPTS,
+        base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+        max_delay: float = DEFAULT_RETRY_MAX_DELAY,
+        on_retry: Optional[Callable[[str, BaseException], None]] = None,
+        on_state_change: Optional[Callable[[str, str], None]] = None,
+        on_reject: Optional[Callable[[str], None]] = None,
+        sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep,
+        jitter: Callable[[], float] = random.random,
+        **breaker_options: Any,
+    ):
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be at least 1, got {max_attempts}")
+
+        self._max_attempts: int = max_attempts
+        self._base_delay: float = base_delay
+        self._max_delay: float = max_delay
+        self._on_retry: Optional[Callable[[str, BaseException], None]] = on_retry
+        self._on_state_change: Optional[Callable[[str, str], None]] = on_state_change
+        self._on_reject: Optional[Callable[[str], None]] = on_reject
+        self._sleep: Callable[[float], Awaitable[Any]] = sleep
+        self._jitter: Callable[[], float] = jitter
+        self._breaker_options: Dict[str, Any] = breaker_options
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+        self.logger = logging.getLogger(__name__)
+
+    def breaker(self, platform: str) -> CircuitBreaker:
+        breaker: Optional[CircuitBreaker] = self._breakers.get(platform)
+        if breaker is None:
+            breaker = self._breakers[platform] = CircuitBreaker(platform, **self._breaker_options)
+        return breaker
+
+    def check(self, platform: str) -> None:
+        """
+        Fail fast if the platform's breaker is open, e.g., before queueing a download.
+
+        :raises CircuitOpenError: if the platform's breaker is open.
+        """
+        breaker: CircuitBreaker = self.breaker(platform)
+        if breaker.state == OPEN:
+            self._reject(breaker)
+
+    def _reject(self, breaker: CircuitBreaker) -> None:
+        if self._on_reject:
+            self._on_reject(breaker.name)
+        raise CircuitOpenError(breaker.name, breaker.retry_after())
+
+    def states(self) -> Dict[str, Tuple[str, float]]:
+        """
+        The state of each platform's breaker and the seconds until it lets a trial call through.
+        """
+        return {platform: (breaker.state, breaker.retry_after()) for platform, breaker in sorted(self._breakers.items())}
+
+    def backoff(self, retry: int) -> float:
+        """
+        The delay before the `retry`-th retry (starting at 1), with full jitter.
+        """
+        return self._jitter() * min(self._max_delay, self._base_delay * 2 ** (retry - 1))
+
+    async def call(self, platform: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Call `func` until it succeeds, fails with an error that isn't transient, or runs out of attempts.
+
+        :raises CircuitOpenError: if the platform's breaker is open.
+        """
+        breaker: CircuitBreaker = self.breaker(platform)
+        attempt: int = 1
+        while True:
+            try:
+                self._guarded(platform, breaker, breaker.before_call)
+            except CircuitOpenError:
+                self._reject(breaker)
+            try:
+                result: T = await func()
+            except asyncio.CancelledError:
+                breaker.record_cancelled()
+                raise
+            except Exception as ex:
+                kind: str = classify_error(ex)
+                if kind != TRANSIENT:
+                    # The platform responded; the request itself can't succeed.
+                    self._guarded(platform, breaker, breaker.record_success)
+                    raise
+
+                self._guarded(platform, breaker, breaker.record_failure)
+                if attempt >= self._max_attempts or breaker.state != CLOSED:
+                    raise
+
+                delay: float = self.backoff(attempt)
+                self.logger.warning(
+                    "Transient error downloading from %s (attempt %d/%d), retrying in %.1fs: %s",
+                    platform, attempt, self._max_attempts, delay, ex)
+                if self._on_retry:
+                    self._on_retry(platform, ex)
+                await self._sleep(delay)
+                attempt += 1
+                continue
+
+            self._guarded(platform, breaker, breaker.record_success)
+            return result
+
+    def _guarded(self, platform: str, breaker: CircuitBreaker, action: Callable[[], None]) -> None:
+        """
+        Run a breaker action, reporting the state change if there is one.
+        """
+        before: str = breaker.state
+        try:
+            action()
+        finally:
+            after: str = breaker.state
+            if after != before:
+                self.logger.warning("Circuit breaker for %s is now %s.", platform, after)
+                if self._on_state_change:
+                    self._on_state_change(platform, after)
@@ -0,0 +1,205 @@
+"""
+Fair scheduling of downloads across chats and users.
+
+Queued downloads are grouped per chat and, within each chat, per user. Downloads are started
+round-robin across chats, and round-robin across users within a chat, so that one busy group
+(or one busy user) can't starve everybody else. The total number of queued downloads is
+bounded; once the bound is reached new downloads are rejected immediately.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from telegram_media_downloader_bot.errors import QueueFullError
+
+DEFAULT_MAX_QUEUE_DEPTH: int = 100
+
+# Number of recent queue wait times kept for reporting.
+_WAIT_TIME_SAMPLES: int = 1000
+
+
+class _Job(object):
+    def __init__(self, chat_id: str, user_id: str, factory: Callable[[], Awaitable[Any]]):
+        self.chat_id: str = chat_id
+        self.user_id: str = user_id
+        self.factory: Callable[[], Awaitable[Any]] = factory
+        self.future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self.enqueued_at: float = time.monotonic()
+
+
+class FairScheduler(object):
+    """
+    Runs submitted downloads with bounded concurrency and per-chat/per-user round-robin fairness.
+
+    :param max_concurrency: maximum number of downloads that run at the same time.
+    :param max_queue_depth: maximum number of downloads waiting to start.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH):
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+
+        self._max_concurrency: int = max_concurrency
+        self._max_queue_depth: int = max_queue_depth
+
+        # chat ID -> user ID -> queued jobs. Both levels are kept in round-robin order.
+        self._queues: "OrderedDict[str, OrderedDict[str, Deque[_Job]]]" = OrderedDict()
+        self._queue_depth: int = 0
+        self._running: int = 0
+        self._tasks: Set["asyncio.Future[None]"] = set()
+        self._running_jobs: Set[_Job] = set()
+
+        self._wait_times: Deque[float] = deque(maxlen=_WAIT_TIME_SAMPLES)
+        self._num_rejected: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of downloads waiting to start.
+        """
+        return self._queue_depth
+
+    @property
+    def running(self) -> int:
+        """
+        Number of downloads currently running.
+        """
+        return self._running
+
+    @property
+    def max_queue_depth(self) -> int:
+        return self._max_queue_depth
+
+    async def submit(self, chat_id: str, user_id: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Queue a download and wait for its result.
+
+        :param chat_id: the chat that requested the download.
+        :param user_id: the user that requested the download.
+        :param factory: creates the awaitable that performs the download once it is scheduled.
+
+        :raises QueueFullError: if the queue is full.
+        """
+        if self._queue_depth >= self._max_queue_depth:
+            self._num_rejected += 1
+            raise QueueFullError(
+                f"Download queue is full ({self._queue_depth}/{self._max_queue_depth} queued)")
+
+        job = _Job(chat_id, user_id, factory)
+        self._queues.setdefault(chat_id, OrderedDict()).setdefault(user_id, deque()).append(job)
+        self._queue_depth += 1
+        self._dispatch()
+
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if not job.future.done():
+                # The requester gave up before the download started.
+                self._remove(job)
+                job.future.cancel()
+            raise
+
+    def cancel_all(self, error: Exception) -> int:
+        """
+        Fail every queued and running download with `error`, e.g., when shutting down.
+
+        :return: the number of downloads that were failed.
+        """
+        jobs: List[_Job] = [job for users in self._queues.values() for queued in users.values() for job in queued]
+        jobs.extend(self._running_jobs)
+        self._queues.clear()
+        self._queue_depth = 0
+
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(error)
+        for task in list(self._tasks):
+            task.cancel()
+        return len(jobs)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a snapshot of the queue for reporting.
+        """
+        wait_times: List[float] = sorted(self._wait_times)
+        per_chat: List[Tuple[str, int]] = sorted(
+            ((chat_id, sum(len(jobs) for jobs in users.values())) for chat_id, users in self._queues.items()),
+            key=lambda item: item[1], reverse=True)
+
+        return {
+            "queue_depth": self._queue_depth,
+            "max_queue_depth": self._max_queue_depth,
+            "running": self._running,
+            "max_concurrency": self._max_concurrency,
+            "rejected": self._num_rejected,
+            "queued_per_chat": per_chat,
+            "mean_wait": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "p95_wait": wait_times[int(0.95 * (len(wait_times) - 1))] if wait_times else 0.0,
+            "max_wait": wait_times[-1] if wait_times else 0.0,
+        }
+
+    def _next_job(self) -> Optional[_Job]:
+        if not self._queues:
+            return None
+
+        chat_id, users = next(iter(self._queues.items()))
+        user_id, jobs = next(iter(users.items()))
+        job: _Job = jobs.popleft()
+
+        # Rotate: this user goes to the back of its chat, and this chat to the back of all chats.
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+
+        if users:
+            self._queues.move_to_end(chat_id)
+        else:
+            del self._queues[chat_id]
+
+        self._queue_depth -= 1
+        return job
+
+    def _remove(self, job: _Job) -> None:
+        users = self._queues.get(job.chat_id)
+        jobs = users.get(job.user_id) if users else None
+        if not users or not jobs or job not in jobs:
+            return
+
+        jobs.remove(job)
+        self._queue_depth -= 1
+        if not jobs:
+            del users[job.user_id]
+        if not users:
+            del self._queues[job.chat_id]
+
+    def _dispatch(self) -> None:
+        while self._running < self._max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+
+            self._wait_times.append(time.monotonic() - job.enqueued_at)
+            self._running += 1
+            task = asyncio.ensure_future(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: _Job) -> None:
+        self._running_jobs.add(job)
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as ex:
+            if not job.future.done():
+                job.future.set_exception(ex)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running_jobs.discard(job)
+            self._running -= 1
+            self._dispatch()
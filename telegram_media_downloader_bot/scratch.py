@@ -0,0 +1,215 @@
+"""
+Managed scratch space for downloads that spill to disk.
+
+Every download reserves space against a byte quota before it starts, and a background
+sweeper deletes files that were left behind (e.g., by a crash or a failed cleanup).
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+DEFAULT_SCRATCH_DIR: str = os.path.join(tempfile.gettempdir(), "telegram_media_downloader_bot")
+DEFAULT_SCRATCH_QUOTA: int = 1024 * 1024 * 1024  # bytes
+DEFAULT_ORPHAN_TTL: float = 60 * 60  # seconds
+DEFAULT_SWEEP_INTERVAL: float = 5 * 60  # seconds
+
+
+class Reservation(object):
+    """
+    Space reserved in a `ScratchSpace`. Release it once the file it was reserved for has been removed.
+    """
+
+    def __init__(self, scratch: "ScratchSpace", size: int):
+        self._scratch: "ScratchSpace" = scratch
+        self._size: int = size
+        self._paths: Set[str] = set()
+        self._released: bool = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def resize(self, size: int) -> None:
+        """
+        Shrink (or grow) the reservation, e.g., to the actual size of the download once it is known.
+        """
+        if not self._released:
+            self._scratch._resize(self, size)
+
+    def attach(self, path: Optional[str]) -> None:
+        """
+        Associate the reservation with a file it was made for, so that the sweeper leaves the file alone.
+        """
+        if self._released or path is None:
+            return
+        path = os.path.abspath(path)
+        self._paths.add(path)
+        self._scratch._live_paths.add(path)
+
+    def release(self, *args: Any) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._scratch._live_paths.difference_update(self._paths)
+        self._scratch._resize(self, 0)
+
+
+class ScratchSpace(object):
+    """
+    A directory for downloaded media with a byte quota and a sweeper for orphaned files.
+
+    Reservations are made and released on the event loop. The sweeper runs on a background thread.
+
+    :param directory: directory in which media is written. Created if it does not exist.
+    :param quota: maximum number of bytes that may be reserved at once. 0 means unlimited.
+    :param orphan_ttl: files older than this many seconds that don't belong to a reservation are deleted.
+    :param sweep_interval: seconds between sweeps. 0 disables the background sweeper.
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_SCRATCH_DIR,
+        quota: int = DEFAULT_SCRATCH_QUOTA,
+        orphan_ttl: float = DEFAULT_ORPHAN_TTL,
+        sweep_interval: float = DEFAULT_SWEEP_INTERVAL,
+    ):
+        self._directory: str = directory
+        self._quota: int = quota
+        self._orphan_ttl: float = orphan_ttl
+        self._sweep_interval: float = sweep_interval
+
+        self._reserved: int = 0
+        self._waiters: List["asyncio.Future[None]"] = []
+        self._live_paths: Set[str] = set()
+
+        self._num_swept: int = 0
+        self._bytes_swept: int = 0
+
+        self.logger = logging.getLogger(__name__)
+
+        os.makedirs(self._directory, exist_ok=True)
+
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        if sweep_interval > 0:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="scratch-sweeper", daemon=True)
+            self._sweeper.start()
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def quota(self) -> int:
+        return self._quota
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def _fits(self, size: int) -> bool:
+        return not self._quota or self._reserved + size <= self._quota
+
+    async def reserve(self, size: int) -> Reservation:
+        """
+        Reserve `size` bytes, waiting until enough space has been released if the quota is exhausted.
+
+        :raises ValueError: if `size` exceeds the quota, so the reservation could never be granted.
+        """
+        if self._quota and size > self._quota:
+            raise ValueError(f"Cannot reserve {size} bytes with a quota of {self._quota} bytes")
+
+        loop = asyncio.get_running_loop()
+        while not self._fits(size):
+            waiter: "asyncio.Future[None]" = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+        reservation = Reservation(self, size)
+        self._reserved += size
+        return reservation
+
+    def _resize(self, reservation: Reservation, size: int) -> None:
+        self._reserved += size - reservation._size
+        reservation._size = size
+
+        # Let every waiter re-check whether its reservation fits now.
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        Delete files older than the orphan TTL that don't belong to a live reservation.
+
+        :return: the number of files deleted.
+        """
+        now = time.time() if now is None else now
+        deleted: int = 0
+
+        for entry in os.scandir(self._directory):
+            try:
+                if not entry.is_file() or os.path.abspath(entry.path) in self._live_paths:
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime < self._orphan_ttl:
+                    continue
+                os.remove(entry.path)
+            except OSError as ex:
+                # Removed concurrently, or not ours to remove.
+                self.logger.debug('Could not sweep "%s": %s', entry.path, ex)
+                continue
+
+            deleted += 1
+            self._num_swept += 1
+            self._bytes_swept += stat.st_size
+            self.logger.warning('Deleted orphaned scratch file "%s" (%d bytes).', entry.path, stat.st_size)
+
+        return deleted
+
+    def _sweep_loop(self) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception as ex:
+                self.logger.error("Scratch sweep failed: %s", ex)
+            if self._stop.wait(self._sweep_interval):
+                return
+
+    def usage(self) -> Dict[str, Any]:
+        """
+        Report the scratch directory's disk usage, reservations and sweeper activity.
+        """
+        files: int = 0
+        disk_bytes: int = 0
+        for entry in os.scandir(self._directory):
+            try:
+                if entry.is_file():
+                    files += 1
+                    disk_bytes += entry.stat().st_size
+            except OSError:
+                pass  # Removed while scanning.
+
+        return {
+            "directory": self._directory,
+            "files": files,
+            "disk_bytes": disk_bytes,
+            "reserved": self._reserved,
+            "quota": self._quota,
+            "waiting": len(self._waiters),
+            "swept": self._num_swept,
+            "bytes_swept": self._bytes_swept,
+        }
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
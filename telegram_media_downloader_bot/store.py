@@ -0,0 +1,194 @@
+"""
+Optional SQLite-backed persistence for bot state.
+
+Writes never touch the database on the calling thread. They are queued and committed in
+batches by a background writer thread, and the database runs in write-ahead-log mode with
+`synchronous=NORMAL`, so handlers never wait on fsync.
+
+Expired file IDs are deleted, and the number of file IDs is capped, at startup and whenever
+the writer commits new ones, so the database stays as bounded as the in-memory cache.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_FLUSH_INTERVAL: float = 0.5  # seconds
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS file_ids (
+    key TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS authenticated_chats (
+    chat_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS user_chats (
+    user_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Sentinel that tells the writer thread to exit.
+_STOP = object()
+
+_Write = Tuple[str, Sequence[Any]]
+
+
+class StateStore(object):
+    """
+    Persists the file ID cache, authenticated chats, user -> private chat mappings and counters.
+
+    :param path: path of the SQLite database file. Created if it does not exist.
+    :param flush_interval: how long (in seconds) the writer waits to batch further writes into one transaction.
+    :param max_file_ids: the maximum number of file IDs kept; the ones that expire soonest are deleted first.
+                         If None, only expired file IDs are deleted.
+    """
+
+    def __init__(self, path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL, max_file_ids: Optional[int] = None):
+        self._path: str = path
+        self._flush_interval: float = flush_interval
+        self._max_file_ids: Optional[int] = max_file_ids
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._closed: bool = False
+
+        self.logger = logging.getLogger(__name__)
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executescript(_SCHEMA)
+                self._prune_file_ids(conn)
+        finally:
+            conn.close()
+
+        self._writer = threading.Thread(
+            target=self._write_loop, name="state-store-writer", daemon=True)
+        self._writer.start()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _prune_file_ids(self, conn: sqlite3.Connection) -> None:
+        """
+        Delete expired file IDs, and then the ones that expire soonest beyond `max_file_ids`.
+        """
+        conn.execute("DELETE FROM file_ids WHERE expires_at <= ?", (time.time(),))
+        if self._max_file_ids is not None:
+            conn.execute("DELETE FROM file_ids WHERE key NOT IN "
+                         "(SELECT key FROM file_ids ORDER BY expires_at DESC LIMIT ?)", (self._max_file_ids,))
+
+    def _query(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple[Any, ...]]:
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def load_file_ids(self, now: Optional[float] = None) -> List[Tuple[str, str, float]]:
+        """
+        Return the unexpired (key, file_id, expires_at) entries, ordered from oldest to newest.
+        """
+        now = time.time() if now is None else now
+        return [(str(key), str(file_id), float(expires_at)) for key, file_id, expires_at in self._query(
+            "SELECT key, file_id, expires_at FROM file_ids WHERE expires_at > ? ORDER BY expires_at", (now,))]
+
+    def load_authenticated_chats(self) -> List[str]:
+        return [str(row[0]) for row in self._query("SELECT chat_id FROM authenticated_chats")]
+
+    def load_user_chats(self) -> Dict[str, str]:
+        return {str(user_id): str(chat_id) for user_id, chat_id in self._query("SELECT user_id, chat_id FROM user_chats")}
+
+    def load_counters(self) -> Dict[str, int]:
+        return {str(name): int(value) for name, value in self._query("SELECT name, value FROM counters")}
+
+    def put_file_id(self, key: str, file_id: str, expires_at: float) -> None:
+        self._enqueue("INSERT OR REPLACE INTO file_ids (key, file_id, expires_at) VALUES (?, ?, ?)",
+                      (key, file_id, expires_at))
+
+    def delete_file_id(self, key: str) -> None:
+        self._enqueue("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    def add_authenticated_chat(self, chat_id: str) -> None:
+        self._enqueue("INSERT OR IGNORE INTO authenticated_chats (chat_id) VALUES (?)", (chat_id,))
+
+    def clear_authenticated_chats(self) -> None:
+        self._enqueue("DELETE FROM authenticated_chats", ())
+
+    def put_user_chat(self, user_id: str, chat_id: str) -> None:
+        self._enqueue("INSERT OR REPLACE INTO user_chats (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id))
+
+    def set_counter(self, name: str, value: int) -> None:
+        self._enqueue("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value))
+
+    def flush(self) -> None:
+        """
+        Block until every queued write has been committed.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Commit any queued writes and stop the writer thread.
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+
+    def _enqueue(self, sql: str, params: Sequence[Any]) -> None:
+        if self._closed:
+            self.logger.warning("Dropping write to closed state store: %s", sql)
+            return
+
+        self._queue.put((sql, params))
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        stopping: bool = False
+
+        try:
+            while not stopping:
+                batch: List[Any] = [self._queue.get()]
+
+                # Give further writes a moment to arrive so that they share a single commit.
+                deadline: float = time.monotonic() + self._flush_interval
+                while batch[-1] is not _STOP:
+                    remaining: float = deadline - time.monotonic()
+                    try:
+                        batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                writes: List[_Write] = [item for item in batch if item is not _STOP]
+                stopping = len(writes) != len(batch)
+
+                try:
+                    with conn:
+                        for sql, params in writes:
+                            conn.execute(sql, params)
+                        if any(sql.startswith("INSERT OR REPLACE INTO file_ids") for sql, _ in writes):
+                            self._prune_file_ids(conn)
+                except Exception as ex:
+                    self.logger.error("Failed to write %d update(s) to state store: %s", len(writes), ex)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            conn.close()
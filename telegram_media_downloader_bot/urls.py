@@ -0,0 +1,114 @@
+"""
+Classification of supported media URLs.
+
+Every supported URL is mapped to its platform, the platform's media ID and a canonical URL,
+so that share variants (`?igsh=...`, `m.`/`www.` hosts, trailing slashes, ...) of the same
+media are treated identically by the download, deduplication and caching layers.
+
+Rules are indexed by host, so classifying a URL costs one dictionary lookup plus the
+(precompiled) path patterns of that host, no matter how many sites are supported.
+"""
+import re
+from typing import Dict, List, NamedTuple, Optional, Pattern
+from urllib.parse import urlsplit
+
+# Host prefixes that don't change which media a URL refers to.
+_IGNORED_HOST_PREFIXES = ("www.", "m.")
+
+# Candidate URLs within free-form message text, with or without a scheme.
+_URL_CANDIDATE_PATTERN: Pattern[str] = re.compile(
+    r"(?:https?://)?(?:[a-z0-9-]+\.)+[a-z]{2,}/[^\s<>\"']*", re.IGNORECASE)
+
+
+class MediaUrl(NamedTuple):
+    """
+    A classified media URL.
+    """
+    platform: str
+    media_id: str
+    canonical_url: str
+
+    @property
+    def key(self) -> str:
+        """
+        Key that uniquely identifies the media, for deduplication and caching.
+        """
+        return f"{self.platform}:{self.media_id}"
+
+
+class _Rule(NamedTuple):
+    platform: str
+    pattern: Pattern[str]
+    canonical_url: str  # Formatted with the named groups of `pattern`.
+
+
+def _rule(platform: str, pattern: str, canonical_url: str) -> _Rule:
+    return _Rule(platform, re.compile(pattern), canonical_url)
+
+
+_YOUTUBE_SHORTS = _rule("youtube", r"^/shorts/(?P<id>[\w-]+)", "https://www.youtube.com/shorts/{id}")
+_INSTAGRAM_REEL = _rule("instagram", r"^/(?:[\w.]+/)?reels?/(?P<id>[\w-]+)", "https://www.instagram.com/reel/{id}/")
+_INSTAGRAM_POST = _rule("instagram", r"^/(?:[\w.]+/)?p/(?P<id>[\w-]+)", "https://www.instagram.com/p/{id}/")
+
+# Host (without "www."/"m.") -> rules to try, in order.
+_RULES_BY_HOST: Dict[str, List[_Rule]] = {
+    "youtube.com": [_YOUTUBE_SHORTS],
+    "youtu.be": [_YOUTUBE_SHORTS],
+    "instagram.com": [_INSTAGRAM_REEL, _INSTAGRAM_POST],
+}
+
+
+def supported_hosts() -> List[str]:
+    """
+    Return the hosts for which media URLs are supported.
+    """
+    return list(_RULES_BY_HOST)
+
+
+def _normalize_host(netloc: str) -> str:
+    host: str = netloc.lower().rsplit("@", 1)[-1].split(":", 1)[0]
+    for prefix in _IGNORED_HOST_PREFIXES:
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+def classify_url(url: str) -> Optional[MediaUrl]:
+    """
+    Classify a single URL.
+
+    :param url: the URL, with or without a scheme.
+
+    :return: the classified URL, or None if the URL is not a supported media URL.
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = f"https://{url}"
+
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return None
+
+    for rule in _RULES_BY_HOST.get(_normalize_host(parts.netloc), ()):
+        match = rule.pattern.match(parts.path)
+        if match:
+            media_id: str = match.group("id")
+            return MediaUrl(rule.platform, media_id, rule.canonical_url.format(id=media_id))
+
+    return None
+
+
+def find_media_urls(text: str) -> List[MediaUrl]:
+    """
+    Find every supported media URL in a message, in order of appearance and without duplicates.
+
+    :param text: free-form message text.
+    """
+    found: Dict[str, MediaUrl] = {}
+    for candidate in _URL_CANDIDATE_PATTERN.findall(text):
+        media_url = classify_url(candidate)
+        if media_url and media_url.key not in found:
+            found[media_url.key] = media_url
+
+    return list(found.values())
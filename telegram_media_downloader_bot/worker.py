@@ -0,0 +1,225 @@
+"""
+Download workers for split mode.
+
+Workers take jobs off the job queue that the bot frontend puts them on (see `--job-queue`),
+download the media, send it to the chat that requested it and report the result back.
+Run as many workers as needed, on as many hosts as needed:
+
+    python -m telegram_media_downloader_bot.worker --job-queue redis://localhost:6379/0 --processes 4
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from argparse import ArgumentParser, Namespace
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+from telegram import Bot
+from telegram.ext import ExtBot
+
+from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.buffer import DEFAULT_SPOOL_THRESHOLD
+from telegram_media_downloader_bot.downloader import DEFAULT_DOWNLOAD_WORKERS, DEFAULT_MAX_UPLOAD_SIZE
+from telegram_media_downloader_bot.jobs import Job, JobQueue, JobResult, open_job_queue
+from telegram_media_downloader_bot.parallel import DEFAULT_CONNECTIONS_PER_DOWNLOAD, DEFAULT_MAX_CONNECTIONS
+from telegram_media_downloader_bot.postprocess import DEFAULT_POSTPROCESS_HEADROOM, DEFAULT_POSTPROCESS_WORKERS
+from telegram_media_downloader_bot.ratelimit import DEFAULT_CHAT_RATE, DEFAULT_OVERALL_RATE, TelegramRateLimiter
+from telegram_media_downloader_bot.resilience import DEFAULT_BREAKER_COOLDOWN, DEFAULT_DOWNLOAD_ATTEMPTS
+from telegram_media_downloader_bot.scratch import DEFAULT_SCRATCH_DIR, DEFAULT_SCRATCH_QUOTA
+
+# How long a worker waits for a job before checking whether it should stop.
+DEFAULT_POLL_TIMEOUT: float = 1.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+async def serve_jobs(
+    downloader: MediaDownloaderBot,
+    job_queue: JobQueue,
+    bot: Bot,
+    concurrency: int = DEFAULT_DOWNLOAD_WORKERS,
+    stop: Optional[asyncio.Event] = None,
+    poll_timeout: float = DEFAULT_POLL_TIMEOUT,
+) -> int:
+    """
+    Process jobs from `job_queue` until `stop` is set, at most `concurrency` at a time.
+
+    A job is only taken off the queue once a slot is free, so jobs that this worker can't start yet
+    stay available to other workers.
+
+    :return: the number of jobs processed.
+    """
+    stop = stop or asyncio.Event()
+    slots = asyncio.Semaphore(concurrency)
+    running: Set["asyncio.Task[None]"] = set()
+    num_processed: int = 0
+
+    async def process(job: Job) -> None:
+        nonlocal num_processed
+        try:
+            result: JobResult = await downloader.process_job(job, bot, job_queue)
+            await asyncio.to_thread(job_queue.complete, job, result)
+            num_processed += 1
+        except Exception as ex:
+            # The job stays on the queue (where the backend supports it) and is handed out again later.
+            logger.error('Failed to complete job "%s": %s', job.id, ex)
+        finally:
+            slots.release()
+
+    while not stop.is_set():
+        await slots.acquire()
+        try:
+            job: Optional[Job] = await asyncio.to_thread(job_queue.get, poll_timeout)
+        except Exception as ex:
+            slots.release()
+            logger.error("Failed to take a job off the queue: %s", ex)
+            await asyncio.sleep(poll_timeout)
+            continue
+
+        if job is None:
+            slots.release()
+            continue
+
+        task: "asyncio.Task[None]" = asyncio.ensure_future(process(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    # Finish the jobs that were already taken.
+    await asyncio.gather(*running)
+    return num_processed
+
+
+async def _run_worker(options: Dict[str, Any]) -> None:
+    index: int = options["index"]
+    log_file: str = options["log_file"]
+    if log_file:
+        # Every process writes (and rotates) its own log file.
+        root, ext = os.path.splitext(log_file)
+        log_file = f"{root}.{index}{ext}"
+
+    downloader = MediaDownloaderBot(
+        token=options["token"],
+        log_file=log_file,
+        download_workers=options["download_workers"],
+        download_connections=options["download_connections"],
+        max_download_connections=options["max_download_connections"],
+        postprocess_workers=options["postprocess_workers"],
+        max_upload_size=options["max_upload_size"],
+        spool_threshold=options["spool_threshold"],
+        # Each process sweeps its own scratch directory, so that it doesn't delete another process's downloads.
+        scratch_dir=os.path.join(options["scratch_dir"], f"worker-{index}"),
+        scratch_quota=options["scratch_quota"],
+        download_attempts=options["download_attempts"],
+        circuit_breaker_cooldown=options["circuit_breaker_cooldown"],
+    )
+    job_queue: JobQueue = open_job_queue(options["job_queue"])
+    bot = ExtBot(options["token"], rate_limiter=TelegramRateLimiter(
+        overall_rate=options["api_rate_limit"], chat_rate=options["chat_rate_limit"]))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info("Download worker %d is waiting for jobs (pid %d).", index, os.getpid())
+    try:
+        async with bot:
+            num_processed: int = await serve_jobs(downloader, job_queue, bot, options["download_workers"], stop)
+        logger.info("Download worker %d stopped after %d job(s).", index, num_processed)
+    finally:
+        job_queue.close()
+        await downloader.shutdown()
+
+
+def run_worker(options: Dict[str, Any]) -> None:
+    """
+    Entry point of a worker process.
+    """
+    asyncio.run(_run_worker(options))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Namespace:
+    parser = ArgumentParser(description="Download worker for split mode.")
+    parser.add_argument("-t", "--token", type = str, default = "", help = "Telegram bot token. You may also specify this via the `TELEGRAM_BOT_TOKEN` environment variable.")
+    parser.add_argument("--job-queue", type = str, default = "", help = "Job queue shared with the bot frontend: `sqlite:///<path>` or `redis://<host>:<port>/<db>`. You may also specify this via the `JOB_QUEUE` environment variable.")
+    parser.add_argument("-n", "--processes", type = int, default = 1, help = "Number of worker processes to run. You may also specify this via the `WORKER_PROCESSES` environment variable.")
+    parser.add_argument("-w", "--download-workers", type = int, default = DEFAULT_DOWNLOAD_WORKERS, help = "Maximum number of jobs each worker process runs concurrently. You may also specify this via the `DOWNLOAD_WORKERS` environment variable.")
+    parser.add_argument("-l", "--log-file", type = str, default = "telegram_worker.log", help = "Path for log file. Each process appends its index to the name. If the empty string is specified, then logs will only be written to stdout.")
+    parser.add_argument("--download-connections", type = int, default = DEFAULT_CONNECTIONS_PER_DOWNLOAD, help = "Maximum number of connections over which each video is downloaded in parallel. You may also specify this via the `DOWNLOAD_CONNECTIONS` environment variable.")
+    parser.add_argument("--max-download-connections", type = int, default = DEFAULT_MAX_CONNECTIONS, help = "Maximum number of connections that the downloads of all worker processes open at the same time. You may also specify this via the `MAX_DOWNLOAD_CONNECTIONS` environment variable.")
+    parser.add_argument("--postprocess-workers", type = int, default = DEFAULT_POSTPROCESS_WORKERS, help = "Maximum number of ffmpeg processes that each worker process runs at the same time to remux or re-encode videos. 0 disables post-processing. You may also specify this via the `POSTPROCESS_WORKERS` environment variable.")
+    parser.add_argument("--max-upload-size", type = int, default = DEFAULT_MAX_UPLOAD_SIZE, help = "Maximum size (in bytes) of media that will be sent. You may also specify this via the `MAX_UPLOAD_SIZE` environment variable.")
+    parser.add_argument("--spool-threshold", type = int, default = DEFAULT_SPOOL_THRESHOLD, help = "Downloaded media up to this size (in bytes) is kept in memory; larger media is written to disk. You may also specify this via the `SPOOL_THRESHOLD` environment variable.")
+    parser.add_argument("--scratch-dir", type = str, default = DEFAULT_SCRATCH_DIR, help = "Directory for downloads that are too large to keep in memory. Each process uses a subdirectory. You may also specify this via the `SCRATCH_DIR` environment variable.")
+    parser.add_argument("--scratch-quota", type = int, default = DEFAULT_SCRATCH_QUOTA, help = "Maximum number of bytes that the downloads of all processes may use in the scratch directory. 0 means unlimited. You may also specify this via the `SCRATCH_QUOTA` environment variable.")
+    parser.add_argument("--download-attempts", type = int, default = DEFAULT_DOWNLOAD_ATTEMPTS, help = "Number of times a download is attempted when it fails with a transient error. You may also specify this via the `DOWNLOAD_ATTEMPTS` environment variable.")
+    parser.add_argument("--circuit-breaker-cooldown", type = float, default = DEFAULT_BREAKER_COOLDOWN, help = "Seconds for which downloads from a failing platform are rejected. You may also specify this via the `CIRCUIT_BREAKER_COOLDOWN` environment variable.")
+    parser.add_argument("--api-rate-limit", type = float, default = DEFAULT_OVERALL_RATE, help = "Maximum number of outbound Telegram Bot API requests per second across all worker processes. You may also specify this via the `API_RATE_LIMIT` environment variable.")
+    parser.add_argument("--chat-rate-limit", type = float, default = DEFAULT_CHAT_RATE, help = "Maximum number of outbound Telegram Bot API requests per second to a single private chat, per worker process. You may also specify this via the `CHAT_RATE_LIMIT` environment variable.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    load_dotenv()
+    args: Namespace = parse_args(argv)
+
+    token: str = os.environ.get("TELEGRAM_BOT_TOKEN", args.token)
+    if not token:
+        raise ValueError("No Telegram bot token specified")
+
+    job_queue: str = os.environ.get("JOB_QUEUE", args.job_queue)
+    if not job_queue:
+        raise ValueError("No job queue specified")
+
+    processes: int = int(os.environ.get("WORKER_PROCESSES", args.processes))
+    max_upload_size: int = int(os.environ.get("MAX_UPLOAD_SIZE", args.max_upload_size))
+    scratch_quota: int = int(os.environ.get("SCRATCH_QUOTA", args.scratch_quota))
+    api_rate_limit: float = float(os.environ.get("API_RATE_LIMIT", args.api_rate_limit))
+    max_download_connections: int = int(os.environ.get("MAX_DOWNLOAD_CONNECTIONS", args.max_download_connections))
+    postprocess_workers: int = int(os.environ.get("POSTPROCESS_WORKERS", args.postprocess_workers))
+    # Each process needs room for at least one download, plus the output of post-processing it.
+    min_scratch_quota: int = int(max_upload_size * (1 + DEFAULT_POSTPROCESS_HEADROOM)) if postprocess_workers else max_upload_size
+
+    options: Dict[str, Any] = {
+        "token": token,
+        "job_queue": job_queue,
+        "log_file": args.log_file,
+        "download_workers": int(os.environ.get("DOWNLOAD_WORKERS", args.download_workers)),
+        "max_upload_size": max_upload_size,
+        "spool_threshold": int(os.environ.get("SPOOL_THRESHOLD", args.spool_threshold)),
+        "scratch_dir": os.environ.get("SCRATCH_DIR", args.scratch_dir),
+        "download_connections": int(os.environ.get("DOWNLOAD_CONNECTIONS", args.download_connections)),
+        "postprocess_workers": postprocess_workers,
+        # The quota, the connection budget and the overall rate limit are shared by all of the processes.
+        "scratch_quota": max(scratch_quota // processes, min_scratch_quota) if scratch_quota else 0,
+        "max_download_connections": max(1, max_download_connections // processes),
+        "api_rate_limit": api_rate_limit / processes,
+        "chat_rate_limit": float(os.environ.get("CHAT_RATE_LIMIT", args.chat_rate_limit)),
+        "download_attempts": int(os.environ.get("DOWNLOAD_ATTEMPTS", args.download_attempts)),
+        "circuit_breaker_cooldown": float(os.environ.get("CIRCUIT_BREAKER_COOLDOWN", args.circuit_breaker_cooldown)),
+    }
+
+    if processes <= 1:
+        run_worker({**options, "index": 0})
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=({**options, "index": index},), name=f"download-worker-{index}")
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    print(f"⚙️ Started {processes} download worker(s).")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches every process in the foreground group; wait for them to finish their jobs.
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+A pool of warm `yt_dlp.YoutubeDL` instances.
+
+Creating a `YoutubeDL` instance loads the extractor list, and each instance lazily builds
+its extractors, HTTP sessions and cookie jar on first use. Reusing instances across
+downloads keeps all of that warm, so only the first download on each instance pays for it.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_YDL_MAX_USES: int = 50
+
+# Options that change with every download. They are applied to an instance when it is acquired,
+# rather than being part of the pool key.
+PER_DOWNLOAD_OPTIONS: Tuple[str, ...] = ("outtmpl",)
+
+_Key = Tuple[Tuple[str, str], ...]
+
+
+def set_output_path(ydl: Any, path: str) -> None:
+    """
+    Set the path that `ydl` downloads the next video to.
+    """
+    outtmpl = ydl.params.get("outtmpl")
+    if isinstance(outtmpl, dict):
+        # YoutubeDL normalizes `outtmpl` into a dictionary of templates when it is created.
+        outtmpl["default"] = path
+    else:
+        ydl.params["outtmpl"] = path
+
+
+def _options_key(params: Dict[str, Any]) -> _Key:
+    return tuple(sorted((name, repr(value)) for name, value in params.items() if name not in PER_DOWNLOAD_OPTIONS))
+
+
+def _create_youtube_dl(params: Dict[str, Any]) -> Any:
+    # yt-dlp is slow to import, so it is only imported once the first instance is needed.
+    import yt_dlp
+
+    return yt_dlp.YoutubeDL(params)
+
+
+class _PooledInstance(object):
+    def __init__(self, ydl: Any):
+        self.ydl: Any = ydl
+        self.uses: int = 0
+
+
+class YoutubeDLPool(object):
+    """
+    Hands out `YoutubeDL` instances keyed by their options. Each instance is used by one download at
+    a time, and is closed after `max_uses` downloads or as soon as a download using it raises.
+
+    The pool is thread-safe. Idle instances are kept per option set, so the number of instances is
+    bounded by the number of concurrent downloads.
+
+    :param max_uses: number of downloads after which an instance is replaced. 1 disables reuse.
+    :param factory: creates a `YoutubeDL` from options. Defaults to `yt_dlp.YoutubeDL`.
+    """
+
+    def __init__(self, max_uses: int = DEFAULT_YDL_MAX_USES, factory: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        if max_uses < 1:
+            raise ValueError(f"max_uses must be at least 1, got {max_uses}")
+
+        self.max_uses: int = max_uses
+        self._factory: Callable[[Dict[str, Any]], Any] = factory or _create_youtube_dl
+        self._idle: Dict[_Key, List[_PooledInstance]] = {}
+        self._lock = threading.Lock()
+
+        self._created: int = 0
+        self._reused: int = 0
+        self._recycled: int = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    @contextmanager
+    def acquire(self, params: Dict[str, Any]) -> Iterator[Any]:
+        """
+        Borrow an instance configured with `params` for the duration of the context.
+        """
+        key: _Key = _options_key(params)
+        with self._lock:
+            idle: List[_PooledInstance] = self._idle.get(key, [])
+            instance = idle.pop() if idle else None
+            if instance is not None:
+                self._reused += 1
+
+        if instance is None:
+            # Created outside the lock, so that slow construction doesn't serialize the workers.
+            instance = _PooledInstance(self._factory(dict(params)))
+            with self._lock:
+                self._created += 1
+        else:
+            self._apply_per_download_options(instance.ydl, params)
+
+        instance.uses += 1
+        try:
+            yield instance.ydl
+        except BaseException:
+            self._recycle(instance)
+            raise
+
+        if instance.uses >= self.max_uses:
+            self._recycle(instance)
+            return
+
+        with self._lock:
+            self._idle.setdefault(key, []).append(instance)
+
+    @staticmethod
+    def _apply_per_download_options(ydl: Any, params: Dict[str, Any]) -> None:
+        for name in PER_DOWNLOAD_OPTIONS:
+            if name not in params:
+                continue
+            if name == "outtmpl" and not isinstance(params[name], dict):
+                set_output_path(ydl, params[name])
+            else:
+                ydl.params[name] = params[name]
+
+    def _recycle(self, instance: _PooledInstance) -> None:
+        with self._lock:
+            self._recycled += 1
+        try:
+            instance.ydl.close()
+        except Exception as ex:
+            self.logger.warning("Failed to close YoutubeDL instance: %s", ex)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "created": self._created,
+                "reused": self._reused,
+                "recycled": self._recycled,
+                "idle": sum(len(idle) for idle in self._idle.values()),
+            }
+
+    def clear(self) -> None:
+        """
+        Close all idle instances.
+        """
+        with self._lock:
+            idle: List[_PooledInstance] = [instance for instances in self._idle.values() for instance in instances]
+            self._idle.clear()
+        for instance in idle:
+            self._recycle(instance)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pickle
+
+import pytest
+
+from telegram_media_downloader_bot.buffer import MediaBuffer
+
+
+def test_small_media_stays_in_memory(tmp_path):
+    media = MediaBuffer(str(tmp_path), spool_threshold=10)
+    media.write(b"abc")
+    media.write(b"def")
+
+    assert media.in_memory
+    assert media.size == 6
+    assert os.listdir(tmp_path) == []
+
+    with media.open() as reader:
+        assert reader.read() == b"abcdef"
+        assert reader.name == "video.mp4"
+
+
+def test_large_media_spills_to_disk(tmp_path):
+    media = MediaBuffer(str(tmp_path), spool_threshold=4)
+    media.write(b"abc")
+    media.write(b"def")
+
+    assert not media.in_memory
+    assert media.path and os.path.dirname(media.path) == str(tmp_path)
+
+    with media.open() as reader:
+        assert reader.read() == b"abcdef"
+
+    media.close()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("spool_threshold", [0, 1024])
+def test_readers_are_independent(tmp_path, spool_threshold):
+    with MediaBuffer(str(tmp_path), spool_threshold=spool_threshold) as media:
+        media.write(b"0123456789")
+        first, second = media.open(), media.open()
+        with first, second:
+            assert first.read(4) == b"0123"
+            assert second.read() == b"0123456789"
+            assert first.read() == b"456789"
+
+
+def test_closed_buffer_cannot_be_opened(tmp_path):
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"abc")
+    media.close()
+    media.close()
+
+    assert media.closed
+    with pytest.raises(ValueError):
+        media.open()
+
+
+def test_from_file_takes_ownership_of_the_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"abc")
+
+    with MediaBuffer.from_file(str(path)) as media:
+        assert media.size == 3
+        assert not media.in_memory
+        with media.open() as reader:
+            assert reader.read() == b"abc"
+
+    assert not path.exists()
+
+
+@pytest.mark.parametrize("spool_threshold", [0, 1024])
+def test_buffer_survives_pickling(tmp_path, spool_threshold):
+    media = MediaBuffer(str(tmp_path), spool_threshold=spool_threshold)
+    media.write(b"abc")
+
+    copy = pickle.loads(pickle.dumps(media))
+    with copy.open() as reader:
+        assert reader.read() == b"abc"
+    copy.close()
+
+
+def test_media_is_hashed_while_it_is_written(tmp_path):
+    expected = hashlib.sha256(b"abcdef").hexdigest()
+    for threshold in (10, 4):
+        media = MediaBuffer(str(tmp_path), spool_threshold=threshold)
+        media.write(b"abc")
+        media.write(b"def")
+        assert media.sha256 == expected
+        # The digest survives pickling, e.g., from a process pool.
+        assert pickle.loads(pickle.dumps(media)).sha256 == expected
+        media.close()
+
+    path = tmp_path / "written-by-yt-dlp.mp4"
+    path.write_bytes(b"abcdef")
+    media = MediaBuffer.from_file(str(path))
+    assert not media.hashed
+    assert media.sha256 == expected
+    media.close()
+
+
+def test_small_file_is_loaded_into_memory(tmp_path):
+    path = tmp_path / "written-by-yt-dlp.mp4"
+    path.write_bytes(b"abcdef")
+
+    media = MediaBuffer.from_file(str(path), spool_threshold=10)
+
+    assert media.in_memory and media.hashed
+    assert media.sha256 == hashlib.sha256(b"abcdef").hexdigest()
+    assert not path.exists()
+    with media.open() as reader:
+        assert reader.read() == b"abcdef"
+    media.close()
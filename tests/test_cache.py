@@ -0,0 +1,77 @@
+import pytest
+
+from telegram_media_downloader_bot.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_and_put():
+    cache = TTLCache(max_size=2, ttl=10)
+    assert cache.get("a") is None
+
+    cache.put("a", "file-a")
+    assert cache.get("a") == "file-a"
+    assert "a" in cache
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=10)
+    cache.put("a", "file-a")
+    cache.put("b", "file-b")
+    cache.get("a")
+    cache.put("c", "file-c")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "file-a"
+    assert cache.get("c") == "file-c"
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = TTLCache(max_size=2, ttl=10, clock=clock)
+    cache.put("a", "file-a")
+
+    clock.now += 9
+    assert cache.get("a") == "file-a"
+
+    clock.now += 1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_pop():
+    cache = TTLCache(max_size=2, ttl=10)
+    cache.put("a", "file-a")
+    assert cache.pop("a") == "file-a"
+    assert cache.pop("a") is None
+
+
+def test_peek_does_not_count_or_refresh():
+    clock = FakeClock()
+    cache = TTLCache(max_size=2, ttl=10, clock=clock)
+    cache.put("a", "file-a")
+    cache.put("b", "file-b")
+
+    assert cache.peek("a") == "file-a"
+    assert cache.peek("missing") is None
+    assert (cache.hits, cache.misses) == (0, 0)
+
+    # "a" is still the least recently used entry.
+    cache.put("c", "file-c")
+    assert cache.peek("a") is None
+
+    clock.now += 11
+    assert cache.peek("b") is None
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        TTLCache(max_size=0)
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from telegram_media_downloader_bot.coalescer import RequestCoalescer
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_task():
+    coalescer = RequestCoalescer()
+    calls = 0
+    released = []
+    gate = asyncio.Event()
+
+    async def download():
+        nonlocal calls
+        calls += 1
+        await gate.wait()
+        return "video.mp4"
+
+    async def request():
+        async with coalescer.acquire("key", download, release=released.append) as result:
+            return result
+
+    tasks = [asyncio.create_task(request()) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert coalescer.holders("key") == 5
+
+    gate.set()
+    results = await asyncio.gather(*tasks)
+
+    assert calls == 1
+    assert results == ["video.mp4"] * 5
+    assert released == ["video.mp4"]
+    assert "key" not in coalescer
+
+
+@pytest.mark.asyncio
+async def test_failure_is_shared_by_all_requesters():
+    coalescer = RequestCoalescer()
+    released = []
+
+    async def download():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def request():
+        async with coalescer.acquire("key", download, release=released.append):
+            pass
+
+    results = await asyncio.gather(*[request() for _ in range(3)], return_exceptions=True)
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len({id(r) for r in results}) == 1
+    assert released == []
+    assert len(coalescer) == 0
+
+
+@pytest.mark.asyncio
+async def test_new_task_after_previous_one_finished():
+    coalescer = RequestCoalescer()
+    calls = 0
+
+    async def download():
+        nonlocal calls
+        calls += 1
+        return calls
+
+    async with coalescer.acquire("key", download) as first:
+        pass
+    async with coalescer.acquire("key", download) as second:
+        pass
+
+    assert (first, second) == (1, 2)
+
@@ -0,0 +1,277 @@
+import io
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+from telegram_media_downloader_bot.downloader import MAX_MEDIA_GROUP_SIZE, WARM_UP_EXTRACTORS, SizeLimitedFormatSelector, estimate_size, fetch_media, probe_media, warm_up
+from telegram_media_downloader_bot.errors import MediaTooLargeError
+from telegram_media_downloader_bot.ydl_pool import YoutubeDLPool
+
+MB = 1024 * 1024
+
+
+def fmt(format_id, ext="mp4", vcodec="avc1", acodec="mp4a", filesize=None, filesize_approx=None):
+    return {"format_id": format_id, "ext": ext, "vcodec": vcodec, "acodec": acodec,
+            "filesize": filesize, "filesize_approx": filesize_approx}
+
+
+def select(formats, max_size, postprocess_size=0):
+    return [f["format_id"] for f in SizeLimitedFormatSelector(max_size, postprocess_size)({"formats": formats})]
+
+
+def test_estimate_size():
+    assert estimate_size(fmt("a", filesize=10)) == 10
+    assert estimate_size(fmt("a", filesize_approx=12.5)) == 12
+    assert estimate_size(fmt("a")) is None
+
+
+def test_best_format_within_budget_is_selected():
+    formats = [fmt("360p", filesize=5 * MB), fmt("720p", filesize_approx=30 * MB), fmt("1080p", filesize=80 * MB)]
+    assert select(formats, 50 * MB) == ["720p"]
+    assert select(formats, 10 * MB) == ["360p"]
+
+
+def test_only_single_file_mp4_formats_are_considered():
+    formats = [
+        fmt("progressive", acodec=None, filesize=5 * MB),
+        fmt("video-only", acodec="none", filesize=6 * MB),
+        fmt("audio-only", vcodec="none", filesize=1 * MB),
+        fmt("webm", ext="webm", filesize=2 * MB),
+    ]
+    assert select(formats, 50 * MB) == ["progressive"]
+    assert select([fmt("webm", ext="webm")], 50 * MB) == []
+
+
+def test_unknown_size_is_used_only_when_nothing_known_fits():
+    assert select([fmt("unknown"), fmt("known", filesize=1 * MB)], 50 * MB) == ["known"]
+    assert select([fmt("unknown"), fmt("known", filesize=60 * MB)], 50 * MB) == ["unknown"]
+
+
+def test_oversize_media_is_rejected_before_download():
+    formats = [fmt("720p", filesize=60 * MB), fmt("1080p", filesize=90 * MB)]
+    with pytest.raises(MediaTooLargeError) as exc_info:
+        select(formats, 50 * MB)
+
+    assert exc_info.value.size == 60 * MB
+    assert exc_info.value.max_size == 50 * MB
+
+
+def test_formats_that_can_be_post_processed_to_fit_are_selected_last():
+    formats = [fmt("webm", ext="webm", vcodec="vp9", acodec="opus", filesize=20 * MB),
+               fmt("720p", filesize=60 * MB), fmt("1080p", filesize=70 * MB)]
+    # Without post-processing, only mp4 formats that fit are considered.
+    with pytest.raises(MediaTooLargeError):
+        select(formats, 50 * MB)
+    # Other containers that fit are preferred over re-encoding...
+    assert select(formats, 50 * MB, postprocess_size=75 * MB) == ["webm"]
+    # ...and the smallest format that can be re-encoded is preferred over larger ones.
+    assert select(formats[1:], 50 * MB, postprocess_size=75 * MB) == ["720p"]
+    # mp4 formats that fit are still preferred over everything else.
+    assert select(formats + [fmt("360p", filesize=5 * MB)], 50 * MB, postprocess_size=75 * MB) == ["360p"]
+
+    with pytest.raises(MediaTooLargeError) as exc_info:
+        select(formats[1:], 50 * MB, postprocess_size=55 * MB)
+    assert exc_info.value.size == 60 * MB
+
+
+def test_media_too_large_error_survives_pickling():
+    error = pickle.loads(pickle.dumps(MediaTooLargeError(2, 1)))
+    assert (error.size, error.max_size) == (2, 1)
+
+
+class FakeYoutubeDL(object):
+    """
+    Serves one progressive format (streamed via `urlopen`) or an HLS format (downloaded to `outtmpl`)
+    per video. With `entries`, the URL is a playlist (e.g., a carousel) of that many videos.
+    """
+
+    def __init__(self, params, data=b"\0" * 100, protocol="https", entries=0):
+        self.params = params
+        self.data = data
+        self.protocol = protocol
+        self.entries = entries
+        self.downloaded = False
+        self.extractors = []
+        self.extractions = 0
+        self.fragment_connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def get_info_extractor(self, ie_key):
+        self.extractors.append(ie_key)
+
+    def extract_info(self, url, download=True, process=True):
+        self.extractions += 1
+        return {"id": "abc", "webpage_url": url, "duration": 12.5}
+
+    def process_ie_result(self, info, download=True):
+        assert not download
+        video = {**info, "url": "https://cdn.example.com/abc.mp4", "protocol": self.protocol, "filesize": len(self.data)}
+        if self.entries:
+            return {**info, "_type": "playlist", "entries": [{**video, "id": f"abc-{i}"} for i in range(self.entries)]}
+        return video
+
+    def process_info(self, info):
+        self.downloaded = True
+        self.fragment_connections.append(self.params.get("concurrent_fragment_downloads"))
+        with open(self.params["outtmpl"], "wb") as f:
+            f.write(self.data)
+        return info
+
+    def urlopen(self, request):
+        return io.BytesIO(self.data)
+
+
+def fake_youtube_dl(**kwargs):
+    return lambda params: FakeYoutubeDL(params, **kwargs)
+
+
+def test_progressive_media_is_streamed_into_memory(tmp_path):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(data=b"video"))
+    (media,), timings = fetch_media("https://example.com/v", str(tmp_path), max_size=MB, spool_threshold=MB, pool=pool)
+
+    with media:
+        assert media.in_memory
+        assert timings.size == media.size == 5
+        with media.open() as reader:
+            assert reader.read() == b"video"
+    assert os.listdir(tmp_path) == []
+
+
+def test_media_that_cannot_be_streamed_is_downloaded_to_a_file(tmp_path):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(protocol="m3u8_native"))
+    (media,), _ = fetch_media("https://example.com/v", str(tmp_path), max_size=MB, spool_threshold=0, pool=pool)
+
+    assert not media.in_memory and media.size == 100
+    # The file is hashed when the hash is needed, rather than read again right away.
+    assert not media.hashed
+    media.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_small_file_is_loaded_into_memory_and_hashed_in_one_read(tmp_path):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(protocol="m3u8_native"))
+    (media,), _ = fetch_media("https://example.com/v", str(tmp_path), max_size=MB, spool_threshold=MB, pool=pool)
+
+    assert media.in_memory and media.size == 100
+    assert media.hashed
+    assert os.listdir(tmp_path) == []
+    media.close()
+
+
+@pytest.mark.parametrize("protocol", ["https", "m3u8_native"])
+def test_every_video_of_a_carousel_is_downloaded(tmp_path, protocol):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(protocol=protocol, entries=3))
+    # Small videos that yt-dlp writes to files are loaded into memory, so keep them all on disk.
+    items, timings = fetch_media("https://example.com/carousel", str(tmp_path), max_size=MB,
+                                 spool_threshold=MB if protocol == "https" else 0, pool=pool)
+
+    assert len(items) == 3
+    assert timings.size == 300
+    # Each video that had to be downloaded to a file got a file of its own.
+    assert len(os.listdir(tmp_path)) == (0 if protocol == "https" else 3)
+    for media in items:
+        media.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_carousels_are_truncated_to_one_media_group(tmp_path):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(entries=MAX_MEDIA_GROUP_SIZE + 2))
+    items, _ = fetch_media("https://example.com/carousel", str(tmp_path), max_size=MB, pool=pool)
+
+    assert len(items) == MAX_MEDIA_GROUP_SIZE
+
+
+@pytest.mark.parametrize("protocol", ["https", "m3u8_native"])
+@pytest.mark.parametrize("entries", [0, 2])
+def test_media_over_the_limit_is_discarded(tmp_path, protocol, entries):
+    pool = YoutubeDLPool(factory=fake_youtube_dl(protocol=protocol, entries=entries))
+    with pytest.raises(MediaTooLargeError):
+        fetch_media("https://example.com/v", str(tmp_path), max_size=10, spool_threshold=0, pool=pool)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_ydl_instances_are_reused_per_option_set(tmp_path):
+    created = []
+
+    def factory(params):
+        created.append(FakeYoutubeDL(params))
+        return created[-1]
+
+    pool = YoutubeDLPool(factory=factory)
+    for _ in range(3):
+        fetch_media("https://example.com/v", str(tmp_path), max_size=MB, pool=pool).items[0].close()
+    fetch_media("https://example.com/v", str(tmp_path), max_size=2 * MB, pool=pool).items[0].close()
+
+    assert len(created) == 2
+    assert pool.stats() == {"created": 2, "reused": 2, "recycled": 0, "idle": 2}
+
+
+def test_warm_up_leaves_a_ready_instance_for_the_first_download(tmp_path):
+    created = []
+
+    def factory(params):
+        created.append(FakeYoutubeDL(params))
+        return created[-1]
+
+    pool = YoutubeDLPool(factory=factory)
+    warm_up(str(tmp_path), max_size=MB, pool=pool)
+    assert created[0].extractors == list(WARM_UP_EXTRACTORS)
+
+    fetch_media("https://example.com/v", str(tmp_path), max_size=MB, pool=pool).items[0].close()
+    assert len(created) == 1
+    assert pool.stats()["reused"] == 1
+
+
+def test_yt_dlp_is_not_imported_at_start_up():
+    # In a fresh interpreter, since this one has imported yt-dlp already.
+    code = "import sys, telegram_media_downloader_bot.bot, telegram_media_downloader_bot.worker; print('yt_dlp' in sys.modules)"
+    assert subprocess.check_output([sys.executable, "-c", code], text=True).strip() == "False"
+
+
+def test_probe_is_reused_by_the_download(tmp_path):
+    created = []
+
+    def factory(params):
+        created.append(FakeYoutubeDL(params, entries=2))
+        return created[-1]
+
+    pool = YoutubeDLPool(factory=factory)
+    info = probe_media("https://example.com/v", max_size=MB, pool=pool)
+    assert len(info.entries) == 2
+    assert (info.duration, info.size) == (25.0, 200)
+
+    items, timings = fetch_media("https://example.com/v", str(tmp_path), max_size=MB, pool=pool, info=info)
+    for media in items:
+        media.close()
+
+    assert len(items) == 2
+    assert timings.extract == 0.0
+    assert sum(ydl.extractions for ydl in created) == 1
+
+
+def test_fragments_are_downloaded_over_several_connections(tmp_path):
+    created = []
+
+    def factory(params):
+        created.append(FakeYoutubeDL(params, protocol="m3u8_native"))
+        return created[-1]
+
+    pool = YoutubeDLPool(factory=factory)
+    fetch_media("https://example.com/v", str(tmp_path), max_size=MB, pool=pool, connections=3).items[0].close()
+    fetch_media("https://example.com/v", str(tmp_path), max_size=MB, pool=pool).items[0].close()
+
+    # The reused instance is set up for each download.
+    assert len(created) == 1
+    assert created[0].fragment_connections == [3, 1]
@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from telegram_media_downloader_bot.errors import JobFailedError, MediaTooLargeError, ShuttingDownError
+from telegram_media_downloader_bot.jobs import Job, JobDispatcher, JobResult, RedisJobQueue, SQLiteJobQueue, open_job_queue
+
+
+class FakeRedis(object):
+    """
+    A local stand-in for `redis.Redis`, with just the commands used by `RedisJobQueue`.
+    """
+
+    def __init__(self):
+        self.lists = {}
+        self.values = {}
+        self.expiry = {}
+        self._changed = threading.Condition()
+
+    def lpush(self, key, *values):
+        with self._changed:
+            for value in values:
+                self.lists.setdefault(key, []).insert(0, value.encode("utf-8"))
+            self._changed.notify_all()
+            return len(self.lists[key])
+
+    def rpop(self, key):
+        with self._changed:
+            items = self.lists.get(key)
+            return items.pop() if items else None
+
+    def brpop(self, keys, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                for key in keys:
+                    if self.lists.get(key):
+                        return key.encode("utf-8"), self.lists[key].pop()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lrem(self, key, count, value):
+        with self._changed:
+            items = self.lists.get(key, [])
+            removed = [item for item in items if item == value.encode("utf-8")]
+            self.lists[key] = [item for item in items if item != value.encode("utf-8")]
+            return len(removed)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.expiry[key] = ex
+
+    def exists(self, key):
+        return int(key in self.values)
+
+    def expire(self, key, seconds):
+        self.expiry[key] = seconds
+
+
+def make_job(url="https://www.youtube.com/shorts/abc", reply_to="frontend"):
+    return Job.create(url, "youtube", "100", "1", 7, reply_to)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def job_queue(request, tmp_path):
+    if request.param == "sqlite":
+        queue = SQLiteJobQueue(str(tmp_path / "jobs.db"))
+    else:
+        queue = RedisJobQueue(FakeRedis())
+    yield queue
+    queue.close()
+
+
+def test_jobs_are_handed_out_in_order_and_results_routed_to_their_consumer(job_queue):
+    first, second = make_job("https://a"), make_job("https://b", reply_to="other")
+    job_queue.put(first)
+    job_queue.put(second)
+    assert job_queue.depth() == 2
+
+    assert job_queue.get(timeout=1) == first
+    assert job_queue.get(timeout=1) == second
+    assert job_queue.depth() == 0
+
+    job_queue.complete(first, JobResult(first.id, ("file-id-1",), (11,)))
+    job_queue.complete(second, JobResult(second.id, ("file-id-2",), (12,)))
+
+    assert job_queue.get_results("frontend", timeout=1) == [JobResult(first.id, ("file-id-1",), (11,))]
+    assert job_queue.get_results("other", timeout=1) == [JobResult(second.id, ("file-id-2",), (12,))]
+    assert job_queue.get_results("frontend", timeout=0.1) == []
+
+
+def test_cancelled_jobs_are_withdrawn(job_queue):
+    queued, taken = make_job("https://a"), make_job("https://b")
+    job_queue.put(taken)
+    job_queue.put(queued)
+    assert job_queue.get(timeout=1) == taken
+    assert not job_queue.cancelled(taken)
+
+    job_queue.cancel(queued)
+    job_queue.cancel(taken)
+
+    # The queued job is gone, and the worker that took the other one can tell that it was cancelled.
+    assert job_queue.depth() == 0
+    assert job_queue.get(timeout=0.1) is None
+    assert job_queue.cancelled(taken)
+
+
+def test_get_times_out_on_an_empty_queue(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.db"), poll_interval=0.01)
+    start = time.monotonic()
+    assert queue.get(timeout=0.1) is None
+    assert time.monotonic() - start >= 0.1
+
+
+def test_sqlite_queue_is_shared_by_connections_to_the_same_file(tmp_path):
+    frontend = open_job_queue(f"sqlite:///{tmp_path / 'jobs.db'}")
+    worker = open_job_queue(str(tmp_path / "jobs.db"))
+
+    job = make_job()
+    frontend.put(job)
+    assert worker.get(timeout=1) == job
+    worker.complete(job, JobResult(job.id, ("file-id",)))
+    assert frontend.get_results("frontend", timeout=1)[0].file_ids == ("file-id",)
+
+
+def test_job_taken_by_a_crashed_worker_is_handed_out_again(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.db"), visibility_timeout=0.1)
+    job = make_job()
+    queue.put(job)
+
+    assert queue.get(timeout=1) == job
+    assert queue.get(timeout=0) is None
+    time.sleep(0.15)
+    assert queue.get(timeout=0) == job
+
+
+def test_results_nobody_picks_up_expire(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.db"), result_ttl=0)
+    abandoned, job = make_job(reply_to="gone"), make_job()
+    queue.put(abandoned)
+    queue.put(job)
+    queue.complete(queue.get(timeout=1), JobResult(abandoned.id, ("file-id-1",)))
+    time.sleep(0.01)
+    queue.complete(queue.get(timeout=1), JobResult(job.id, ("file-id-2",)))
+
+    assert queue.get_results("gone", timeout=0) == []
+    assert queue.get_results("frontend", timeout=0) == [JobResult(job.id, ("file-id-2",))]
+
+
+def test_errors_survive_the_round_trip():
+    result = JobResult.loads(JobResult.failure("job", MediaTooLargeError(2, 1)).dumps())
+    assert result.failed
+    error = result.error()
+    assert isinstance(error, MediaTooLargeError)
+    assert (error.size, error.max_size) == (2, 1)
+
+    other = JobResult.loads(JobResult.failure("job", KeyError("boom")).dumps()).error()
+    assert isinstance(other, JobFailedError)
+    assert "KeyError" in str(other)
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_hands_each_result_to_its_job():
+    queue = SQLiteJobQueue(":memory:")
+    dispatcher = JobDispatcher(queue, poll_timeout=0.05)
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            job = queue.get(timeout=0.05)
+            if job is not None:
+                queue.complete(job, JobResult(job.id, (job.url,)))
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    try:
+        jobs = [make_job(f"https://{i}", reply_to=dispatcher.consumer) for i in range(5)]
+        results = await asyncio.gather(*[dispatcher.submit(job) for job in jobs])
+    finally:
+        stop.set()
+        worker.join()
+        dispatcher.close()
+
+    assert [result.file_ids for result in results] == [(job.url,) for job in jobs]
+    assert dispatcher.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_gives_up_on_jobs_that_no_worker_takes():
+    dispatcher = JobDispatcher(SQLiteJobQueue(":memory:"), job_timeout=0.1, poll_timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        await dispatcher.submit(make_job(reply_to=dispatcher.consumer))
+    assert dispatcher.in_flight == 0
+    # The user was told that the download failed, so no worker may send the video later.
+    assert dispatcher.queue.depth() == 0
+    dispatcher.close()
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_cancel_all_stops_waiting_but_keeps_jobs_queued():
+    queue = SQLiteJobQueue(":memory:")
+    dispatcher = JobDispatcher(queue, poll_timeout=0.05)
+    submitted = asyncio.ensure_future(dispatcher.submit(make_job(reply_to=dispatcher.consumer)))
+    await asyncio.sleep(0.05)
+
+    assert dispatcher.cancel_all(ShuttingDownError("stopping")) == 1
+    with pytest.raises(ShuttingDownError):
+        await submitted
+    assert queue.depth() == 1
+    dispatcher.close()
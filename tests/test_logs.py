@@ -0,0 +1,71 @@
+import logging
+import threading
+
+from telegram_media_downloader_bot.logs import UPDATES_LOGGER, LoggingPipeline, SamplingFilter
+
+
+class Unformattable(object):
+    def __init__(self):
+        self.formatted_on = None
+
+    def __str__(self):
+        self.formatted_on = threading.current_thread()
+        return "unformattable"
+
+
+def test_records_are_formatted_and_written_in_the_background(tmp_path):
+    log_file = tmp_path / "bot.log"
+    pipeline = LoggingPipeline("test_logs.background", log_file=str(log_file), logger_format="%(levelname)s %(message)s")
+    argument = Unformattable()
+
+    logging.getLogger("test_logs.background.child").info("hello %s", argument)
+    pipeline.close()
+
+    assert log_file.read_text() == "INFO hello unformattable\n"
+    # Not even pytest's log capture, a handler of the root logger, formatted it on this thread.
+    assert argument.formatted_on is not threading.current_thread()
+    assert logging.getLogger("test_logs.background").propagate
+
+
+def test_log_file_is_rotated(tmp_path):
+    log_file = tmp_path / "bot.log"
+    pipeline = LoggingPipeline("test_logs.rotation", log_file=str(log_file), logger_format="%(message)s",
+                               max_bytes=100, backup_count=2)
+    logger = logging.getLogger("test_logs.rotation")
+    for i in range(20):
+        logger.info("line %d %s", i, "x" * 20)
+    pipeline.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["bot.log", "bot.log.1", "bot.log.2"]
+    assert all(path.stat().st_size <= 100 for path in tmp_path.iterdir())
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    pipeline = LoggingPipeline("test_logs.full", queue_size=1)
+    # Stop the writer so that the queue fills up.
+    pipeline._listener.stop()
+    logger = logging.getLogger("test_logs.full")
+    logger.info("first")
+    logger.info("second")
+    assert pipeline.dropped == 1
+    pipeline._listener.start()
+    pipeline.close()
+
+
+def test_new_pipeline_replaces_the_previous_one():
+    first = LoggingPipeline("test_logs.replace")
+    second = LoggingPipeline("test_logs.replace")
+    assert logging.getLogger("test_logs.replace").handlers == [second._handler]
+    assert first._listener is None
+    second.close()
+    assert logging.getLogger("test_logs.replace").handlers == []
+
+
+def test_update_dumps_are_sampled(monkeypatch):
+    record = logging.LogRecord(UPDATES_LOGGER, logging.DEBUG, __file__, 1, "update", (), None)
+    assert not SamplingFilter(0).filter(record)
+    assert SamplingFilter(1).filter(record)
+
+    monkeypatch.setattr("telegram_media_downloader_bot.logs.random.random", lambda: 0.3)
+    assert SamplingFilter(0.5).filter(record)
+    assert not SamplingFilter(0.2).filter(record)
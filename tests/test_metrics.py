@@ -0,0 +1,72 @@
+import urllib.request
+
+import pytest
+
+from telegram_media_downloader_bot.metrics import Counter, Histogram, Metrics, MetricsServer
+
+
+def test_counter_tracks_labelled_values():
+    counter = Counter("things_total", "Things.")
+    counter.inc(platform="youtube")
+    counter.inc(2, platform="youtube")
+    counter.inc(platform="instagram")
+
+    assert counter.value(platform="youtube") == 3
+    assert counter.value(platform="tiktok") == 0
+    assert counter.total() == 4
+
+
+def test_histogram_quantiles():
+    histogram = Histogram("latency_seconds", "Latency.", buckets=(0.1, 0.2, 0.5, 1.0))
+    for _ in range(90):
+        histogram.observe(0.05, stage="download")
+    for _ in range(10):
+        histogram.observe(0.7, stage="download")
+    histogram.observe(5.0, stage="upload")
+
+    assert histogram.count(stage="download") == 100
+    assert histogram.quantile(0.5, stage="download") == pytest.approx(0.1 * 50 / 90)
+    assert 0.5 < histogram.quantile(0.95, stage="download") <= 1.0
+    # Observations beyond the last bucket are reported as the last bucket's bound.
+    assert histogram.quantile(0.99, stage="upload") == 1.0
+    assert histogram.quantile(0.5, stage="cleanup") is None
+
+
+def test_time_stage_records_duration_and_errors():
+    metrics = Metrics()
+    with metrics.time_stage("classify"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.time_stage("upload", "youtube"):
+            raise ValueError()
+
+    assert metrics.stage_duration.count(stage="classify") == 1
+    assert metrics.stage_duration.count(stage="upload", platform="youtube") == 1
+    assert metrics.errors.value(stage="upload", platform="youtube", error="ValueError") == 1
+    assert [line.split(":")[0].strip(" •") for line in metrics.summary_lines()] == ["classify", "upload"]
+
+
+def test_render_uses_prometheus_text_format():
+    metrics = Metrics()
+    metrics.stage_duration.observe(0.003, stage="download", platform="youtube")
+    metrics.downloaded_bytes.inc(1024, platform="youtube")
+
+    text: str = metrics.render()
+    assert "# TYPE stage_duration_seconds histogram" in text
+    assert 'stage_duration_seconds_bucket{platform="youtube",stage="download",le="0.005"} 1' in text
+    assert 'stage_duration_seconds_bucket{platform="youtube",stage="download",le="+Inf"} 1' in text
+    assert 'stage_duration_seconds_count{platform="youtube",stage="download"} 1' in text
+    assert 'downloaded_bytes_total{platform="youtube"} 1024' in text
+
+
+def test_metrics_server_serves_scrape_endpoint():
+    metrics = Metrics()
+    metrics.coalesced.inc()
+    server = MetricsServer(metrics, port=0).start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body: str = response.read().decode()
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert "coalesced_requests_total 1" in body
+    finally:
+        server.stop()
@@ -0,0 +1,113 @@
+import io
+import threading
+import time
+
+import pytest
+
+from telegram_media_downloader_bot.buffer import MediaBuffer
+from telegram_media_downloader_bot.errors import MediaTooLargeError
+from telegram_media_downloader_bot.parallel import ConnectionBudget, fetch_ranges
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, data, status=200, headers=None):
+        super().__init__(data)
+        self.status = status
+        self.headers = headers or {}
+
+
+class RangeServer(object):
+    """
+    Serves `data` at every URL, honoring `Range` headers unless `ranges` is False.
+    """
+
+    def __init__(self, data, ranges=True, latency=0.0):
+        self.data = data
+        self.ranges = ranges
+        self.latency = latency
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def urlopen(self, url, headers):
+        with self._lock:
+            self.requests.append(headers.get("Range"))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            if not self.ranges or "Range" not in headers:
+                return FakeResponse(self.data)
+            first, last = (int(n) for n in headers["Range"][len("bytes="):].split("-"))
+            last = min(last, len(self.data) - 1)
+            return FakeResponse(self.data[first:last + 1], 206,
+                                {"Content-Range": f"bytes {first}-{last}/{len(self.data)}"})
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def fetch(server, max_size=1024, connections=3, chunk_size=10):
+    media = MediaBuffer()
+    fetch_ranges(server.urlopen, "https://cdn.example.com/v.mp4", {"User-Agent": "test"}, media,
+                 max_size, connections, chunk_size)
+    media.finish()
+    with media.open() as reader:
+        return reader.read()
+
+
+def test_ranges_are_fetched_concurrently_and_written_in_order():
+    data = bytes(range(256)) * 2
+    server = RangeServer(data, latency=0.01)
+
+    assert fetch(server, connections=4, chunk_size=50) == data
+    assert len(server.requests) == 11
+    assert server.requests[0] == "bytes=0-49"
+    assert 1 < server.max_active <= 4
+
+
+def test_server_without_range_support_is_read_over_one_connection():
+    data = b"x" * 95
+    server = RangeServer(data, ranges=False)
+
+    assert fetch(server) == data
+    assert len(server.requests) == 1
+
+
+def test_oversize_file_is_rejected_after_the_first_range():
+    server = RangeServer(b"x" * 2000)
+
+    with pytest.raises(MediaTooLargeError) as error:
+        fetch(server, max_size=1000)
+
+    assert error.value.size == 2000
+    assert len(server.requests) == 1
+
+
+def test_budget_is_shared_by_downloads():
+    budget = ConnectionBudget(5)
+    with budget.acquire(4) as first:
+        with budget.acquire(4) as second:
+            assert (first, second) == (4, 1)
+            assert budget.in_use == 5
+
+            acquired = []
+
+            def acquire():
+                with budget.acquire(2) as granted:
+                    acquired.append(granted)
+
+            waiter = threading.Thread(target=acquire)
+            waiter.start()
+            time.sleep(0.05)
+            # No connection is free, so the third download waits.
+            assert acquired == []
+        waiter.join(timeout=1)
+        assert acquired == [1]
+    assert budget.in_use == 0
+
+
+def test_budget_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        ConnectionBudget(0)
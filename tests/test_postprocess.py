@@ -0,0 +1,166 @@
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from telegram_media_downloader_bot.buffer import MediaBuffer
+from telegram_media_downloader_bot.errors import MediaTooLargeError, PostprocessError
+from telegram_media_downloader_bot.postprocess import AUDIO_BITRATE, REMUX, TRANSCODE, PostProcessor, ffmpeg_args, plan_postprocess
+
+MB = 1024 * 1024
+
+# Stands in for ffmpeg: copies the input (`-i <path>`) to the output (the last argument), truncated to
+# FAKE_FFMPEG_OUTPUT_SIZE bytes, after burning FAKE_FFMPEG_CPU seconds of CPU and sleeping FAKE_FFMPEG_SLEEP seconds.
+FAKE_FFMPEG = f"""#!{sys.executable}
+import os, sys, time
+args = sys.argv[1:]
+with open(args[args.index("-i") + 1], "rb") as f:
+    data = f.read()
+end = time.process_time() + float(os.environ.get("FAKE_FFMPEG_CPU", "0"))
+while time.process_time() < end:
+    pass
+time.sleep(float(os.environ.get("FAKE_FFMPEG_SLEEP", "0")))
+if os.environ.get("FAKE_FFMPEG_EXIT"):
+    sys.stderr.write("Invalid data found when processing input")
+    sys.exit(int(os.environ["FAKE_FFMPEG_EXIT"]))
+with open(args[-1], "wb") as f:
+    f.write(data[:int(os.environ.get("FAKE_FFMPEG_OUTPUT_SIZE", len(data)))])
+"""
+
+
+@pytest.fixture
+def ffmpeg(tmp_path):
+    path = tmp_path / "ffmpeg"
+    path.write_text(FAKE_FFMPEG)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def read(media):
+    with media.open() as reader:
+        return reader.read()
+
+
+def test_plan():
+    h264 = {"ext": "mp4", "vcodec": "avc1.64001F", "acodec": "mp4a.40.2", "duration": 60}
+    assert plan_postprocess(h264, 10 * MB, 50 * MB) is None
+    assert plan_postprocess({**h264, "ext": "webm"}, 10 * MB, 50 * MB) == REMUX
+    assert plan_postprocess({**h264, "vcodec": "vp9"}, 10 * MB, 50 * MB) == TRANSCODE
+    assert plan_postprocess(h264, 60 * MB, 50 * MB) == TRANSCODE
+    # Unknown codecs are assumed to be streamable.
+    assert plan_postprocess({"ext": "mp4"}, 10 * MB, 50 * MB) is None
+
+
+def test_videos_that_cannot_fit_are_not_transcoded():
+    # Without a duration, there is no bitrate that is known to fit.
+    assert plan_postprocess({"ext": "mp4"}, 60 * MB, 50 * MB) is None
+    # A 50 MB hour isn't worth watching.
+    assert plan_postprocess({"ext": "mp4", "duration": 3600}, 60 * MB, 50 * MB) is None
+
+
+def test_transcode_bitrate_fits_the_limit():
+    args = ffmpeg_args("ffmpeg", TRANSCODE, "in.webm", "out.mp4", max_size=50 * MB, duration=100)
+    video_bitrate = int(args[args.index("-b:v") + 1])
+
+    assert (video_bitrate + AUDIO_BITRATE) * 100 / 8 <= 50 * MB
+    assert args[-1] == "out.mp4"
+    assert "+faststart" in args
+
+
+def test_remux_copies_the_streams():
+    args = ffmpeg_args("ffmpeg", REMUX, "in.webm", "out.mp4", max_size=50 * MB)
+    assert args[args.index("-c") + 1] == "copy"
+
+
+def test_job_reports_timings_and_cpu_time(tmp_path, ffmpeg, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_CPU", "0.2")
+    processor = PostProcessor(ffmpeg=ffmpeg)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"video")
+
+    result = processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path)).future.result(timeout=10)
+
+    assert read(result.media) == b"video"
+    assert (result.action, result.input_size, result.output_size) == (REMUX, 5, 5)
+    assert result.cpu_time >= 0.2
+    assert result.duration >= result.cpu_time
+    # The input, which was held in memory, was written to a temporary file that is gone again.
+    assert sorted(os.listdir(tmp_path)) == sorted(["ffmpeg", os.path.basename(result.media.path)])
+    result.media.close()
+    processor.shutdown()
+
+
+def test_jobs_run_where_cpu_time_is_not_reported(tmp_path, ffmpeg, monkeypatch):
+    # Like on Windows, which has no `os.wait4`.
+    monkeypatch.delattr("os.wait4")
+    processor = PostProcessor(ffmpeg=ffmpeg)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"video")
+
+    result = processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path)).future.result(timeout=10)
+
+    assert read(result.media) == b"video"
+    assert result.cpu_time == 0
+    result.media.close()
+    processor.shutdown()
+
+
+def test_output_over_the_limit_is_rejected(tmp_path, ffmpeg):
+    processor = PostProcessor(ffmpeg=ffmpeg)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"\0" * 100)
+
+    with pytest.raises(MediaTooLargeError) as exc_info:
+        processor.submit(media, TRANSCODE, max_size=50, duration=10, directory=str(tmp_path)).future.result(timeout=10)
+
+    assert exc_info.value.size == 100
+    assert os.listdir(tmp_path) == ["ffmpeg"]
+    processor.shutdown()
+
+
+def test_ffmpeg_failure_is_reported(tmp_path, ffmpeg, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_EXIT", "1")
+    processor = PostProcessor(ffmpeg=ffmpeg)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"video")
+
+    with pytest.raises(PostprocessError, match="Invalid data"):
+        processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path)).future.result(timeout=10)
+    processor.shutdown()
+
+
+def test_cancelling_a_job_kills_ffmpeg(tmp_path, ffmpeg, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_SLEEP", "30")
+    processor = PostProcessor(max_workers=1, ffmpeg=ffmpeg)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"video")
+
+    running = processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path))
+    queued = processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path))
+    while running._process is None:
+        time.sleep(0.01)
+    assert processor.active_jobs == 2
+
+    start = time.perf_counter()
+    queued.cancel()
+    running.cancel()
+    with pytest.raises(PostprocessError, match="cancelled"):
+        running.future.result(timeout=10)
+
+    assert queued.future.cancelled()
+    assert time.perf_counter() - start < 5
+    processor.shutdown()
+    assert processor.active_jobs == 0
+
+
+def test_jobs_time_out(tmp_path, ffmpeg, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_SLEEP", "30")
+    processor = PostProcessor(ffmpeg=ffmpeg, timeout=0.2)
+    media = MediaBuffer(str(tmp_path))
+    media.write(b"video")
+
+    with pytest.raises(PostprocessError, match="timed out"):
+        processor.submit(media, REMUX, max_size=MB, directory=str(tmp_path)).future.result(timeout=10)
+    processor.shutdown()
@@ -0,0 +1,139 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+from telegram_media_downloader_bot.ratelimit import PRIORITY_LOW, TelegramRateLimiter, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_allows_bursts_then_throttles():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock.now = 0.5
+    assert bucket.delay() == 0
+
+
+def test_paused_token_bucket_hands_out_nothing():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=5, clock=clock)
+    bucket.pause(10)
+    assert bucket.delay() == pytest.approx(10)
+
+    clock.now = 10
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.delay() == pytest.approx(1)
+
+
+def request(log, name):
+    async def callback():
+        log.append(name)
+        return name
+    return callback
+
+
+@pytest.mark.asyncio
+async def test_media_replies_are_sent_before_low_priority_requests():
+    limiter = TelegramRateLimiter(overall_rate=50, chat_rate=0)
+    log = []
+
+    # Use up the burst, so that the following requests queue up.
+    for i in range(50):
+        await limiter.process_request(request(log, "burst"), (), {}, "sendMessage", {}, None)
+
+    cleanup = asyncio.ensure_future(limiter.process_request(
+        request(log, "delete"), (), {}, "deleteMessage", {"chat_id": 1}, None))
+    welcome = asyncio.ensure_future(limiter.process_request(
+        request(log, "welcome"), (), {}, "sendMessage", {"chat_id": -2}, PRIORITY_LOW))
+    video = asyncio.ensure_future(limiter.process_request(
+        request(log, "video"), (), {}, "sendVideo", {"chat_id": 3}, None))
+    await asyncio.sleep(0)
+    assert limiter.stats()["waiting"] == 3
+
+    await asyncio.gather(cleanup, welcome, video)
+    assert log[50:] == ["video", "delete", "welcome"]
+    assert limiter.stats()["throttled"] == 3
+
+
+@pytest.mark.asyncio
+async def test_requests_to_one_chat_are_spread_out():
+    limiter = TelegramRateLimiter(overall_rate=0, chat_rate=20, chat_burst=1)
+    loop = asyncio.get_running_loop()
+    times = []
+
+    async def callback():
+        times.append(loop.time())
+
+    await asyncio.gather(*[limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 1}, None) for _ in range(3)])
+    # Another chat isn't affected.
+    start = loop.time()
+    await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 2}, None)
+
+    assert times[2] - times[0] >= 0.09
+    assert times[3] - start < 0.05
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_pauses_the_chat_and_retries():
+    limiter = TelegramRateLimiter(overall_rate=0, chat_rate=100, max_retries=1)
+    loop = asyncio.get_running_loop()
+    calls = []
+
+    async def flooded():
+        calls.append(loop.time())
+        if len(calls) == 1:
+            raise RetryAfter(timedelta(seconds=0.1))
+        return True
+
+    assert await limiter.process_request(flooded, (), {}, "sendVideo", {"chat_id": 1}, None) is True
+    assert calls[1] - calls[0] >= 0.09
+    assert limiter.stats()["flood_waits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_is_raised_after_the_last_retry():
+    limiter = TelegramRateLimiter(overall_rate=0, chat_rate=100, max_retries=0)
+
+    async def flooded():
+        raise RetryAfter(1)
+
+    with pytest.raises(RetryAfter):
+        await limiter.process_request(flooded, (), {}, "sendVideo", {"chat_id": 1}, None)
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_of_older_python_telegram_bot_versions():
+    limiter = TelegramRateLimiter(overall_rate=0, chat_rate=100, max_retries=1)
+    calls = []
+
+    class OldRetryAfter(RetryAfter):
+        # Before 22.2, `retry_after` was an int and there was no timedelta.
+        retry_after = 0
+        message = "Flood control exceeded"
+
+        def __init__(self):
+            Exception.__init__(self, self.message)
+
+    async def flooded():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OldRetryAfter()
+        return True
+
+    assert await limiter.process_request(flooded, (), {}, "sendVideo", {"chat_id": 1}, None) is True
+    assert limiter.stats()["flood_waits"] == 1
@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import DownloadError, ExtractorError
+
+from telegram_media_downloader_bot.errors import CircuitOpenError, MediaTooLargeError
+from telegram_media_downloader_bot.resilience import (CLOSED, HALF_OPEN, OPEN, PERMANENT, RESTRICTED, TRANSIENT,
+                                                      CircuitBreaker, Resilience, classify_error)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse(object):
+    def __init__(self, status):
+        self.status = status
+        self.headers = {}
+        self.reason = ""
+        self.url = "https://example.com"
+
+    def close(self):
+        pass
+
+
+def download_error(cause):
+    return DownloadError(f"ERROR: {cause}", exc_info=(type(cause), cause, None))
+
+
+def test_classify_error():
+    assert classify_error(download_error(HTTPError(FakeResponse(429)))) == TRANSIENT
+    assert classify_error(download_error(HTTPError(FakeResponse(503)))) == TRANSIENT
+    assert classify_error(download_error(HTTPError(FakeResponse(404)))) == PERMANENT
+    assert classify_error(download_error(TransportError("Connection reset by peer"))) == TRANSIENT
+    assert classify_error(TimeoutError()) == TRANSIENT
+    assert classify_error(download_error(ExtractorError("Restricted Video: you must be 18 years old"))) == RESTRICTED
+    assert classify_error(DownloadError("ERROR: Sign in to confirm your age")) == RESTRICTED
+    assert classify_error(DownloadError("ERROR: Unsupported URL")) == PERMANENT
+    assert classify_error(MediaTooLargeError(2, 1)) == PERMANENT
+
+
+def test_breaker_opens_on_failure_rate_and_recovers_after_cooldown():
+    clock = FakeClock()
+    breaker = CircuitBreaker("instagram", failure_rate=0.5, min_calls=4, window=60, cooldown=30, clock=clock)
+
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.before_call()
+    assert exc_info.value.platform == "instagram"
+    assert exc_info.value.retry_after == 30
+
+    # After the cool-down, a single trial call is let through.
+    clock.now = 30
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.before_call()
+    # Callers rejected while the trial call is running aren't told to retry right away.
+    assert exc_info.value.retry_after == 5
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_failed_trial_call_reopens_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(min_calls=1, cooldown=30, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 30
+
+
+def test_old_outcomes_leave_the_window():
+    clock = FakeClock()
+    breaker = CircuitBreaker(min_calls=2, window=10, clock=clock)
+    breaker.record_failure()
+    clock.now = 11
+    breaker.record_success()
+    breaker.record_failure()
+    # One failure out of the two calls in the window is enough to open it.
+    assert breaker.state == OPEN
+
+
+def make_resilience(**kwargs):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    kwargs.setdefault("min_calls", 100)
+    return Resilience(sleep=sleep, jitter=lambda: 1.0, **kwargs), delays
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried_with_backoff():
+    retried = []
+    resilience, delays = make_resilience(max_attempts=4, base_delay=1, max_delay=3,
+                                         on_retry=lambda platform, ex: retried.append(platform))
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        if calls < 4:
+            raise download_error(HTTPError(FakeResponse(429)))
+        return "video"
+
+    assert await resilience.call("youtube", flaky) == "video"
+    assert delays == [1, 2, 3]
+    assert retried == ["youtube"] * 3
+
+
+@pytest.mark.asyncio
+async def test_permanent_errors_are_not_retried():
+    resilience, delays = make_resilience()
+
+    async def too_large():
+        raise MediaTooLargeError(2, 1)
+
+    with pytest.raises(MediaTooLargeError):
+        await resilience.call("youtube", too_large)
+    assert delays == []
+    # The platform answered, so it doesn't count against its breaker.
+    assert resilience.breaker("youtube").state == CLOSED
+
+
+@pytest.mark.asyncio
+async def test_open_breaker_fails_fast():
+    states = []
+    rejected = []
+    resilience, _ = make_resilience(max_attempts=1, min_calls=2, on_reject=rejected.append,
+                                    on_state_change=lambda platform, state: states.append((platform, state)))
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        raise TimeoutError()
+
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            await resilience.call("instagram", failing)
+
+    with pytest.raises(CircuitOpenError):
+        resilience.check("instagram")
+    with pytest.raises(CircuitOpenError):
+        await resilience.call("instagram", failing)
+
+    assert calls == 2
+    assert states == [("instagram", OPEN)]
+    assert rejected == ["instagram", "instagram"]
+    # Other platforms are unaffected.
+    resilience.check("youtube")
+    assert resilience.states()["instagram"][0] == OPEN
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_call_lets_another_one_through():
+    clock = FakeClock()
+    resilience, _ = make_resilience(min_calls=1, cooldown=10, clock=clock)
+    resilience.breaker("youtube").record_failure()
+    clock.now = 10
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    task = asyncio.ensure_future(resilience.call("youtube", hang))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    async def succeed():
+        return "video"
+
+    assert await resilience.call("youtube", succeed) == "video"
+    assert resilience.breaker("youtube").state == CLOSED
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from telegram_media_downloader_bot.errors import QueueFullError, ShuttingDownError
+from telegram_media_downloader_bot.scheduler import FairScheduler
+
+
+@pytest.mark.asyncio
+async def test_round_robin_across_chats_and_users():
+    scheduler = FairScheduler(max_concurrency=1, max_queue_depth=100)
+    order = []
+    gate = asyncio.Event()
+
+    def job(name):
+        async def run():
+            await gate.wait()
+            order.append(name)
+        return run
+
+    # Occupy the only slot so that everything else queues up.
+    blocker = asyncio.create_task(scheduler.submit("busy-chat", "u0", job("blocker")))
+    await asyncio.sleep(0)
+
+    tasks = [asyncio.create_task(scheduler.submit("busy-chat", user, job(name))) for user, name in [
+        ("u1", "busy-u1-1"), ("u1", "busy-u1-2"), ("u1", "busy-u1-3"), ("u2", "busy-u2-1")]]
+    tasks.append(asyncio.create_task(scheduler.submit("quiet-chat", "u3", job("quiet-u3-1"))))
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 5
+
+    gate.set()
+    await asyncio.gather(blocker, *tasks)
+
+    assert order == ["blocker", "busy-u1-1", "quiet-u3-1", "busy-u2-1", "busy-u1-2", "busy-u1-3"]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    scheduler = FairScheduler(max_concurrency=2)
+    active = 0
+    max_active = 0
+
+    async def run():
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    await asyncio.gather(*[scheduler.submit(str(i % 3), "u", run) for i in range(10)])
+
+    assert max_active == 2
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_immediately():
+    scheduler = FairScheduler(max_concurrency=1, max_queue_depth=2)
+    gate = asyncio.Event()
+
+    async def run():
+        await gate.wait()
+        return "done"
+
+    tasks = [asyncio.create_task(scheduler.submit("chat", "u", run)) for _ in range(3)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueueFullError):
+        await scheduler.submit("chat", "u", run)
+    assert scheduler.stats()["rejected"] == 1
+
+    gate.set()
+    assert await asyncio.gather(*tasks) == ["done"] * 3
+
+
+@pytest.mark.asyncio
+async def test_errors_are_propagated_to_submitter():
+    scheduler = FairScheduler(max_concurrency=1)
+
+    async def run():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await scheduler.submit("chat", "u", run)
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_leaves_the_queue():
+    scheduler = FairScheduler(max_concurrency=1)
+    gate = asyncio.Event()
+    started = []
+
+    async def run(name):
+        started.append(name)
+        await gate.wait()
+
+    first = asyncio.create_task(scheduler.submit("chat", "u", lambda: run("first")))
+    second = asyncio.create_task(scheduler.submit("chat", "u", lambda: run("second")))
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 1
+
+    second.cancel()
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 0
+
+    gate.set()
+    await first
+    assert started == ["first"]
+
+
+@pytest.mark.asyncio
+async def test_stats_report_depth_per_chat():
+    scheduler = FairScheduler(max_concurrency=1)
+    gate = asyncio.Event()
+
+    async def run():
+        await gate.wait()
+
+    tasks = [asyncio.create_task(scheduler.submit(chat, "u", run)) for chat in ["a", "b", "b", "b"]]
+    await asyncio.sleep(0)
+
+    stats = scheduler.stats()
+    assert stats["queue_depth"] == 3
+    assert stats["running"] == 1
+    assert stats["queued_per_chat"] == [("b", 3)]
+
+    gate.set()
+    await asyncio.gather(*tasks)
+    assert scheduler.stats()["max_wait"] > 0
+
+
+@pytest.mark.asyncio
+async def test_cancel_all_fails_queued_and_running_downloads():
+    scheduler = FairScheduler(max_concurrency=1)
+    started = asyncio.Event()
+
+    async def hang():
+        started.set()
+        await asyncio.sleep(10)
+
+    running = asyncio.create_task(scheduler.submit("chat", "u1", hang))
+    queued = asyncio.create_task(scheduler.submit("chat", "u2", hang))
+    await started.wait()
+
+    assert scheduler.cancel_all(ShuttingDownError()) == 2
+    for task in (running, queued):
+        with pytest.raises(ShuttingDownError):
+            await task
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 0 and scheduler.running == 0
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from telegram_media_downloader_bot.scratch import ScratchSpace
+
+
+@pytest.fixture
+def scratch(tmp_path):
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=100, orphan_ttl=60, sweep_interval=0)
+    yield scratch
+    scratch.close()
+
+
+def test_directory_is_created(scratch):
+    assert os.path.isdir(scratch.directory)
+
+
+@pytest.mark.asyncio
+async def test_reservations_wait_for_space(scratch):
+    first = await scratch.reserve(60)
+    waiting = asyncio.ensure_future(scratch.reserve(60))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    assert scratch.usage()["waiting"] == 1
+
+    # Shrinking the first reservation to the space actually used makes room.
+    first.resize(30)
+    second = await asyncio.wait_for(waiting, 1)
+    assert scratch.reserved == 90
+
+    first.release()
+    second.release()
+    second.release()
+    assert scratch.reserved == 0
+
+
+@pytest.mark.asyncio
+async def test_reservation_larger_than_quota_is_rejected(scratch):
+    with pytest.raises(ValueError):
+        await scratch.reserve(101)
+
+
+@pytest.mark.asyncio
+async def test_sweep_deletes_only_old_orphans(scratch):
+    def make_file(name, age):
+        path = os.path.join(scratch.directory, name)
+        with open(path, "wb") as f:
+            f.write(b"\0" * 10)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    orphan = make_file("orphan.mp4", age=120)
+    fresh = make_file("fresh.mp4", age=1)
+    live = make_file("live.mp4", age=120)
+
+    reservation = await scratch.reserve(10)
+    reservation.attach(live)
+
+    assert scratch.sweep() == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(fresh) and os.path.exists(live)
+    assert scratch.usage()["swept"] == 1
+    assert scratch.usage()["bytes_swept"] == 10
+
+    # Once released, a file that was left behind is swept like any other.
+    reservation.release()
+    assert scratch.sweep() == 1
+    assert not os.path.exists(live)
+
+
+def test_background_sweeper_runs_at_startup(tmp_path):
+    path = tmp_path / "leftover.mp4"
+    path.write_bytes(b"\0")
+    os.utime(path, (0, 0))
+
+    scratch = ScratchSpace(str(tmp_path), orphan_ttl=60, sweep_interval=60)
+    scratch.close()
+
+    assert not path.exists()
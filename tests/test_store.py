@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.store import StateStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "state.db")
+
+
+def test_state_round_trip(db_path):
+    store = StateStore(db_path, flush_interval=0)
+    now = time.time()
+    store.put_file_id("instagram.com/reel/a", "file-a", now + 100)
+    store.put_file_id("instagram.com/reel/b", "file-b", now - 1)
+    store.put_file_id("instagram.com/reel/c", "file-c", now + 100)
+    store.delete_file_id("instagram.com/reel/c")
+    store.add_authenticated_chat("100")
+    store.add_authenticated_chat("100")
+    store.put_user_chat("1", "200")
+    store.set_counter("num_downloads", 3)
+    store.set_counter("num_downloads", 4)
+    store.close()
+
+    store = StateStore(db_path)
+    assert store.load_file_ids(now=now) == [("instagram.com/reel/a", "file-a", now + 100)]
+    assert store.load_authenticated_chats() == ["100"]
+    assert store.load_user_chats() == {"1": "200"}
+    assert store.load_counters() == {"num_downloads": 4}
+
+    store.clear_authenticated_chats()
+    store.flush()
+    assert store.load_authenticated_chats() == []
+    store.close()
+
+
+def test_writes_are_batched_off_the_calling_thread(db_path):
+    store = StateStore(db_path, flush_interval=0.2)
+    start = time.monotonic()
+    for i in range(500):
+        store.set_counter(f"counter-{i}", i)
+    assert time.monotonic() - start < 0.2
+
+    store.flush()
+    assert len(store.load_counters()) == 500
+    store.close()
+
+
+def test_expired_and_excess_file_ids_are_pruned(db_path):
+    store = StateStore(db_path, flush_interval=0)
+    now = time.time()
+    store.put_file_id("expired", "file-expired", now - 1)
+    for i in range(5):
+        store.put_file_id(f"key-{i}", f"file-{i}", now + 100 + i)
+    store.close()
+
+    store = StateStore(db_path, flush_interval=0, max_file_ids=3)
+    assert store._query("SELECT key FROM file_ids ORDER BY expires_at") == [("key-2",), ("key-3",), ("key-4",)]
+
+    store.put_file_id("key-5", "file-5", now + 200)
+    store.flush()
+    assert store._query("SELECT key FROM file_ids ORDER BY expires_at") == [("key-3",), ("key-4",), ("key-5",)]
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_bot_state_survives_restart(db_path):
+    bot = MediaDownloaderBot(token="dummy", password="testpass", log_file="", state_db=db_path)
+    bot.authenticate_chat("100")
+    bot._put_file_id("instagram.com/reel/abc", "file-abc")
+    bot._put_file_id(bot._content_key("0" * 64), "file-abc")
+    bot._user_to_chat_id["1"] = "200"
+    bot._store.put_user_chat("1", "200")
+    bot.close()
+
+    restarted = MediaDownloaderBot(token="dummy", password="testpass", log_file="", state_db=db_path)
+    assert "100" in restarted._authenticated_chats
+    assert restarted._user_to_chat_id == {"1": "200"}
+    assert restarted._file_id_cache.get("instagram.com/reel/abc") == "file-abc"
+    assert restarted._content_file_id_cache.get(restarted._content_key("0" * 64)) == "file-abc"
+    restarted.close()
@@ -1,6 +1,9 @@
 from datetime import datetime
 from fileinput import FileInput
 import os
+import sys
+import threading
+import time
 from typing import Optional 
 import pytest
 import asyncio
@@ -10,6 +13,22 @@ from telegram import User, Chat, Message, Update
 from telegram.ext import ContextTypes
 
 from telegram_media_downloader_bot.bot import MediaDownloaderBot
+from telegram_media_downloader_bot.buffer import MediaBuffer
+from telegram_media_downloader_bot.downloader import DownloadResult, DownloadTimings, MediaInfo, create_download_executor
+from telegram_media_downloader_bot.errors import MediaTooLargeError
+from telegram_media_downloader_bot.jobs import Job, JobResult, SQLiteJobQueue
+from telegram_media_downloader_bot.ratelimit import PRIORITY_LOW, TelegramRateLimiter
+from telegram_media_downloader_bot.worker import serve_jobs
+
+
+@pytest.fixture(autouse=True)
+def probe_media():
+    """
+    Downloads are stubbed by the tests, so stub the probe that precedes each of them, too.
+    """
+    with patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._probe_media",
+               return_value=MediaInfo(entries=({},), duration=None, size=None, extract_time=0.1)) as mock_probe:
+        yield mock_probe
 
 
 @pytest.fixture
@@ -21,6 +40,7 @@ def bot():
         admin_user_id="42",
         bot_user_id="9999",
         public_ipv4="1.2.3.4",
+        log_file="",
     )
 
 
@@ -54,6 +74,19 @@ def make_update(user_id="1", chat_id="100", text=None, is_group=False):
     return update
 
 
+def make_download_result(data: bytes = b"video", count: int = 1) -> DownloadResult:
+    items = []
+    for _ in range(count):
+        media = MediaBuffer()
+        media.write(data)
+        items.append(media)
+    return DownloadResult(tuple(items), DownloadTimings(extract=0.1, download=0.2, size=count * len(data)))
+
+
+def video_message(file_id: str) -> MagicMock:
+    return MagicMock(video=MagicMock(file_id=file_id))
+
+
 @pytest.mark.asyncio
 async def test_start_command(bot, fake_context):
     update = make_update(text="/start")
@@ -90,6 +123,7 @@ async def test_metrics_command(bot, fake_context):
 @pytest.mark.asyncio
 @patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
 async def test_download_command_valid_url(mock_download, bot, fake_context):
+    mock_download.return_value = make_download_result()
     bot.authenticate_chat("1000")
     update = make_update(
         text="/download https://www.youtube.com/shorts/2vAFkEhL2g4", chat_id="1000")
@@ -126,26 +160,25 @@ async def test_download_media(bot, fake_context):
     chat_id: str = "1234"
     bot.authenticate_chat(chat_id)
     url:str = "https://www.instagram.com/reel/DE9WkhAoLQJ/"
-    output_path:str = "test.mp4"
-    bot._download_media(url, output_path)
-    
-    assert os.path.exists(output_path)
-    assert os.path.isfile(output_path)
+    result: DownloadResult = bot._download_media(url, "./")
 
-    os.remove(output_path)
-    
-    assert not os.path.exists(output_path)
+    with result.items[0] as media:
+        assert media.size > 0
+        with media.open() as video:
+            assert video.read(1)
+
+    assert media.path is None or not os.path.exists(media.path)
     
 @pytest.mark.asyncio
-@patch("telegram_media_downloader_bot.bot.os.remove")
-@patch("telegram_media_downloader_bot.bot.open", new_callable=MagicMock)
 @patch("telegram_media_downloader_bot.bot.uuid.uuid4", return_value="fake-id")
 @patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
-async def test_inline_download_command_success(mock_download, mock_uuid, mock_open, mock_remove, bot, fake_context):
+async def test_inline_download_command_success(mock_download, mock_uuid, bot, fake_context):
+    mock_download.return_value = make_download_result()
     # Set up user ID and chat ID mapping
     bot._user_to_chat_id["1"] = "100"
 
     mock_video = MagicMock()
+    mock_video.file_id = "cached-file-id"
     mock_video.get_file = AsyncMock(return_value=MagicMock(file_id="cached-file-id"))
     mock_message = MagicMock()
     mock_message.video = mock_video
@@ -162,6 +195,9 @@ async def test_inline_download_command_success(mock_download, mock_uuid, mock_op
     mock_download.assert_called_once()
     fake_context.bot.send_video.assert_called_once()
     update.inline_query.answer.assert_called_once()
+    # The upload's file handle is closed and the buffer is released once the video has been sent.
+    assert fake_context.bot.send_video.call_args.kwargs["video"].closed
+    assert mock_download.return_value.items[0].closed
 
 @pytest.mark.asyncio
 @patch("telegram_media_downloader_bot.bot.datetime")
@@ -180,8 +216,719 @@ async def test_check_group_auth_timeout(mock_sleep, mock_datetime, bot, fake_con
 
     await bot._check_group_auth(chat_id=int(chat_id), context=fake_context)
 
+    # Without a rate limiter, `ExtBot` rejects `rate_limit_args`.
     fake_context.bot.send_message.assert_called_once_with(
         chat_id=int(chat_id), text="⏰ Authentication timeout. Goodbye!"
     )
     fake_context.bot.leave_chat.assert_called_once_with(int(chat_id))
-    assert chat_id not in bot._group_auth_timers
\ No newline at end of file
+    assert chat_id not in bot._group_auth_timers
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.asyncio.sleep", return_value=None)
+async def test_check_group_auth_timeout_leaves_even_if_goodbye_fails(mock_sleep, bot, fake_context):
+    chat_id = "9999"
+    bot._group_auth_timers[chat_id] = {"removal_time": datetime.now(), "authenticated": False}
+    bot._rate_limiter = TelegramRateLimiter()
+    fake_context.bot.send_message = AsyncMock(side_effect=RuntimeError("Forbidden"))
+    fake_context.bot.leave_chat = AsyncMock()
+
+    await bot._check_group_auth(chat_id=int(chat_id), context=fake_context)
+
+    assert fake_context.bot.send_message.call_args.kwargs["rate_limit_args"] == PRIORITY_LOW
+    fake_context.bot.leave_chat.assert_called_once_with(int(chat_id))
+    assert chat_id not in bot._group_auth_timers
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_download_media_async_runs_in_worker_pool(mock_download, bot):
+    download_threads = []
+
+    def download(url, directory, info=None):
+        download_threads.append(threading.current_thread())
+        return make_download_result(b"\0" * 1024)
+
+    mock_download.side_effect = download
+
+    (media,) = await bot._download_media_async("https://www.youtube.com/shorts/2vAFkEhL2g4", "./", platform="youtube")
+
+    assert len(download_threads) == 1
+    assert download_threads[0] is not threading.current_thread()
+    assert media.size == 1024
+    assert bot._metrics.downloaded_bytes.value(platform="youtube") == 1024
+    assert bot._metrics.stage_duration.count(stage="extract") == 1
+    # Downloads are only counted once the video has been delivered.
+    assert bot._num_downloads == 0
+
+
+@pytest.mark.asyncio
+async def test_download_worker_pool_is_bounded():
+    bot = MediaDownloaderBot(token="dummy", download_workers=2, log_file="")
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def slow_download(url, directory, info=None):
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(max_active, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return make_download_result()
+
+    with patch.object(bot, "_download_media", side_effect=slow_download):
+        await asyncio.gather(*[bot._download_media_async(f"url-{i}", "./") for i in range(6)])
+
+    assert max_active == 2
+
+
+def test_create_download_executor_rejects_invalid_arguments():
+    with pytest.raises(ValueError):
+        create_download_executor("fiber", 2)
+
+    with pytest.raises(ValueError):
+        create_download_executor("thread", 0)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_messages_for_same_url_download_once(bot, fake_context):
+    chat_id: str = "1234"
+    bot.authenticate_chat(chat_id)
+
+    def slow_download(url, directory, info=None):
+        time.sleep(0.05)
+        return make_download_result()
+
+    updates = [
+        make_update(chat_id=chat_id, text="https://www.instagram.com/reel/DE9WkhAoLQJ/"),
+        make_update(chat_id=chat_id, text="https://instagram.com/reel/DE9WkhAoLQJ/?igsh=abc"),
+        make_update(chat_id=chat_id, text="https://www.instagram.com/reel/DE9WkhAoLQJ"),
+    ]
+
+    for update in updates:
+        update.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    with patch.object(bot, "_download_media", side_effect=slow_download) as mock_download:
+        buffers = [media for result in await asyncio.gather(*[bot.handle_message(update, fake_context) for update in updates])
+                   for media in result]
+
+    mock_download.assert_called_once()
+    assert len(buffers) == 3
+    assert len(set(map(id, buffers))) == 1
+    # The shared buffer was uploaded once, and the other replies re-sent it by file ID. It was released after the last one.
+    videos = [update.message.reply_video.call_args.kwargs["video"] for update in updates]
+    readers = [video for video in videos if not isinstance(video, str)]
+    assert len(readers) == 1 and readers[0].closed
+    assert videos.count("file-id-1") == 2
+    assert buffers[0].closed
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_repeat_message_is_answered_from_file_id_cache(mock_download, bot, fake_context):
+    mock_download.return_value = make_download_result()
+    chat_id: str = "1234"
+    bot.authenticate_chat(chat_id)
+
+    first = make_update(chat_id=chat_id, text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+    first.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+    await bot.handle_message(first, fake_context)
+
+    second = make_update(chat_id=chat_id, text="https://instagram.com/reel/DE9WkhAoLQJ?igsh=xyz")
+    second.message.reply_video = AsyncMock()
+    await bot.handle_message(second, fake_context)
+
+    mock_download.assert_called_once()
+    second.message.reply_video.assert_called_once_with(
+        video="file-id-1", reply_to_message_id=second.message.message_id)
+
+    assert bot._num_downloads == 2
+    assert bot._metrics.deliveries.value(platform="instagram", source="upload") == 1
+    assert bot._metrics.deliveries.value(platform="instagram", source="cache") == 1
+    assert bot._metrics.cache_hits.value(platform="instagram") == 1
+    assert bot._metrics.cache_misses.value(platform="instagram") == 1
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_identical_media_from_another_url_is_sent_by_file_id(mock_download, bot, fake_context):
+    mock_download.side_effect = lambda url, directory, info=None: make_download_result(b"same clip")
+
+    first = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    first.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+    await bot.handle_message(first, fake_context)
+
+    # A repost of the same clip.
+    second = make_update(chat_id="1234", text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+    second.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+    await bot.handle_message(second, fake_context)
+
+    assert mock_download.call_count == 2
+    second.message.reply_video.assert_called_once_with(
+        video="file-id-1", reply_to_message_id=second.message.message_id)
+    assert bot._metrics.content_dedup_hits.value(platform="instagram") == 1
+    assert bot._metrics.deliveries.value(platform="instagram", source="content") == 1
+    assert bot._metrics.uploaded_bytes.total() == len(b"same clip")
+    # Links to the repost are answered from the file ID cache from now on.
+    assert bot._file_id_cache.get("instagram:DE9WkhAoLQJ") == "file-id-1"
+
+
+def test_content_entries_do_not_evict_url_entries():
+    bot = MediaDownloaderBot(token="dummy", log_file="", file_id_cache_size=1)
+    bot._put_file_id("youtube:2vAFkEhL2g4", "file-id-1")
+    bot._put_file_id(bot._content_key("0" * 64), "file-id-1")
+
+    assert bot._file_id_cache.get("youtube:2vAFkEhL2g4") == "file-id-1"
+    assert bot._content_file_id_cache.get(bot._content_key("0" * 64)) == "file-id-1"
+    bot.close()
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_stale_content_file_id_falls_back_to_upload(mock_download, bot, fake_context):
+    result = make_download_result(b"same clip")
+    mock_download.return_value = result
+    bot._put_file_id(bot._content_key(result.items[0].sha256), "expired-file-id")
+
+    update = make_update(chat_id="1234", text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+    update.message.reply_video = AsyncMock(side_effect=[Exception("Wrong file identifier"), video_message("file-id-2")])
+    await bot.handle_message(update, fake_context)
+
+    assert update.message.reply_video.call_count == 2
+    assert not isinstance(update.message.reply_video.call_args.kwargs["video"], str)
+    assert bot._content_file_id_cache.get(bot._content_key(result.items[0].sha256)) == "file-id-2"
+    assert bot._metrics.deliveries.value(platform="instagram", source="upload") == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_command_by_admin_includes_stage_latency(bot, fake_context):
+    bot._metrics.stage_duration.observe(0.2, stage="download", platform="youtube")
+    update = make_update(user_id="42", text="/metrics")
+    await bot.metrics_command(update, fake_context)
+
+    reply: str = update.message.reply_text.call_args[0][0]
+    assert reply.startswith("⬇️ Total number of downloads: 0")
+    assert "download: p50" in reply
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_inline_download_command_cache_hit(mock_download, bot, fake_context):
+    bot._user_to_chat_id["1"] = "100"
+    bot._file_id_cache.put("instagram:abc123", "cached-file-id")
+    fake_context.bot.send_video = AsyncMock()
+
+    update = MagicMock()
+    update.inline_query.query = "https://www.instagram.com/reel/abc123/?igsh=1 look at this"
+    update.inline_query.from_user.id = 1
+    update.inline_query.answer = AsyncMock()
+
+    await bot.inline_download_command(update, fake_context)
+
+    mock_download.assert_not_called()
+    fake_context.bot.send_video.assert_not_called()
+    results = update.inline_query.answer.call_args.args[0]
+    assert results[0].video_file_id == "cached-file-id"
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_download_rejected_when_queue_is_full(mock_download, fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", max_queue_depth=0)
+    update = make_update(text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+
+    await bot.handle_message(update, fake_context)
+
+    mock_download.assert_not_called()
+    update.message.reply_text.assert_called_once_with(
+        "⏳ I'm busy right now. Please try again in a minute.",
+        reply_to_message_id=update.message.message_id)
+
+
+@pytest.mark.asyncio
+async def test_spilled_download_reserves_scratch_space_until_released(tmp_path, fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", scratch_dir=str(tmp_path), max_upload_size=100, scratch_quota=100)
+    bot.authenticate_chat("1234")
+
+    def download(url, directory, info=None):
+        media = MediaBuffer(directory, spool_threshold=0)
+        media.write(b"\0" * 10)
+        reserved.append(bot._scratch.reserved)
+        return DownloadResult((media,), DownloadTimings(extract=0.0, download=0.0, size=10))
+
+    async def reply_video(video, reply_to_message_id=None):
+        assert bot._scratch.reserved == 10
+        assert len(os.listdir(tmp_path)) == 1
+
+    reserved = []
+    update = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    update.message.reply_video = reply_video
+    with patch.object(bot, "_download_media", side_effect=download):
+        await bot.handle_message(update, fake_context)
+
+    # The whole quota was reserved while downloading, and everything is released after the reply.
+    assert reserved == [100]
+    assert bot._scratch.reserved == 0
+    assert os.listdir(tmp_path) == []
+    bot.close()
+
+
+@pytest.mark.asyncio
+async def test_download_reserves_its_probed_size(tmp_path, probe_media, fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", scratch_dir=str(tmp_path), max_upload_size=100, scratch_quota=100)
+    bot.authenticate_chat("1234")
+    probe_media.return_value = MediaInfo(entries=({},), duration=None, size=40, extract_time=0.1)
+    # Holds most of the quota, which the probed size still fits next to.
+    other = await bot._scratch.reserve(50)
+
+    def download(url, directory, info=None):
+        reserved.append(bot._scratch.reserved)
+        media = MediaBuffer(directory, spool_threshold=0)
+        media.write(b"\0" * 10)
+        return DownloadResult((media,), DownloadTimings(extract=0.0, download=0.0, size=10))
+
+    reserved = []
+    update = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    with patch.object(bot, "_download_media", side_effect=download):
+        await bot.handle_message(update, fake_context)
+
+    # The probed size, with a margin for estimates, rather than the largest possible download.
+    assert reserved == [50 + 50]
+    other.release()
+    assert bot._scratch.reserved == 0
+    bot.close()
+
+
+@pytest.mark.asyncio
+async def test_oversize_video_is_re_encoded_to_fit(tmp_path, probe_media, fake_context):
+    # Stands in for ffmpeg, writing a video that fits.
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(f"#!{sys.executable}\nimport sys\nopen(sys.argv[-1], 'wb').write(b'small')\n")
+    ffmpeg.chmod(0o755)
+    with patch("telegram_media_downloader_bot.bot.find_ffmpeg", return_value=str(ffmpeg)):
+        bot = MediaDownloaderBot(token="dummy", log_file="", scratch_dir=str(tmp_path / "scratch"), max_upload_size=100,
+                                 postprocess_headroom=1.5)
+    bot.authenticate_chat("1234")
+    # Short enough for a bitrate that fits 100 bytes.
+    probe_media.return_value = MediaInfo(entries=({"ext": "mp4", "duration": 0.001},), duration=0.001, size=120, extract_time=0.1)
+
+    uploaded = []
+
+    async def reply_video(video, reply_to_message_id=None):
+        uploaded.append(video.read())
+        return video_message("file-id-1")
+
+    update = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    update.message.reply_video = reply_video
+    with patch.object(bot, "_download_media", return_value=make_download_result(b"\0" * 120)) as mock_download:
+        await bot.handle_message(update, fake_context)
+
+    mock_download.assert_called_once()
+    assert uploaded == [b"small"]
+    assert bot._metrics.stage_duration.count(stage="postprocess") == 1
+    assert bot._metrics.postprocess_cpu_seconds.value(action="transcode", platform="youtube") > 0
+    assert os.listdir(tmp_path / "scratch") == []
+    bot.close()
+
+
+def test_scratch_quota_must_fit_one_download(tmp_path):
+    with pytest.raises(ValueError):
+        MediaDownloaderBot(token="dummy", log_file="", scratch_dir=str(tmp_path), max_upload_size=100, scratch_quota=50)
+
+
+@pytest.mark.asyncio
+async def test_status_command(bot, fake_context):
+    update = make_update(user_id="42", text="/status")
+    await bot.status_command(update, fake_context)
+    assert "Queued downloads: 0/100" in update.message.reply_text.call_args.args[0]
+    assert "Scratch space: 0.0 MB in 0 file(s)" in update.message.reply_text.call_args.args[0]
+
+    update = make_update(user_id="2", text="/status")
+    await bot.status_command(update, fake_context)
+    update.message.reply_text.assert_not_called()
+
+
+def test_webhook_url(bot):
+    assert bot.webhook_url() == "https://1.2.3.4:8081/webhook"
+    assert bot.webhook_url("updates") == "https://1.2.3.4:8081/updates"
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_oversize_media_is_rejected(mock_download, bot, fake_context):
+    chat_id: str = "1234"
+    mock_download.side_effect = MediaTooLargeError(80 * 1024 * 1024, 50 * 1024 * 1024)
+    update = make_update(chat_id=chat_id, text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+
+    await bot.handle_message(update, fake_context)
+
+    update.message.reply_text.assert_called_once_with(
+        "⚠️ The requested video is larger than 50 MB, which is too large to send on Telegram. Sorry!",
+        reply_to_message_id=update.message.message_id)
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.asyncio.sleep", new_callable=AsyncMock)
+async def test_slow_inline_download_is_answered_with_placeholder(mock_sleep, fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", inline_answer_timeout=0.01)
+    bot._user_to_chat_id["1"] = "100"
+
+    mock_message = MagicMock()
+    mock_message.video.file_id = "late-file-id"
+    fake_context.bot.send_video = AsyncMock(return_value=mock_message)
+    fake_context.bot.delete_message = AsyncMock()
+
+    def make_inline_update():
+        update = MagicMock()
+        update.inline_query.query = "https://www.instagram.com/reel/abc123/"
+        update.inline_query.from_user.id = 1
+        update.inline_query.answer = AsyncMock()
+        return update
+
+    def slow_download(url, directory, info=None):
+        time.sleep(0.2)
+        return make_download_result()
+
+    with patch.object(bot, "_download_media", side_effect=slow_download) as mock_download:
+        first = make_inline_update()
+        await bot.inline_download_command(first, fake_context)
+
+        placeholder = first.inline_query.answer.call_args.args[0][0]
+        assert placeholder.title == "⏳ Preparing Video..."
+        assert placeholder.input_message_content.message_text == "https://www.instagram.com/reel/abc123/"
+
+        # A retry while the download is still running joins the same background task.
+        second = make_inline_update()
+        await bot.inline_download_command(second, fake_context)
+
+        await asyncio.gather(*bot._background_tasks)
+
+    mock_download.assert_called_once()
+    fake_context.bot.send_video.assert_called_once()
+    # The user got a placeholder, so the video stays in their private chat.
+    fake_context.bot.delete_message.assert_not_called()
+
+    retry = make_inline_update()
+    await bot.inline_download_command(retry, fake_context)
+    assert retry.inline_query.answer.call_args.args[0][0].video_file_id == "late-file-id"
+
+
+@pytest.mark.asyncio
+async def test_every_link_in_a_message_is_sent_in_one_media_group(bot, fake_context):
+    chat_id: str = "1234"
+    bot.authenticate_chat(chat_id)
+    bot._file_id_cache.put("youtube:2vAFkEhL2g4", "cached-file-id")
+
+    def download(url, directory, info=None):
+        # The first link is a carousel of two videos.
+        return make_download_result(count=2 if "DE9WkhAoLQJ" in url else 1)
+
+    update = make_update(chat_id=chat_id, text=(
+        "https://www.instagram.com/reel/DE9WkhAoLQJ/ and https://www.youtube.com/shorts/2vAFkEhL2g4 "
+        "and https://www.instagram.com/reel/abc123/"))
+    update.message.reply_video = AsyncMock()
+    update.message.reply_media_group = AsyncMock(
+        return_value=[video_message(f"file-id-{i}") for i in range(4)])
+
+    with patch.object(bot, "_download_media", side_effect=download) as mock_download:
+        buffers = await bot.handle_message(update, fake_context)
+
+    assert mock_download.call_count == 2
+    update.message.reply_video.assert_not_called()
+    update.message.reply_media_group.assert_called_once()
+    media = update.message.reply_media_group.call_args.kwargs["media"]
+    assert len(media) == 4
+    # The videos are sent in the order of their links, with the cached video re-sent by file ID.
+    assert media[2].media == "cached-file-id"
+
+    assert len(buffers) == 3 and all(media.closed for media in buffers)
+    assert bot._file_id_cache.get("instagram:DE9WkhAoLQJ") == "file-id-0,file-id-1"
+    assert bot._file_id_cache.get("instagram:abc123") == "file-id-3"
+    assert bot._num_downloads == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_link_does_not_prevent_the_others_from_being_sent(bot, fake_context):
+    chat_id: str = "1234"
+    bot.authenticate_chat(chat_id)
+
+    def download(url, directory, info=None):
+        if "abc123" in url:
+            raise MediaTooLargeError(80 * 1024 * 1024, 50 * 1024 * 1024)
+        return make_download_result()
+
+    update = make_update(chat_id=chat_id, text=(
+        "https://www.instagram.com/reel/DE9WkhAoLQJ/ https://www.instagram.com/reel/abc123/"))
+    update.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    with patch.object(bot, "_download_media", side_effect=download):
+        await bot.handle_message(update, fake_context)
+
+    update.message.reply_video.assert_called_once()
+    update.message.reply_text.assert_called_once_with(
+        "⚠️ The requested video is larger than 50 MB, which is too large to send on Telegram. Sorry!",
+        reply_to_message_id=update.message.message_id)
+
+
+@pytest.mark.asyncio
+async def test_inline_query_for_carousel_offers_every_video(bot, fake_context):
+    bot._user_to_chat_id["1"] = "100"
+    bot._file_id_cache.put("instagram:abc123", "file-id-1,file-id-2")
+
+    update = MagicMock()
+    update.inline_query.query = "https://www.instagram.com/reel/abc123/"
+    update.inline_query.from_user.id = 1
+    update.inline_query.answer = AsyncMock()
+
+    await bot.inline_download_command(update, fake_context)
+
+    results = update.inline_query.answer.call_args.args[0]
+    assert [result.video_file_id for result in results] == ["file-id-1", "file-id-2"]
+    assert len({result.id for result in results}) == 2
+
+
+@pytest.mark.asyncio
+async def test_transient_download_error_is_retried(bot, fake_context):
+    chat_id: str = "1234"
+    bot._resilience._sleep = AsyncMock()
+    update = make_update(chat_id=chat_id, text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    update.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    with patch.object(bot, "_download_media", side_effect=[TimeoutError(), make_download_result()]) as mock_download:
+        await bot.handle_message(update, fake_context)
+
+    assert mock_download.call_count == 2
+    update.message.reply_video.assert_called_once()
+    assert bot._metrics.retries.value(platform="youtube") == 1
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_age_restricted_video_is_reported(mock_download, bot, fake_context):
+    mock_download.side_effect = Exception("ERROR: Sign in to confirm your age. This video may be inappropriate for some users.")
+    update = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+
+    await bot.handle_message(update, fake_context)
+
+    mock_download.assert_called_once()
+    assert "age restricted" in update.message.reply_text.call_args.args[0]
+
+
+@pytest.mark.asyncio
+@patch("telegram_media_downloader_bot.bot.MediaDownloaderBot._download_media")
+async def test_open_circuit_breaker_rejects_downloads_without_queueing(mock_download, fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", download_attempts=1)
+    mock_download.side_effect = TimeoutError()
+    for _ in range(5):
+        await bot.handle_message(make_update(text="https://www.instagram.com/reel/DE9WkhAoLQJ/"), fake_context)
+    assert mock_download.call_count == 5
+
+    update = make_update(text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+    await bot.handle_message(update, fake_context)
+
+    assert mock_download.call_count == 5
+    assert update.message.reply_text.call_args.args[0].startswith("🚧 Downloads from instagram are failing right now")
+    assert bot._metrics.circuit_state.value(platform="instagram") == 2
+
+    admin = make_update(user_id="42", text="/metrics")
+    bot._admin_user_id = "42"
+    await bot.metrics_command(admin, fake_context)
+    assert "instagram: open" in admin.message.reply_text.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_split_mode_hands_downloads_to_workers(fake_context):
+    job_queue = SQLiteJobQueue(":memory:")
+    frontend = MediaDownloaderBot(token="dummy", log_file="", job_queue=job_queue)
+    worker = MediaDownloaderBot(token="dummy", log_file="")
+    telegram_bot = MagicMock()
+    telegram_bot.send_video = AsyncMock(return_value=MagicMock(video=MagicMock(file_id="file-id-1"), message_id=55))
+
+    def download(url, directory, info=None):
+        if "abc123" in url:
+            raise MediaTooLargeError(80 * 1024 * 1024, 50 * 1024 * 1024)
+        return make_download_result()
+
+    update = make_update(text="https://www.youtube.com/shorts/2vAFkEhL2g4 https://www.instagram.com/reel/abc123/")
+    update.message.message_id = 7
+    update.message.reply_video = AsyncMock()
+
+    stop = asyncio.Event()
+    serving = asyncio.ensure_future(serve_jobs(worker, job_queue, telegram_bot, stop=stop, poll_timeout=0.05))
+    try:
+        with patch.object(worker, "_download_media", side_effect=download) as worker_download, \
+                patch.object(frontend, "_download_media") as frontend_download:
+            await frontend.handle_message(update, fake_context)
+    finally:
+        stop.set()
+        assert await serving == 2
+        frontend.close()
+        worker.close()
+
+    frontend_download.assert_not_called()
+    assert worker_download.call_count == 2
+
+    # The worker replied with the video itself, and the frontend replied with the other link's error.
+    telegram_bot.send_video.assert_called_once()
+    assert telegram_bot.send_video.call_args.kwargs["chat_id"] == "100"
+    assert telegram_bot.send_video.call_args.kwargs["reply_to_message_id"] == 7
+    update.message.reply_video.assert_not_called()
+    update.message.reply_text.assert_called_once_with(
+        "⚠️ The requested video is larger than 50 MB, which is too large to send on Telegram. Sorry!",
+        reply_to_message_id=update.message.message_id)
+
+    assert frontend._file_id_cache.get("youtube:2vAFkEhL2g4") == "file-id-1"
+    assert frontend._num_downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_does_not_send_media_of_cancelled_jobs():
+    job_queue = SQLiteJobQueue(":memory:")
+    worker = MediaDownloaderBot(token="dummy", log_file="")
+    telegram_bot = MagicMock()
+    telegram_bot.send_video = AsyncMock()
+    job = Job.create("https://www.youtube.com/shorts/2vAFkEhL2g4", "youtube", "100", "1", 7, "frontend")
+    job_queue.put(job)
+    assert job_queue.get(timeout=1) == job
+
+    def download(url, directory, info=None):
+        # The frontend gives up while the worker is downloading.
+        job_queue.cancel(job)
+        return make_download_result()
+
+    with patch.object(worker, "_download_media", side_effect=download):
+        result = await worker.process_job(job, telegram_bot, job_queue)
+    worker.close()
+
+    assert result.failed
+    assert "cancelled" in str(result.error())
+    telegram_bot.send_video.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_split_mode_resends_shared_job_to_other_chats(fake_context):
+    frontend = MediaDownloaderBot(token="dummy", log_file="", job_queue=SQLiteJobQueue(":memory:"))
+    release = asyncio.Event()
+
+    async def submit(job):
+        await release.wait()
+        return JobResult(job.id, ("file-id-1",), (55,))
+
+    first = make_update(chat_id="100", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    second = make_update(chat_id="200", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    second.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    with patch.object(frontend._jobs, "submit", side_effect=submit) as mock_submit:
+        requests = asyncio.gather(frontend.handle_message(first, fake_context), frontend.handle_message(second, fake_context))
+        await asyncio.sleep(0.01)
+        release.set()
+        await requests
+    frontend.close()
+
+    mock_submit.assert_called_once()
+    assert mock_submit.call_args.args[0].chat_id == "100"
+    # The worker sent the video to the first chat, so the frontend re-sends it to the second one by file ID.
+    assert second.message.reply_video.call_args.kwargs["video"] == "file-id-1"
+    assert frontend._metrics.coalesced.total() == 1
+
+
+@pytest.mark.asyncio
+async def test_shutdown_waits_for_in_flight_downloads(fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="")
+    update = make_update(text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    update.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    def download(url, *args, **kwargs):
+        time.sleep(0.2)
+        return make_download_result()
+
+    with patch.object(bot, "_download_media", side_effect=download):
+        request = asyncio.ensure_future(bot.handle_message(update, fake_context))
+        await asyncio.sleep(0.05)
+        await bot.shutdown(timeout=5)
+
+    assert request.done()
+    update.message.reply_video.assert_called_once()
+    assert bot._closed
+
+    # Links that arrive after the shutdown are turned away.
+    late = make_update(text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    await bot.handle_message(late, fake_context)
+    assert late.message.reply_text.call_args.args[0].startswith("🔄 I'm restarting")
+
+
+@pytest.mark.asyncio
+async def test_shutdown_timeout_tells_users_to_try_again(fake_context):
+    bot = MediaDownloaderBot(token="dummy", log_file="", download_workers=1)
+    release = threading.Event()
+    running = make_update(text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    queued = make_update(chat_id="200", text="https://www.instagram.com/reel/DE9WkhAoLQJ/")
+
+    def download(url, *args, **kwargs):
+        release.wait(5)
+        return make_download_result()
+
+    with patch.object(bot, "_download_media", side_effect=download):
+        requests = asyncio.gather(bot.handle_message(running, fake_context), bot.handle_message(queued, fake_context))
+        await asyncio.sleep(0.05)
+        shutdown = asyncio.ensure_future(bot.shutdown(timeout=0.1))
+        await requests
+        release.set()
+        await shutdown
+
+    for update in (running, queued):
+        assert update.message.reply_text.call_args.args[0].startswith("🔄 I'm restarting")
+    assert bot._closed
+
+
+@pytest.mark.asyncio
+async def test_exit_command_shuts_down_and_stops_the_application(bot, fake_context):
+    fake_context.application = MagicMock()
+    fake_context.application.updater.running = True
+    fake_context.application.updater.stop = AsyncMock()
+    update = make_update(user_id="42", text="/exit")
+
+    await bot.exit_command(update, fake_context)
+    await bot._shutdown_task
+
+    fake_context.application.updater.stop.assert_called_once()
+    fake_context.application.stop_running.assert_called_once()
+    assert bot.shutting_down
+
+
+@pytest.mark.asyncio
+async def test_post_init_warms_up_downloads_in_the_background():
+    bot = MediaDownloaderBot(token="dummy", log_file="")
+    app = MagicMock()
+
+    with patch("telegram_media_downloader_bot.bot.warm_up") as mock_warm_up:
+        await bot.post_init(app)
+        await asyncio.gather(*bot._background_tasks)
+    bot.close()
+
+    mock_warm_up.assert_called_once_with(bot._scratch.directory, bot._max_upload_size, None, bot._postprocess_size)
+
+
+@pytest.mark.asyncio
+async def test_probe_is_reused_by_the_download_and_rejections_are_cached(bot, probe_media, fake_context):
+    info = MediaInfo(entries=({"id": "abc"},), duration=10.0, size=1024, extract_time=0.1)
+    probe_media.return_value = info
+    update = make_update(chat_id="1234", text="https://www.youtube.com/shorts/2vAFkEhL2g4")
+    update.message.reply_video = AsyncMock(return_value=video_message("file-id-1"))
+
+    with patch.object(bot, "_download_media", return_value=make_download_result()) as mock_download:
+        await bot.handle_message(update, fake_context)
+    assert mock_download.call_args.args[2] is info
+
+    probe_media.side_effect = MediaTooLargeError(100 * 1024 * 1024, bot._max_upload_size)
+    oversize = "https://www.instagram.com/reel/DE9WkhAoLQJ/"
+    with patch.object(bot._scheduler, "submit", wraps=bot._scheduler.submit) as mock_submit:
+        for _ in range(2):
+            update = make_update(chat_id="1234", text=oversize)
+            await bot.handle_message(update, fake_context)
+            assert "too large" in update.message.reply_text.call_args.args[0]
+
+    # The second request was rejected from the metadata cache, without probing or queueing it again.
+    assert probe_media.call_count == 2
+    assert mock_submit.call_count == 1
@@ -0,0 +1,49 @@
+import pytest
+
+from telegram_media_downloader_bot.urls import MediaUrl, classify_url, find_media_urls
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.instagram.com/reel/DE9WkhAoLQJ/",
+    "https://instagram.com/reel/DE9WkhAoLQJ/?igsh=MWQ1ZGUxMzBkMA==",
+    "instagram.com/reel/DE9WkhAoLQJ",
+    "https://m.instagram.com/reels/DE9WkhAoLQJ/#comments",
+    "https://www.instagram.com/some.user/reel/DE9WkhAoLQJ/",
+    "HTTPS://WWW.INSTAGRAM.COM/reel/DE9WkhAoLQJ/",
+])
+def test_instagram_reel_variants_are_canonicalized(url):
+    assert classify_url(url) == MediaUrl(
+        "instagram", "DE9WkhAoLQJ", "https://www.instagram.com/reel/DE9WkhAoLQJ/")
+
+
+def test_instagram_post():
+    media_url = classify_url("https://www.instagram.com/p/C1a2b3c4d5e/?img_index=1")
+    assert media_url == MediaUrl("instagram", "C1a2b3c4d5e", "https://www.instagram.com/p/C1a2b3c4d5e/")
+    assert media_url.key == "instagram:C1a2b3c4d5e"
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/shorts/2vAFkEhL2g4",
+    "https://m.youtube.com/shorts/2vAFkEhL2g4?feature=share",
+    "youtu.be/shorts/2vAFkEhL2g4",
+])
+def test_youtube_shorts_variants_are_canonicalized(url):
+    assert classify_url(url) == MediaUrl(
+        "youtube", "2vAFkEhL2g4", "https://www.youtube.com/shorts/2vAFkEhL2g4")
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=2vAFkEhL2g4",
+    "https://www.instagram.com/some.user/",
+    "https://example.com/reel/abc",
+    "https://notinstagram.com/reel/abc",
+    "hello world",
+])
+def test_unsupported_urls(url):
+    assert classify_url(url) is None
+
+
+def test_find_media_urls_in_message_text():
+    text = ("look at this https://www.instagram.com/reel/AAA/?igsh=1 and "
+            "instagram.com/reel/AAA again, plus youtube.com/shorts/BBB!")
+    assert [media_url.key for media_url in find_media_urls(text)] == ["instagram:AAA", "youtube:BBB"]
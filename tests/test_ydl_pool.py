@@ -0,0 +1,85 @@
+import pytest
+
+from telegram_media_downloader_bot.ydl_pool import YoutubeDLPool
+
+
+class FakeYoutubeDL(object):
+    def __init__(self, params):
+        self.params = {**params, "outtmpl": {"default": params["outtmpl"]}}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_instances_are_reused_with_per_download_options():
+    pool = YoutubeDLPool(factory=FakeYoutubeDL)
+
+    with pool.acquire({"outtmpl": "a.mp4", "quiet": True}) as first:
+        pass
+    with pool.acquire({"outtmpl": "b.mp4", "quiet": True}) as second:
+        assert second.params["outtmpl"]["default"] == "b.mp4"
+
+    assert second is first
+    assert pool.stats() == {"created": 1, "reused": 1, "recycled": 0, "idle": 1}
+
+
+def test_instances_are_keyed_by_options():
+    pool = YoutubeDLPool(factory=FakeYoutubeDL)
+
+    with pool.acquire({"outtmpl": "a.mp4", "quiet": True}) as first:
+        pass
+    with pool.acquire({"outtmpl": "a.mp4", "quiet": False}) as second:
+        pass
+
+    assert second is not first
+
+
+def test_concurrent_acquisitions_get_distinct_instances():
+    pool = YoutubeDLPool(factory=FakeYoutubeDL)
+
+    with pool.acquire({"outtmpl": "a.mp4"}) as first, pool.acquire({"outtmpl": "b.mp4"}) as second:
+        assert second is not first
+
+    assert pool.stats()["idle"] == 2
+
+
+def test_instances_are_recycled_after_max_uses():
+    pool = YoutubeDLPool(max_uses=2, factory=FakeYoutubeDL)
+
+    instances = []
+    for _ in range(3):
+        with pool.acquire({"outtmpl": "a.mp4"}) as ydl:
+            instances.append(ydl)
+
+    assert instances[0] is instances[1] and instances[2] is not instances[0]
+    assert instances[0].closed
+    assert pool.stats()["recycled"] == 1
+
+
+def test_instances_are_recycled_on_error():
+    pool = YoutubeDLPool(factory=FakeYoutubeDL)
+
+    with pytest.raises(RuntimeError):
+        with pool.acquire({"outtmpl": "a.mp4"}) as broken:
+            raise RuntimeError()
+
+    with pool.acquire({"outtmpl": "a.mp4"}) as ydl:
+        assert ydl is not broken
+    assert broken.closed
+
+
+def test_clear_closes_idle_instances():
+    pool = YoutubeDLPool(factory=FakeYoutubeDL)
+    with pool.acquire({"outtmpl": "a.mp4"}) as ydl:
+        pass
+
+    pool.clear()
+
+    assert ydl.closed
+    assert pool.stats()["idle"] == 0
+
+
+def test_max_uses_must_be_positive():
+    with pytest.raises(ValueError):
+        YoutubeDLPool(max_uses=0)